@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+数据库的逻辑备份和恢复工具， 备份文件默认保存在 backup/ 目录下：
+
+    python backup.py dump [-d DIR] [-w 4] [-c 5000] [table ...]
+    python backup.py restore -d DIR [--create] [-w 4] [-b 500] [table ...]
+
+备份时每个表(分片表的每个分片)在一个一致性快照(START TRANSACTION WITH CONSISTENT SNAPSHOT)中
+按主键顺序分块读取， 不需要 mysqldump 那样锁表：
+    <table>[@<engine>].manifest.json    记录列名和每个分块的行数、主键范围、sha1
+    <table>[@<engine>].000000.json.gz   每行一个json数组的分块文件
+每写完一个分块就更新manifest， 中断后用同样的目录重新执行 会校验已有分块并从断点继续。
+多个表/分片由多个worker进程并行备份。
+注意： 快照只保证一个表(分片)内部一致， 不同的表/分片在不同的时刻开始快照，
+表之间的计数器(users.blog_count 等)和冗余字段可能不一致， 恢复之后用 recount_counters 修复；
+断点续传时 剩下的分块来自新的快照。
+
+恢复时先删除表上的二级索引(--create 时重建不带索引的表)， 用多行insert导入之后
+再一次性重建索引； 分片表按当前的分片配置重新路由， 所以分片数可以和备份时不同。
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import os, json, gzip, base64, hashlib, time, argparse
+from multiprocessing import Pool
+from cStringIO import StringIO
+
+from transwarp import db
+from transwarp.orm import create_table_sql, index_ddl, live_indexes
+from transwarp.search import write_atomic
+
+from config import configs
+import models
+
+_MODELS = dict((m.__table__, m) for m in (models.User, models.Blog, models.Comment))
+
+_BACKUP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backup')
+
+
+def _init_db():
+    """
+    初始化数据库engine， 也作为worker进程的initializer
+    fork出来的worker已经继承了engine时 不重复初始化
+    """
+    if db.engine is None:
+        db.create_engine(**configs.db)
+    for group, shards in configs.shards.iteritems():
+        if shards and not db.shard_engines(group):
+            db.add_shards(group, shards)
+
+
+def _encode(value):
+    """
+    不是合法utf-8的二进制值(比如 CompressedTextField) 用base64保存
+    """
+    if isinstance(value, bytearray):
+        value = str(value)
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'b64': base64.b64encode(value)}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['b64'])
+    return value
+
+
+def _prefix(table, engine):
+    return table if engine is None else '%s@%s' % (table, engine)
+
+
+def _load_manifest(fpath):
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath, 'rb') as f:
+        return json.load(f)
+
+
+def _save_manifest(fpath, manifest):
+    write_atomic(fpath, json.dumps(manifest, indent=1))
+
+
+def _sha1(fpath):
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _verify(path, chunk):
+    fpath = os.path.join(path, chunk['file'])
+    return os.path.isfile(fpath) and _sha1(fpath) == chunk['sha1']
+
+
+def _dump_table(job):
+    """
+    备份一个表在一个engine上的数据， 返回 (文件前缀, 总行数, 本次写入的行数)
+    """
+    path, table, engine, chunk_size = job
+    model = _MODELS[table]
+    pk = model.__primary_key__.name
+    prefix = _prefix(table, engine)
+    fmanifest = os.path.join(path, '%s.manifest.json' % prefix)
+    manifest = _load_manifest(fmanifest)
+    if manifest is None:
+        columns = [f.name for f in sorted(model.__mappings__.values(), lambda x, y: cmp(x._order, y._order))]
+        manifest = dict(table=table, engine=engine, pk=pk, columns=columns, chunks=[], done=False)
+    if manifest['done']:
+        return prefix, sum(c['rows'] for c in manifest['chunks']), 0
+    # 断点续传：只保留校验通过的分块，之后的分块重新备份
+    chunks = []
+    for c in manifest['chunks']:
+        if not _verify(path, c):
+            logging.warning('[BACKUP] %s: chunk %s is broken, resume from here.' % (prefix, c['file']))
+            break
+        chunks.append(c)
+    manifest['chunks'] = chunks
+    columns = manifest['columns']
+    select = 'select %s from `%s`' % (','.join(['`%s`' % c for c in columns]), table)
+    written = 0
+    with db.use_engine(engine):
+        with db.transaction():
+            # 整个表(分片)在同一个快照中读取， 读取期间的写入不会让分块之间不一致
+            db.update('start transaction with consistent snapshot')
+            while True:
+                last = chunks[-1]['last'] if chunks else None
+                if last is None:
+                    rows = db.select('%s order by `%s` limit ?' % (select, pk), chunk_size)
+                else:
+                    rows = db.select('%s where `%s`>? order by `%s` limit ?' % (select, pk, pk), last, chunk_size)
+                if not rows:
+                    break
+                buf = StringIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    for r in rows:
+                        f.write(json.dumps([_encode(r[c]) for c in columns]))
+                        f.write('\n')
+                data = buf.getvalue()
+                fname = '%s.%06d.json.gz' % (prefix, len(chunks))
+                write_atomic(os.path.join(path, fname), data)
+                values = [rows[0][pk], rows[-1][pk]]
+                chunks.append(dict(file=fname, rows=len(rows), first=values[0], last=values[1], sha1=hashlib.sha1(data).hexdigest()))
+                _save_manifest(fmanifest, manifest)
+                written += len(rows)
+                logging.info('[BACKUP] %s: %s written, %d rows, last %s=%s' % (prefix, fname, len(rows), pk, values[1]))
+                if len(rows) < chunk_size:
+                    break
+    manifest['done'] = True
+    _save_manifest(fmanifest, manifest)
+    return prefix, sum(c['rows'] for c in chunks), written
+
+
+def _engines(model):
+    return model.__shard__.engines if model.__shard__ else [None]
+
+
+def _run(fn, jobs, workers):
+    if workers <= 1 or len(jobs) <= 1:
+        return map(fn, jobs)
+    pool = Pool(min(workers, len(jobs)), _init_db)
+    try:
+        return pool.map(fn, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def dump(path=None, tables=None, workers=4, chunk_size=5000):
+    """
+    备份 tables 中的表(默认全部)到 path 目录， 返回 [(文件前缀, 总行数, 本次写入的行数), ...]
+    """
+    path = path or os.path.join(_BACKUP_DIR, time.strftime('%Y%m%d-%H%M%S'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    jobs = []
+    for table in tables or sorted(_MODELS):
+        for engine in _engines(_MODELS[table]):
+            jobs.append((path, table, engine, chunk_size))
+    start = time.time()
+    results = _run(_dump_table, jobs, workers)
+    logging.info('[BACKUP] %d rows of %d tables dumped to %s in %.1fs.' % (sum(r[1] for r in results), len(jobs), path, time.time() - start))
+    return results
+
+
+def _read_chunk(path, chunk):
+    fpath = os.path.join(path, chunk['file'])
+    if _sha1(fpath) != chunk['sha1']:
+        raise db.DBError('Checksum mismatch: %s' % fpath)
+    with gzip.open(fpath, 'rb') as f:
+        for line in f:
+            yield [_decode(v) for v in json.loads(line)]
+
+
+def _restore_table(job):
+    """
+    把一组备份文件 用多行insert导入， 分片表的每一行按当前分片配置路由， 返回导入的行数
+    """
+    path, fmanifest, batch_size = job
+    manifest = _load_manifest(os.path.join(path, fmanifest))
+    model = _MODELS[manifest['table']]
+    columns = manifest['columns']
+    key = columns.index(model.__shard__.key) if model.__shard__ else None
+    row_sql = '(%s)' % ','.join(['?'] * len(columns))
+    insert = 'insert into `%s` (%s) values ' % (model.__table__, ','.join(['`%s`' % c for c in columns]))
+    pending = {}
+    n = [0]
+
+    def _flush(engine):
+        rows = pending.pop(engine)
+        args = []
+        for r in rows:
+            args.extend(r)
+        with db.use_engine(engine):
+            db.update(insert + ','.join([row_sql] * len(rows)), *args)
+        n[0] += len(rows)
+
+    for chunk in manifest['chunks']:
+        for row in _read_chunk(path, chunk):
+            engine = model.__shard__.engine_for(row[key]) if key is not None else None
+            rows = pending.setdefault(engine, [])
+            rows.append(row)
+            if len(rows) >= batch_size:
+                _flush(engine)
+        logging.info('[RESTORE] %s: %s loaded.' % (fmanifest, chunk['file']))
+    for engine in pending.keys():
+        _flush(engine)
+    return n[0]
+
+
+def _defer_indexes(model, create):
+    """
+    导入之前调用： 删除二级索引(create时重建不带索引的表)， 返回导入之后需要重建的索引
+    """
+    table = model.__table__
+    if create:
+        db.update('drop table if exists `%s`' % table)
+        db.update(create_table_sql(model, indexes=False))
+        return model.__indexes__
+    if db.select('select 1 from `%s` limit 1' % table):
+        raise db.DBError('Table %s is not empty, use --create to recreate it.' % table)
+    indexes = [(name, columns, unique) for columns, (name, unique) in live_indexes(table).iteritems()]
+    if indexes:
+        db.update('alter table `%s` %s' % (table, ', '.join(['drop index `%s`' % i[0] for i in indexes])))
+    return indexes
+
+
+def restore(path, tables=None, workers=4, batch_size=500, create=False):
+    """
+    从 path 目录恢复 tables 中的表(默认全部备份了的表)， 返回导入的总行数
+    """
+    manifests = {}
+    for fname in sorted(os.listdir(path)):
+        if not fname.endswith('.manifest.json'):
+            continue
+        manifest = _load_manifest(os.path.join(path, fname))
+        if tables and manifest['table'] not in tables:
+            continue
+        if not manifest['done']:
+            raise db.DBError('Backup %s is not complete.' % fname)
+        manifests.setdefault(manifest['table'], []).append(fname)
+    start = time.time()
+    deferred = []
+    for table in sorted(manifests):
+        model = _MODELS[table]
+        for engine in _engines(model):
+            with db.use_engine(engine):
+                deferred.append((model, engine, _defer_indexes(model, create)))
+    jobs = [(path, f, batch_size) for table in sorted(manifests) for f in manifests[table]]
+    n = sum(_run(_restore_table, jobs, workers))
+    for model, engine, indexes in deferred:
+        if indexes:
+            logging.info('[RESTORE] rebuilding %d indexes of %s...' % (len(indexes), _prefix(model.__table__, engine)))
+            with db.use_engine(engine):
+                db.update('alter table `%s` %s' % (model.__table__, ', '.join(['add %s' % index_ddl(*i) for i in indexes])))
+    logging.info('[RESTORE] %d rows restored from %s in %.1fs.' % (n, path, time.time() - start))
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Logical backup and restore of the awesome database.')
+    parser.add_argument('command', choices=['dump', 'restore'])
+    parser.add_argument('tables', nargs='*', help='tables to backup or restore, default all')
+    parser.add_argument('-d', '--dir', help='backup directory, default backup/<timestamp> for dump')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('-c', '--chunk-size', type=int, default=5000, help='rows per backup file')
+    parser.add_argument('-b', '--batch-size', type=int, default=500, help='rows per insert statement on restore')
+    parser.add_argument('--create', action='store_true', help='drop and recreate tables before restore')
+    args = parser.parse_args(argv)
+    for t in args.tables:
+        if t not in _MODELS:
+            parser.error('unknown table: %s' % t)
+    _init_db()
+    if args.command == 'dump':
+        dump(args.dir, args.tables, args.workers, args.chunk_size)
+    else:
+        if not args.dir:
+            parser.error('restore needs --dir')
+        restore(args.dir, args.tables, args.workers, args.batch_size, args.create)
+
+
+if __name__ == '__main__':
+    main()
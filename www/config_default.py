@@ -14,6 +14,23 @@ configs = {
         'password': 'www-data',
         'database': 'awesome'
     },
+    # 分片组: 每组是连接参数组成的列表，为空时使用上面的db（不分片）
+    'shards': {
+        'blogs': [],
+        'comments': []
+    },
+    # 全文索引的目录， 相对于www目录
+    'search': {
+        'path': 'data/search'
+    },
+    # 模板： production 为True时启动时预编译全部模板并且不再检查模板文件是否修改，
+    # 编译结果缓存在 cache 目录(相对于www目录)； stream 为True时边渲染边发送页面，
+    # 第一块之后的模板错误只能截断页面， 所以默认关闭
+    'templates': {
+        'production': False,
+        'cache': 'data/templates',
+        'stream': False
+    },
     'session': {
         'secret': 'AwEsOmE'
     }
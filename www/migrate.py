@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+部署新版本的models之前 把数据库的表结构迁移到models的定义：
+
+    python migrate.py            只打印需要执行的 alter table 语句
+    python migrate.py --apply    执行这些语句， 然后补齐数据
+
+--apply 依次执行：
+    1. check_columns 报告的缺少的字段(比如 users.blog_count, blogs.comment_count, blogs.version)，
+       以及还不是blob的 CompressedTextField 列(blogs.content: text ==> mediumblob)；
+    2. check_indexes 报告的缺少的索引；
+    3. 新加的计数器字段 用 recount_counters 重新统计；
+    4. 改成blob的压缩字段 用 compress_column 把已有的行改写为压缩格式。
+每一步都可以重复执行， 已经迁移过的部分会被跳过。
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+import argparse
+
+from transwarp import db
+from transwarp.orm import check_columns, check_indexes, recount_counters, compress_column
+
+from config import configs
+import models
+
+_MODELS = (models.User, models.Blog, models.Comment)
+
+
+def _init_db():
+    db.create_engine(**configs.db)
+    for group, shards in configs.shards.iteritems():
+        if shards:
+            db.add_shards(group, shards)
+
+
+def _engines(model):
+    return model.__shard__.engines if model.__shard__ else [None]
+
+
+def plan():
+    """
+    返回需要执行的语句 [(engine, ddl), ...] 和需要迁移的字段 [(table, column), ...]
+    """
+    statements, columns = [], set()
+    for table, engine, column, ddl in check_columns(*_MODELS):
+        statements.append((engine, ddl))
+        columns.add((table, column))
+    for model in _MODELS:
+        for engine in _engines(model):
+            with db.use_engine(engine):
+                statements.extend((engine, m[4]) for m in check_indexes(model))
+    return statements, columns
+
+
+def migrate(apply=False):
+    statements, columns = plan()
+    for engine, ddl in statements:
+        print '%s%s;' % ('-- on %s:\n' % engine if engine else '', ddl)
+    if not apply:
+        return
+    for engine, ddl in statements:
+        with db.use_engine(engine):
+            db.update(ddl)
+    for model in _MODELS:
+        if any((target.__table__, counter) in columns for fk, target, counter in model.__counters__):
+            logging.info('[MIGRATE] %d counters repaired by %s.' % (recount_counters(model), model.__name__))
+        for name, f in model.__mappings__.iteritems():
+            if f.to_db and (model.__table__, f.name) in columns:
+                logging.info('[MIGRATE] %d rows of %s.%s compressed.' % (compress_column(model, name), model.__table__, f.name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate the awesome database to the current models.')
+    parser.add_argument('--apply', action='store_true', help='execute the statements instead of printing them')
+    args = parser.parse_args(argv)
+    _init_db()
+    migrate(args.apply)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,42 +8,72 @@ Models for user, blog, comment.
 import time, uuid
 
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.search import SearchIndex
+from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField, VersionField, CompressedTextField
 
 #user based class
 class User(Model):
     __table__ = 'users'
+    # 缓存只在本进程内失效， 其他worker修改的密码、权限最多延迟ttl秒可见； 校验cookie时不读缓存
+    __cache__ = dict(ttl=30, max_entries=10000)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=False, ddl='varchar(50)')
+    email = StringField(updatable=False, unique=True, ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(updatable=False, default=time.time)
+    blog_count = IntegerField(updatable=False)
+    created_at = FloatField(updatable=False, default=time.time, index=True)
+
+# full-text index of blogs, opened in wsgiapp:
+blog_index = SearchIndex(fields=dict(name=3, summary=2, content=1))
 
 #class for blogs
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(ttl=60, max_entries=2000)
+    __indexes__ = [('user_id', 'created_at')]
+    __counters__ = [('user_id', User, 'blog_count')]
+    __denormalize__ = [('user_id', User, dict(user_name='name', user_image='image'))]
+    # 按主键分片： Blog.get(详情页、搜索结果、评论计数器) 直接路由到一个分片， 按用户查询时才需要查所有分片
+    __shard__ = dict(key='id', group='blogs')
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
-    user_name = StringField(ddl='varchar(50)')
-    user_image = StringField(ddl='varchar(500)')
+    user_name = StringField(updatable=False, ddl='varchar(50)')
+    user_image = StringField(updatable=False, ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
+    content = CompressedTextField()
+    comment_count = IntegerField(updatable=False)
+    version = VersionField()
+    created_at = FloatField(updatable=False, default=time.time, index=True)
+
+    def post_insert(self):
+        blog_index.add(self.id, self)
+
+    def post_update(self):
+        blog_index.add(self.id, self)
+
+    def post_delete(self):
+        blog_index.remove(self.id)
+
 #class for comments
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at'), ('user_id', 'created_at')]
+    __counters__ = [('blog_id', Blog, 'comment_count')]
+    __denormalize__ = [('user_id', User, dict(user_name='name', user_image='image'))]
+    __shard__ = dict(key='blog_id', group='comments')
+    __group_commit__ = True
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(updatable=False, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
-    user_name = StringField(ddl='varchar(50)')
-    user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    user_name = StringField(updatable=False, ddl='varchar(50)')
+    user_image = StringField(updatable=False, ddl='varchar(500)')
+    content = CompressedTextField()
     created_at = FloatField(updatable=False, default=time.time)
 
 
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the concurrency code in transwarp.db and transwarp.orm, no MySQL needed:
+
+    python test_concurrency.py
+
+事务回调、group commit、single-flight、gather 和冗余字段propagator 都在测试用的engine上执行：
+_StubConnection 把SQL交给测试设置的handler， group commit 需要真正的事务和savepoint， 使用sqlite。
+'''
+
+import os, time, shutil, sqlite3, tempfile, threading, unittest
+
+from transwarp import db
+from transwarp.orm import Model, StringField, IntegerField, _Propagator
+
+
+class _StubCursor(object):
+
+    def __init__(self, handler):
+        self._handler = handler
+        self.description = None
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, sql, args=()):
+        result = self._handler(sql, args)
+        if result is not None:
+            names, self._rows = result
+            self.description = [(n, ) for n in names]
+            self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+
+class _StubConnection(object):
+    """
+    不连接数据库的连接： execute 交给 handler(sql, args)， 返回 (列名列表, 行列表) 或 None
+    """
+    def __init__(self, handler):
+        self._handler = handler
+
+    def cursor(self):
+        return _StubCursor(self._handler)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _SqliteCursor(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.db.cursor()
+
+    def execute(self, sql, args=()):
+        if not self._conn.in_transaction:
+            self._cursor.execute('begin')
+            self._conn.in_transaction = True
+        self._cursor.execute(sql.replace('%s', '?'), args)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class _SqliteConnection(object):
+    """
+    sqlite 连接， 和 mysql.connector 一样 autocommit=False： 第一条语句开始事务， 直到commit/rollback
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.in_transaction = False
+
+    def cursor(self):
+        return _SqliteCursor(self)
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.db.execute('commit')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.db.execute('rollback')
+
+    def close(self):
+        self.db.close()
+
+
+def _no_sql(sql, args):
+    raise AssertionError('Unexpected SQL: %s' % sql)
+
+
+class _EngineTestCase(unittest.TestCase):
+    """
+    全局engine 和 engine 'other' 都是 _StubConnection， 执行的SQL交给 self.handler
+    """
+    def setUp(self):
+        self.handler = _no_sql
+        connect = lambda: _StubConnection(lambda sql, args: self.handler(sql, args))
+        db.engine = db._Engine(connect)
+        db.engines['other'] = db._Engine(connect)
+
+    def tearDown(self):
+        db.engine = None
+        db.engines.pop('other', None)
+
+
+class TransactionHookTest(_EngineTestCase):
+
+    def test_commit_hooks_run_after_outermost_commit_in_order(self):
+        L = []
+        with db.transaction():
+            db.on_commit(lambda: L.append(1))
+            with db.transaction():
+                db.on_commit(lambda: L.append(2))
+            self.assertEqual(L, [])
+            db.on_commit(lambda: L.append(3))
+            self.assertEqual(L, [])
+        self.assertEqual(L, [1, 2, 3])
+
+    def test_rollback_discards_commit_hooks(self):
+        L = []
+        try:
+            with db.transaction():
+                db.on_commit(lambda: L.append('commit'))
+                db.on_rollback(lambda: L.append('rollback 1'))
+                with db.transaction():
+                    db.on_rollback(lambda: L.append('rollback 2'))
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+        self.assertEqual(L, ['rollback 1', 'rollback 2'])
+
+    def test_autocommit_hooks(self):
+        L = []
+        db.on_commit(lambda: L.append('commit'))
+        db.on_rollback(lambda: L.append('rollback'))
+        self.assertEqual(L, ['commit'])
+
+    def test_hooks_of_other_engine_wait_for_outer_transaction(self):
+        L = []
+        try:
+            with db.transaction():
+                with db.use_engine('other'):
+                    with db.transaction():
+                        db.on_commit(lambda: L.append('other committed'))
+                    db.on_rollback(lambda: L.append('other rollback'))
+                self.assertEqual(L, [])
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+        # 'other' 上的事务已经单独提交， 外层回滚时仍然调用它的提交回调:
+        self.assertEqual(L, ['other committed', 'other rollback'])
+
+    def test_failing_hook_does_not_stop_others(self):
+        L = []
+
+        def _fail():
+            raise ValueError('hook failed')
+        with db.transaction():
+            db.on_commit(_fail)
+            db.on_commit(lambda: L.append('after'))
+        self.assertEqual(L, ['after'])
+
+    def test_background_hook(self):
+        done = threading.Event()
+        names = []
+
+        def _hook():
+            names.append(threading.current_thread().name)
+            done.set()
+        with db.transaction():
+            db.on_commit(_hook, background=True)
+        self.assertTrue(done.wait(5))
+        self.assertNotEqual(names[0], threading.current_thread().name)
+
+
+class GroupCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        fpath = os.path.join(self.path, 'test.sqlite')
+        db.engine = db._Engine(lambda: _SqliteConnection(fpath))
+        db.update('create table t (id int primary key)')
+        db.update('insert into t (id) values (?)', 1)
+        # 等待足够长的时间， 让并发的写操作进入同一批:
+        db._group_committers[None] = db._GroupCommitter(None, max_wait=0.2)
+
+    def tearDown(self):
+        db._group_committers.pop(None, None)
+        db.engine = None
+        shutil.rmtree(self.path)
+
+    def test_failed_write_only_rolls_back_itself(self):
+        results = {}
+        hooks = []
+
+        def _write(id):
+            db.on_commit(lambda: hooks.append(('commit', id)))
+            db.on_rollback(lambda: hooks.append(('rollback', id)))
+            db.insert('t', id=id)
+            return id
+
+        def _run(id):
+            try:
+                results[id] = db.group_commit(_write, id)
+            except sqlite3.IntegrityError, e:
+                results[id] = e
+        ts = [threading.Thread(target=_run, args=(id, )) for id in range(5)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertTrue(isinstance(results.pop(1), sqlite3.IntegrityError))
+        self.assertEqual(results, dict(zip([0, 2, 3, 4], [0, 2, 3, 4])))
+        self.assertEqual(sorted(r.id for r in db.select('select id from t')), range(5))
+        self.assertEqual(sorted(hooks), [('commit', 0), ('commit', 2), ('commit', 3), ('commit', 4), ('rollback', 1)])
+        stats = db.group_commit_stats()['default']
+        self.assertEqual((stats['writes'], stats['errors']), (5, 1))
+        self.assertTrue(stats['max_batch_size'] > 1)
+
+
+_SQL = 'select * from t where id=?'
+
+
+class _FlightTestCase(_EngineTestCase):
+    """
+    查询阻塞到 self.release 被设置， 用于构造并发的相同查询
+    """
+    def setUp(self):
+        super(_FlightTestCase, self).setUp()
+        db.set_single_flight(True, _SQL)
+        db._flight_stats.clear()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.executed = []
+        self.error = None
+
+        def _handler(sql, args):
+            self.executed.append(args)
+            self.started.set()
+            self.release.wait(5)
+            if self.error is not None:
+                raise self.error
+            return ['id', 'name'], [(args[0], u'name')]
+        self.handler = _handler
+
+    def tearDown(self):
+        db.set_single_flight(None, _SQL)
+        db._flight_stats.clear()
+        super(_FlightTestCase, self).tearDown()
+
+    def _concurrent(self, fn, n, sql=_SQL, before_join=None):
+        """
+        第一个线程开始执行查询之后 调用before_join， 再启动其他线程， 等它们都加入之后 让查询返回
+        """
+        results = [None] * n
+
+        def _run(i):
+            try:
+                results[i] = (fn(), db.joined_flight())
+            except Exception, e:
+                results[i] = (e, db.joined_flight())
+        ts = [threading.Thread(target=_run, args=(i, )) for i in range(n)]
+        ts[0].start()
+        self.assertTrue(self.started.wait(5))
+        if before_join is not None:
+            before_join()
+        for t in ts[1:]:
+            t.start()
+        deadline = time.time() + 5
+        while db.single_flight_stats().get(sql, {}).get('coalesced', 0) < n - 1 and time.time() < deadline:
+            time.sleep(0.005)
+        self.release.set()
+        for t in ts:
+            t.join()
+        return results
+
+
+class SingleFlightTest(_FlightTestCase):
+
+    def test_concurrent_queries_execute_once(self):
+        results = self._concurrent(lambda: db.select_one(_SQL, 1), 4)
+        self.assertEqual(len(self.executed), 1)
+        self.assertEqual(db.single_flight_stats()[_SQL], dict(executed=1, coalesced=3))
+        self.assertEqual([joined for r, joined in results], [False, True, True, True])
+        rows = [r for r, joined in results]
+        self.assertTrue(all(r == dict(id=1, name=u'name') for r in rows))
+        # 每个线程得到自己的拷贝:
+        self.assertEqual(len(set(id(r) for r in rows)), 4)
+
+    def test_error_is_shared(self):
+        self.error = ValueError('query failed')
+        results = self._concurrent(lambda: db.select_one(_SQL, 1), 3)
+        self.assertEqual(len(self.executed), 1)
+        self.assertTrue(all(r is self.error for r, joined in results))
+        # 失败的查询不会留在 _flights 中， 之后的查询重新执行:
+        self.error = None
+        self.assertEqual(db.select_one(_SQL, 1).id, 1)
+        self.assertEqual(len(self.executed), 2)
+
+    def test_different_args_are_not_coalesced(self):
+        self.release.set()
+        db.select_one(_SQL, 1)
+        db.select_one(_SQL, 2)
+        self.assertEqual(self.executed, [(1, ), (2, )])
+
+    def test_transaction_is_not_coalesced(self):
+        self.release.set()
+        with db.transaction():
+            db.select_one(_SQL, 1)
+            self.assertFalse(db.joined_flight())
+        self.assertEqual(db.single_flight_stats(), {})
+
+
+class Note(Model):
+    __table__ = 'notes'
+    __cache__ = dict(ttl=60, max_entries=100)
+
+    id = IntegerField(primary_key=True)
+    name = StringField()
+
+
+class CacheSingleFlightTest(_FlightTestCase):
+
+    def setUp(self):
+        super(CacheSingleFlightTest, self).setUp()
+        self.sql = 'select * from %s where %s=?' % (Note.__table__, Note.__primary_key__.name)
+        db.set_single_flight(True, self.sql)
+        Note.__cache__.clear()
+
+    def tearDown(self):
+        db.set_single_flight(None, self.sql)
+        Note.__cache__.clear()
+        super(CacheSingleFlightTest, self).tearDown()
+
+    def test_joined_result_is_not_cached(self):
+        # 查询开始之后 另一个请求提交了修改并使缓存失效， 之后的get加入了这个查询， 读到的是修改之前的数据:
+        results = self._concurrent(lambda: Note.get(1), 2, self.sql, lambda: Note._invalidate(1))
+        self.assertEqual(len(self.executed), 1)
+        self.assertEqual([joined for r, joined in results], [False, True])
+        self.assertTrue(all(r.name == u'name' for r, joined in results))
+        # 执行者的generation已经过期， 加入者的结果可能是旧数据， 都不能写入缓存:
+        self.assertEqual(Note.__cache__.get(1), None)
+
+    def test_leader_result_is_cached(self):
+        self.release.set()
+        Note.get(1)
+        Note.get(1)
+        self.assertEqual(len(self.executed), 1)
+
+
+class GatherTest(_EngineTestCase):
+
+    def test_results_in_call_order(self):
+        def _slow(x, seconds):
+            time.sleep(seconds)
+            return x
+        self.assertEqual(db.gather((_slow, 1, 0.05), (_slow, 2, 0), lambda: 3, (_slow, 4, 0.02)), [1, 2, 3, 4])
+
+    def test_concurrency_limit(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def _call():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+        start = time.time()
+        db.gather(*([_call] * 8), max_concurrency=3)
+        self.assertEqual(active[1], 3)
+        self.assertTrue(time.time() - start < 0.05 * 8)
+
+    def test_first_error_in_call_order_after_all_finished(self):
+        finished = []
+
+        def _fail_late():
+            time.sleep(0.05)
+            raise KeyError('late')
+
+        def _fail_early():
+            raise ValueError('early')
+
+        def _slow():
+            time.sleep(0.1)
+            finished.append('slow')
+        self.assertRaises(KeyError, db.gather, _fail_late, _fail_early, _slow)
+        self.assertEqual(finished, ['slow'])
+
+    def test_nested_gather_in_pool_runs_inline(self):
+        def _inner():
+            names = db.gather(lambda: threading.current_thread().name, lambda: threading.current_thread().name)
+            return getattr(db._gather_worker, 'active', False), names
+        results = db.gather(*([_inner] * 8))
+        in_pool = [names for active, names in results if active]
+        self.assertTrue(in_pool)
+        # 线程池中的gather 在当前线程依次执行， 不会等待同一个线程池 导致死锁:
+        for names in in_pool:
+            self.assertEqual(len(set(names)), 1)
+
+    def test_transaction_runs_inline(self):
+        name = threading.current_thread().name
+        with db.transaction():
+            names = db.gather(lambda: threading.current_thread().name, lambda: threading.current_thread().name)
+        self.assertEqual(names, [name, name])
+
+
+class _Source(object):
+    __name__ = 'Source'
+
+
+class PropagatorTest(unittest.TestCase):
+
+    def test_pending_jobs_are_coalesced(self):
+        release = threading.Event()
+        started = threading.Event()
+        runs = []
+
+        class _Blocking(_Propagator):
+            def run(self, source, key):
+                runs.append(key)
+                started.set()
+                release.wait(5)
+                return 0
+        p = _Blocking()
+        p.submit(_Source, 'a')
+        self.assertTrue(started.wait(5))
+        p.submit(_Source, 'b')
+        time.sleep(0.05)
+        p.submit(_Source, 'b')
+        p.submit(_Source, 'c')
+        p.submit(_Source, 'b')
+        stats = p.stats()
+        self.assertEqual(stats.pending, 2)
+        # 合并的任务保留最早的登记时间:
+        self.assertTrue(stats.lag >= 0.05)
+        release.set()
+        deadline = time.time() + 5
+        while len(runs) < 3 and time.time() < deadline:
+            time.sleep(0.005)
+        time.sleep(0.05)
+        self.assertEqual(runs, ['a', 'b', 'c'])
+        self.assertEqual(p.stats().pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -38,18 +38,45 @@
       3. 支持事物
          transaction 函数封装了如下功能:
              1. 事务也可以嵌套，内层事务会自动合并到外层事务中，这种事务模型足够满足99%的需求
+             2. on_commit/on_rollback 注册最外层事务提交/回滚之后执行的回调
+             3. group_commit 把多个线程并发的小事务 合并成一个事务提交
+      4. 支持多个数据库（分片）
+         add_shards 注册一组命名的engine， use_engine 把当前线程切换到指定的engine，
+         scatter 在多个engine上并行执行同一个函数:
+             db.add_shards('comments', [dict(user='www-data', password='www-data', database='awesome', host='10.0.0.1'),
+                                        dict(user='www-data', password='www-data', database='awesome', host='10.0.0.2')])
+             with db.use_engine('comments1'):
+                 db.select('...')
+             db.scatter(db.shard_engines('comments'), db.select, 'select ...')
+         gather 在线程池中并行执行一个请求里 互相独立的多个查询:
+             blog, user = db.gather((Blog.get, blog_id), (User.get, user_id))
+      5. 合并并发的相同查询
+         set_single_flight 开启后， 多个线程同时执行的相同查询(事务之外) 只执行一次:
+             db.set_single_flight(True)
+             db.single_flight_stats()
+         joined_flight 返回本线程上一次查询的结果 是否来自加入的其他线程的查询
 """
 
+import sys
 import time
 import uuid
+import Queue
 import functools
 import threading
 import logging
 
+from multiprocessing.pool import ThreadPool
+
 
 # global engine object:
 engine = None
 
+# named engine objects: {name: _Engine}
+engines = {}
+
+# shard groups: {group: [engine name, ...]}
+_shard_groups = {}
+
 
 def next_id(t=None):
     """
@@ -71,26 +98,217 @@ def _profiling(start, sql=''):
         logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
 
 
-def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+def _mysql_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
     """
-    db模型的核心函数，用于连接数据库, 生成全局对象engine，
-    engine对象持有数据库连接
+    根据连接参数 生成一个_Engine对象
     """
     import mysql.connector
-    global engine
-    if engine is not None:
-        raise DBError('Engine is already initialized.')
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
     for k, v in defaults.iteritems():
         params[k] = kw.pop(k, v)
+    idle_connections = kw.pop('idle_connections', None)
     params.update(kw)
     params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    return _Engine(lambda: mysql.connector.connect(**params), idle_connections)
+
+
+def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+    """
+    db模型的核心函数，用于连接数据库, 生成全局对象engine，
+    engine对象持有数据库连接
+    idle_connections: engine最多保留的空闲连接数， 默认为 IDLE_CONNECTIONS， 0 表示用完就关闭
+    """
+    global engine
+    if engine is not None:
+        raise DBError('Engine is already initialized.')
+    engine = _mysql_engine(user, password, database, host, port, **kw)
     # test connection...
     logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
 
 
+def add_engine(name, user, password, database, host='127.0.0.1', port=3306, **kw):
+    """
+    注册一个命名的engine， 通过 use_engine(name) 使用
+    """
+    if name in engines:
+        raise DBError('Engine %s is already initialized.' % name)
+    engines[name] = _mysql_engine(user, password, database, host, port, **kw)
+    logging.info('Init mysql engine %s <%s> ok.' % (name, hex(id(engines[name]))))
+
+
+def add_shards(group, shards):
+    """
+    注册一组分片engine，名称为 group + 序号， 比如 comments0, comments1 ...
+    shards: 连接参数(dict)组成的列表， 分片的顺序决定了数据的路由，上线后不能调整
+    """
+    if group in _shard_groups:
+        raise DBError('Shard group %s is already initialized.' % group)
+    names = []
+    for n, params in enumerate(shards):
+        name = '%s%d' % (group, n)
+        add_engine(name, **params)
+        names.append(name)
+    _shard_groups[group] = names
+
+
+def shard_engines(group):
+    """
+    返回分片组中的engine名称列表，分片组不存在时返回空列表
+    """
+    return _shard_groups.get(group, [])
+
+
+def _get_engine(name):
+    """
+    name为None时返回全局engine， 否则返回命名的engine
+    """
+    e = engine if name is None else engines.get(name)
+    if e is None:
+        raise DBError('Engine %s is not initialized.' % (name or 'default'))
+    return e
+
+
+def use_engine(name):
+    """
+    把当前线程的数据库上下文切换到 指定的engine， name为None时使用全局engine:
+        with db.use_engine('comments1'):
+            db.select('...')
+    切换时会暂存当前engine的连接和事务状态，离开with语句时恢复，
+    所以在其他engine上执行的语句 不会加入当前engine上的事务；
+    但在其他engine上注册的 on_commit/on_rollback 回调 仍然等当前线程最外层的事务结束后才调用
+
+    >>> engines['hook_test'] = _Engine(None)
+    >>> L = []
+    >>> with transaction():
+    ...     with use_engine('hook_test'):
+    ...         with transaction():
+    ...             on_commit(lambda: L.append('hook'))
+    ...         L.append('inner committed')
+    ...     L.append('outer')
+    >>> L
+    ['inner committed', 'outer', 'hook']
+    >>> del engines['hook_test']
+    """
+    return _EngineCtx(name)
+
+
+# scatter 使用的线程池大小
+SCATTER_POOL_SIZE = 8
+
+_scatter_pool = None
+_scatter_lock = threading.Lock()
+_scatter_worker = threading.local()
+
+
+def _mark_scatter_worker():
+    _scatter_worker.active = True
+
+
+def _get_scatter_pool():
+    global _scatter_pool
+    if _scatter_pool is None:
+        with _scatter_lock:
+            if _scatter_pool is None:
+                _scatter_pool = ThreadPool(SCATTER_POOL_SIZE, _mark_scatter_worker)
+    return _scatter_pool
+
+
+def scatter(names, fn, *args, **kw):
+    """
+    在每个engine上执行 fn(*args, **kw)， 按names的顺序返回结果列表
+    多个engine时通过线程池并行执行， 任意一个抛出异常 则把该异常抛给调用者
+    注意：并行执行的语句使用各自线程的连接，不会加入调用者的事务
+
+    >>> scatter([None], select_int, 'select count(*) from user where id=?', 900900900)
+    [0]
+    """
+    def _run(name):
+        with use_engine(name):
+            return fn(*args, **kw)
+    if len(names) <= 1 or getattr(_scatter_worker, 'active', False):
+        # 避免在线程池内再次提交任务 导致死锁:
+        return [_run(name) for name in names]
+    return _get_scatter_pool().map(_run, names)
+
+
+# 每个engine最多保留的空闲连接数， 空闲超过 IDLE_CONNECTION_TIMEOUT 秒的连接关闭 不再复用
+IDLE_CONNECTIONS = 8
+IDLE_CONNECTION_TIMEOUT = 60
+
+# gather 每次调用最多同时执行的查询数， gather 使用的线程池大小
+GATHER_MAX_CONCURRENCY = 4
+GATHER_POOL_SIZE = 16
+
+_gather_pool = None
+_gather_worker = threading.local()
+
+
+def _mark_gather_worker():
+    _gather_worker.active = True
+
+
+def _get_gather_pool():
+    """
+    gather 使用单独的线程池， 页面请求不会排在分片的scatter后面， 反过来也一样
+    """
+    global _gather_pool
+    if _gather_pool is None:
+        with _scatter_lock:
+            if _gather_pool is None:
+                _gather_pool = ThreadPool(GATHER_POOL_SIZE, _mark_gather_worker)
+    return _gather_pool
+
+
+def gather(*calls, **kw):
+    """
+    并行执行多个互相独立的只读查询， 按calls的顺序返回结果列表，
+    页面的延迟从所有查询的时间之和 变成最慢的那个查询的时间:
+        blog, comments = db.gather(
+            (Blog.get, blog_id),
+            lambda: Comment.find_by('where blog_id=? order by created_at desc', blog_id, shard_key=blog_id))
+    calls: 每一项是一个函数， 或者 (函数, 参数1, 参数2, ...)
+    max_concurrency: 本次调用最多同时执行的查询数， 默认为 GATHER_MAX_CONCURRENCY，
+        calls 按顺序轮流分给 max_concurrency 个任务， 每个任务在一个连接上依次执行分到的查询，
+        第一个任务在调用者的线程中执行， 其余的交给 gather 自己的线程池(GATHER_POOL_SIZE)
+    查询在调用者当前的engine上执行， 但线程池中的任务使用线程自己的连接(从engine的空闲连接中取， 用完放回)，
+    所以调用者在事务中时(需要读到本事务的修改)， 以及在线程池内调用时， 在当前线程依次执行
+    某个查询抛出异常时 仍然等其他查询执行完， 然后抛出按calls顺序的第一个异常
+
+    >>> gather((select_int, 'select count(*) from user where id=?', 900900900), lambda: 1)
+    [0, 1]
+    """
+    max_concurrency = kw.pop('max_concurrency', GATHER_MAX_CONCURRENCY)
+    if kw:
+        raise TypeError('Unexpected keyword argument(s): %s' % ', '.join(kw.keys()))
+    calls = [c if isinstance(c, tuple) else (c, ) for c in calls]
+    n = min(max_concurrency, len(calls))
+    if n <= 1 or in_transaction() or getattr(_scatter_worker, 'active', False) or getattr(_gather_worker, 'active', False):
+        return [c[0](*c[1:]) for c in calls]
+    engine_name = _db_ctx.engine_name
+
+    def _run(lane):
+        results = []
+        with use_engine(engine_name):
+            with connection():
+                for c in lane:
+                    try:
+                        results.append((None, c[0](*c[1:])))
+                    except Exception:
+                        results.append((sys.exc_info(), None))
+        return results
+    lanes = [calls[i::n] for i in range(n)]
+    pending = _get_gather_pool().map_async(_run, lanes[1:])
+    first = _run(lanes[0])
+    results = [None] * len(calls)
+    for i, lane in enumerate([first] + pending.get()):
+        results[i::n] = lane
+    for error, value in results:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return [value for error, value in results]
+
+
 def connection():
     """
     db模块核心函数，用于获取一个数据库连接
@@ -144,6 +362,269 @@ def transaction():
     return _TransactionCtx()
 
 
+def in_transaction():
+    """
+    当前线程是否处于事务中
+    """
+    return _db_ctx.is_init() and _db_ctx.transactions > 0
+
+
+# 后台执行事务回调的线程池大小
+HOOK_POOL_SIZE = 2
+
+_hook_pool = None
+_hook_lock = threading.Lock()
+
+
+def _get_hook_pool():
+    global _hook_pool
+    if _hook_pool is None:
+        with _hook_lock:
+            if _hook_pool is None:
+                _hook_pool = ThreadPool(HOOK_POOL_SIZE)
+    return _hook_pool
+
+
+def _call_hook(fn):
+    try:
+        fn()
+    except Exception:
+        logging.exception('transaction hook %s failed.' % getattr(fn, '__name__', fn))
+
+
+def _run_hooks(hooks):
+    for fn, background in hooks:
+        if background:
+            _get_hook_pool().apply_async(_call_hook, (fn, ))
+        else:
+            _call_hook(fn)
+
+
+def _finish_hooks(hooks):
+    """
+    当前engine上的事务结束后调用回调；
+    如果是从其他engine的事务中 通过use_engine切换过来的， 交给最外层的事务在结束时调用，
+    这里的修改已经单独提交， 不会随外层事务回滚， 所以外层提交或回滚时都会调用
+    """
+    outer = _db_ctx.outer
+    if outer is None:
+        _run_hooks(hooks)
+    else:
+        outer[0].extend(hooks)
+        outer[1].extend(hooks)
+
+
+def on_commit(fn, background=False):
+    """
+    在当前线程最外层事务提交成功后 调用fn()， 事务回滚时丢弃；
+    不在事务中时（autocommit） 立即调用。 适合缓存失效、更新索引、发送通知等副作用:
+        with db.transaction():
+            db.update('...')
+            db.on_commit(lambda: cache.invalidate(key))
+    background: 为True时提交给后台线程池执行， 不阻塞提交事务的请求，
+                fn在另一个线程中执行， 需要访问数据库时使用该线程自己的连接
+    回调抛出的异常只记录日志， 不影响已经提交的事务和其他回调
+
+    >>> L = []
+    >>> with transaction():
+    ...     on_commit(lambda: L.append('commit'))
+    ...     on_rollback(lambda: L.append('rollback'))
+    ...     L.append('in transaction')
+    >>> L
+    ['in transaction', 'commit']
+    >>> on_commit(lambda: L.append('autocommit'))
+    >>> L
+    ['in transaction', 'commit', 'autocommit']
+    """
+    if in_transaction():
+        _db_ctx.commit_hooks.append((fn, background))
+    else:
+        _finish_hooks([(fn, background)])
+
+
+def on_rollback(fn, background=False):
+    """
+    在当前线程最外层事务回滚后(包括提交失败) 调用fn()， 事务提交成功时丢弃；
+    不在事务中时 没有可以回滚的事务， fn不会被调用
+    background: 同 on_commit
+
+    >>> L = []
+    >>> with transaction():
+    ...     on_commit(lambda: L.append('commit'))
+    ...     on_rollback(lambda: L.append('rollback'))
+    ...     raise StandardError('will cause rollback...')
+    Traceback (most recent call last):
+      ...
+    StandardError: will cause rollback...
+    >>> L
+    ['rollback']
+    """
+    if in_transaction():
+        _db_ctx.rollback_hooks.append((fn, background))
+    elif _db_ctx.outer is not None:
+        _db_ctx.outer[1].append((fn, background))
+
+
+# group commit 的默认参数： 每批最多合并的写操作数， 收集一批写操作最多等待的秒数
+GROUP_COMMIT_MAX_BATCH = 64
+GROUP_COMMIT_MAX_WAIT = 0.005
+
+_group_committers = {}
+_group_lock = threading.Lock()
+
+
+class _GroupWrite(object):
+    """
+    提交给group commit写线程的一个写操作， 调用者在done上等待结果
+    """
+    __slots__ = ('fn', 'args', 'kw', 'result', 'error', 'done', 'submitted')
+
+    def __init__(self, fn, args, kw):
+        self.fn = fn
+        self.args = args
+        self.kw = kw
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.submitted = time.time()
+
+
+class _GroupCommitter(object):
+    """
+    一个engine上的group commit写线程：
+    收集 max_wait 秒内(最多 max_batch 个)并发提交的写操作， 在同一个连接的同一个事务中依次执行，
+    每个写操作前设置savepoint， 失败时只回滚它自己， 最后一次提交， 把多次fsync合并成一次
+    """
+    def __init__(self, engine_name, max_batch=GROUP_COMMIT_MAX_BATCH, max_wait=GROUP_COMMIT_MAX_WAIT):
+        self.engine_name = engine_name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+        self.max_batch_size = 0
+        self.wait_time = 0.0
+        self.commit_time = 0.0
+        t = threading.Thread(target=self._loop, name='group-commit-%s' % (engine_name or 'default'))
+        t.daemon = True
+        t.start()
+
+    def submit(self, fn, args, kw):
+        w = _GroupWrite(fn, args, kw)
+        self.queue.put(w)
+        w.done.wait()
+        if w.error is not None:
+            raise w.error[0], w.error[1], w.error[2]
+        return w.result
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    batch.append(self.queue.get(True, timeout) if timeout > 0 else self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _execute(self, w):
+        global _db_ctx
+        hooks = len(_db_ctx.commit_hooks), len(_db_ctx.rollback_hooks)
+        _update('savepoint group_commit')
+        try:
+            w.result = w.fn(*w.args, **w.kw)
+        except Exception:
+            w.error = sys.exc_info()
+            _update('rollback to savepoint group_commit')
+            # 丢弃失败的写操作注册的事务回调，并执行它的回滚回调：
+            rollback_hooks = _db_ctx.rollback_hooks[hooks[1]:]
+            del _db_ctx.commit_hooks[hooks[0]:]
+            del _db_ctx.rollback_hooks[hooks[1]:]
+            _run_hooks(rollback_hooks)
+
+    def _commit(self, batch):
+        start = time.time()
+        try:
+            with use_engine(self.engine_name):
+                with transaction():
+                    for w in batch:
+                        self._execute(w)
+        except Exception:
+            logging.exception('group commit of %d writes failed.' % len(batch))
+            error = sys.exc_info()
+            for w in batch:
+                if w.error is None:
+                    w.error = error
+        end = time.time()
+        with self.lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.errors += len([w for w in batch if w.error is not None])
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.wait_time += sum(start - w.submitted for w in batch)
+            self.commit_time += end - start
+        for w in batch:
+            w.done.set()
+
+    def stats(self):
+        """
+        返回统计信息： 批次数、写操作数、失败数、平均/最大批大小、
+        写操作提交之后 平均等待多久才开始执行、每批平均执行和提交的时间(秒)
+        """
+        with self.lock:
+            batches = self.batches or 1
+            writes = self.writes or 1
+            return dict(batches=self.batches, writes=self.writes, errors=self.errors,
+                        avg_batch_size=float(self.writes) / batches, max_batch_size=self.max_batch_size,
+                        avg_wait=self.wait_time / writes, avg_commit_time=self.commit_time / batches,
+                        queued=self.queue.qsize())
+
+
+def _get_group_committer(name):
+    c = _group_committers.get(name)
+    if c is None:
+        with _group_lock:
+            c = _group_committers.get(name)
+            if c is None:
+                _get_engine(name)
+                c = _group_committers[name] = _GroupCommitter(name)
+    return c
+
+
+def group_commit(fn, *args, **kw):
+    """
+    通过当前engine的group commit写线程执行 fn(*args, **kw)， 返回fn的返回值或抛出fn的异常，
+    适合大量并发的小事务(比如发表评论)， 多个线程的写操作合并成一个事务提交：
+        db.group_commit(db.insert, 'comments', **kw)
+    fn 在写线程中执行， 只能通过db模块访问数据库， 不能依赖调用者线程的状态；
+    fn 中注册的 on_commit 回调在整批提交之后 在写线程中执行
+    已经在事务中时 直接执行fn， 加入当前事务
+
+    >>> group_commit(insert, 'user', id=3000, name='Gary', email='gary@test.org', passwd='gary', last_modified=time.time())
+    1
+    >>> group_commit(insert, 'user', id=3000, name='Gary', email='gary@test.org', passwd='gary', last_modified=time.time())
+    Traceback (most recent call last):
+      ...
+    IntegrityError: 1062 (23000): Duplicate entry '3000' for key 'PRIMARY'
+    >>> group_commit_stats()['default']['writes'] >= 2
+    True
+    """
+    if in_transaction():
+        return fn(*args, **kw)
+    return _get_group_committer(_db_ctx.engine_name).submit(fn, args, kw)
+
+
+def group_commit_stats():
+    """
+    返回每个engine上group commit的统计信息 {engine名称: stats}， 全局engine的名称为 'default'
+    """
+    return dict((name or 'default', c.stats()) for name, c in _group_committers.items())
+
+
 def with_transaction(func):
     """
     设计一个装饰器 替换with语法，让代码更优雅
@@ -175,11 +656,132 @@ def with_transaction(func):
     return _wrapper
 
 
+# single-flight 的全局开关， 以及按SQL设置的开关 {sql: bool}
+_flight_default = False
+_flight_overrides = {}
+# 每条SQL的统计 {sql: [执行次数, 被合并的次数]}
+_flight_stats = {}
+# 正在执行的查询 {(engine名称, sql, first, args): _Flight}
+_flights = {}
+_flight_lock = threading.Lock()
+# 本线程上一次查询的结果 是否来自加入的查询
+_flight_joined = threading.local()
+
+
+class _Flight(object):
+    """
+    一个正在执行的查询， 相同的查询在done上等待它的结果
+    """
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def set_single_flight(enabled=True, sql=None):
+    """
+    开启/关闭 single-flight： 多个线程同时执行相同的查询(同一个engine、相同的SQL和参数)时，
+    只有第一个线程真正执行， 其他线程等待并共享它的结果(各自得到一份拷贝)
+    事务中的查询不会被合并， 因为它需要看到本事务中的修改；
+    但提交之后的查询 可能加入提交之前就开始执行的相同查询 读到提交之前的数据，
+    所以全局开关默认关闭， 只对能容忍短暂读到旧数据的热点查询 按语句开启
+    sql: 只设置该语句的开关， 优先于全局开关； enabled为None时 删除该语句的设置
+        db.set_single_flight(True, 'select * from blogs where id=?')
+        db.set_single_flight(None, 'select * from blogs where id=?')
+    """
+    global _flight_default
+    with _flight_lock:
+        if sql is None:
+            _flight_default = enabled
+        elif enabled is None:
+            _flight_overrides.pop(sql, None)
+        else:
+            _flight_overrides[sql] = enabled
+
+
+def single_flight_stats():
+    """
+    返回开启了single-flight的查询的统计信息：
+        {sql: dict(executed=真正执行的次数, coalesced=等待共享结果的次数)}
+    """
+    with _flight_lock:
+        return dict((sql, dict(executed=s[0], coalesced=s[1])) for sql, s in _flight_stats.iteritems())
+
+
+def joined_flight():
+    """
+    返回本线程上一次 select/select_one/select_int 的结果 是否来自加入的其他线程的查询
+    加入的查询可能在调用者看到的最近一次提交之前就开始执行了， 结果可能是提交之前的数据，
+    所以不能当作最新的数据写入缓存:
+        d = db.select_one('select * from blogs where id=?', blog_id)
+        if not db.joined_flight():
+            cache.put(blog_id, d, generation)
+
+    >>> select_int('select count(*) from user where id=?', 900900900)
+    0
+    >>> joined_flight()
+    False
+    """
+    return getattr(_flight_joined, 'value', False)
+
+
+def _copy_result(result):
+    if result is None:
+        return None
+    if isinstance(result, Dict):
+        d = Dict()
+        dict.update(d, result)
+        return d
+    return [_copy_result(r) for r in result]
+
+
 @with_connection
 def _select(sql, first, *args):
     """
     执行SQL，返回一个结果 或者多个结果组成的列表
+    开启了single-flight时 合并并发执行的相同查询
     """
+    global _db_ctx
+    _flight_joined.value = False
+    if _db_ctx.transactions or not _flight_overrides.get(sql, _flight_default):
+        return _execute_select(sql, first, *args)
+    key = (_db_ctx.engine_name, sql, first, args)
+    try:
+        hash(key)
+    except TypeError:
+        return _execute_select(sql, first, *args)
+    with _flight_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+        else:
+            flight.waiters += 1
+        _flight_stats.setdefault(sql, [0, 0])[0 if leader else 1] += 1
+    if not leader:
+        _flight_joined.value = True
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        return _copy_result(flight.result)
+    try:
+        flight.result = _execute_select(sql, first, *args)
+    except Exception:
+        flight.error = sys.exc_info()
+        raise
+    finally:
+        with _flight_lock:
+            del _flights[key]
+            waiters = flight.waiters
+        flight.done.set()
+    # 等待者会拷贝flight.result， 所以有等待者时 执行者也返回拷贝:
+    return _copy_result(flight.result) if waiters else flight.result
+
+
+def _execute_select(sql, first, *args):
     global _db_ctx
     cursor = None
     sql = sql.replace('?', '%s')
@@ -375,45 +977,97 @@ class MultiColumnsError(DBError):
     pass
 
 
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
 class _Engine(object):
     """
     数据库引擎对象
     用于保存 db模块的核心函数：create_engine 创建出来的数据库连接
+    用完的连接通过 release 放回， 最多保留 idle_connections 个空闲连接，
+    下次 connect 时优先复用最近放回的连接， gather 的任务和分片上的查询 不用每次都重新连接数据库
+
+    >>> class _Conn(object):
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> e = _Engine(_Conn, idle_connections=1)
+    >>> c1, c2 = e.connect(), e.connect()
+    >>> e.release(c1); e.release(c2)
+    >>> e.connect() is c1, len(e._idle)
+    (True, 0)
     """
-    def __init__(self, connect):
+    def __init__(self, connect, idle_connections=None):
         self._connect = connect
+        self._max_idle = IDLE_CONNECTIONS if idle_connections is None else idle_connections
+        # 空闲连接 [(放回的时间, 连接)]， 按放回的时间排序
+        self._idle = []
+        self._lock = threading.Lock()
 
     def connect(self):
-        return self._connect()
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle and now - self._idle[0][0] >= IDLE_CONNECTION_TIMEOUT:
+                stale.append(self._idle.pop(0)[1])
+            if self._idle:
+                conn = self._idle.pop()[1]
+        for c in stale:
+            _close_quietly(c)
+        return conn if conn is not None else self._connect()
+
+    def release(self, conn):
+        """
+        放回用完的连接： 先回滚 丢掉可能残留的事务和快照， 回滚出错(连接已断开) 或者空闲连接已满时关闭
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            _close_quietly(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append((time.time(), conn))
+                return
+        _close_quietly(conn)
 
 
 class _LasyConnection(object):
     """
     惰性连接对象
     仅当需要cursor对象时，才连接数据库，获取连接
+    engine_name: 使用的engine名称， None表示全局engine
     """
-    def __init__(self):
+    def __init__(self, engine_name=None):
+        self.engine_name = engine_name
         self.connection = None
 
     def cursor(self):
         if self.connection is None:
-            _connection = engine.connect()
+            _connection = _get_engine(self.engine_name).connect()
             logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(_connection)))
             self.connection = _connection
         return self.connection.cursor()
 
     def commit(self):
-        self.connection.commit()
+        # 事务中没有执行过语句时 还没有真正的连接:
+        if self.connection is not None:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection is not None:
+            self.connection.rollback()
 
     def cleanup(self):
         if self.connection:
             _connection = self.connection
             self.connection = None
-            logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(connection)))
-            _connection.close()
+            logging.info('[CONNECTION] [RELEASE] connection <%s>...' % hex(id(_connection)))
+            _get_engine(self.engine_name).release(_connection)
 
 
 class _DbCtx(threading.local):
@@ -423,8 +1077,13 @@ class _DbCtx(threading.local):
     该对象是一个 Thread local对象，因此绑定在此对象上的数据 仅对本线程可见
     """
     def __init__(self):
+        self.engine_name = None
         self.connection = None
         self.transactions = 0
+        self.commit_hooks = []
+        self.rollback_hooks = []
+        # use_engine 切换前 最外层事务的 (commit_hooks, rollback_hooks)， 不在事务中时为None
+        self.outer = None
 
     def is_init(self):
         """
@@ -437,8 +1096,10 @@ class _DbCtx(threading.local):
         初始化连接的上下文对象，获得一个惰性连接对象
         """
         logging.info('open lazy connection...')
-        self.connection = _LasyConnection()
+        self.connection = _LasyConnection(self.engine_name)
         self.transactions = 0
+        self.commit_hooks = []
+        self.rollback_hooks = []
 
     def cleanup(self):
         """
@@ -453,6 +1114,26 @@ class _DbCtx(threading.local):
         """
         return self.connection.cursor()
 
+    def switch(self, engine_name):
+        """
+        切换到另一个engine， 返回切换前的状态， 用于restore
+        """
+        state = (self.engine_name, self.connection, self.transactions, self.commit_hooks, self.rollback_hooks, self.outer)
+        if self.outer is None and self.transactions > 0:
+            self.outer = (self.commit_hooks, self.rollback_hooks)
+        self.engine_name = engine_name
+        self.connection = None
+        self.transactions = 0
+        self.commit_hooks = []
+        self.rollback_hooks = []
+        return state
+
+    def restore(self, state):
+        """
+        恢复switch之前的状态
+        """
+        self.engine_name, self.connection, self.transactions, self.commit_hooks, self.rollback_hooks, self.outer = state
+
 
 # thread-local db context:
 _db_ctx = _DbCtx()
@@ -488,6 +1169,30 @@ class _ConnectionCtx(object):
             _db_ctx.cleanup()
 
 
+class _EngineCtx(object):
+    """
+    切换当前线程使用的engine， 已经在该engine上时 什么也不做，
+    因此路由到当前engine的语句 仍然会加入当前的事务
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _db_ctx
+        self.state = None
+        if _db_ctx.engine_name != self.name:
+            _get_engine(self.name)
+            self.state = _db_ctx.switch(self.name)
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        global _db_ctx
+        if self.state is not None:
+            if _db_ctx.is_init():
+                _db_ctx.cleanup()
+            _db_ctx.restore(self.state)
+
+
 class _TransactionCtx(object):
     """
     事务嵌套比Connection嵌套复杂一点，因为事务嵌套需要计数，
@@ -526,15 +1231,20 @@ class _TransactionCtx(object):
             logging.info('commit ok.')
         except:
             logging.warning('commit failed. try rollback...')
-            _db_ctx.connection.rollback()
-            logging.warning('rollback ok.')
+            self.rollback()
             raise
+        hooks = _db_ctx.commit_hooks
+        _db_ctx.commit_hooks, _db_ctx.rollback_hooks = [], []
+        _finish_hooks(hooks)
 
     def rollback(self):
         global _db_ctx
         logging.warning('rollback transaction...')
+        hooks = _db_ctx.rollback_hooks
+        _db_ctx.commit_hooks, _db_ctx.rollback_hooks = [], []
         _db_ctx.connection.rollback()
         logging.info('rollback ok.')
+        _finish_hooks(hooks)
 
 
 if __name__ == '__main__':
@@ -31,16 +31,99 @@ orm模块设计的原因：
 """
 
 import db
+import re
+import sys
+import math
+import zlib
 import time
+import struct
+import hashlib
 import logging
+import functools
+import threading
+import unicodedata
 
+from collections import OrderedDict
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+# pre_xxx 在执行SQL之前调用， post_xxx 在事务提交之后调用（不在事务中时 执行SQL之后立即调用）
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
 
-def _gen_sql(table_name, mappings):
+# Model.aggregate 支持的聚合函数，结果中的聚合列也按此顺序排列
+_aggregates = ('count', 'sum', 'avg', 'min', 'max')
+
+
+def _index_name(columns, unique=False):
+    """
+    根据字段名生成索引名，比如：
+        ('blog_id', 'created_at') ==> idx_blog_id_created_at
+        ('email', ) + unique       ==> uk_email
+    """
+    return '%s_%s' % ('uk' if unique else 'idx', '_'.join(columns))
+
+
+def _normalize_index(spec):
+    """
+    将__indexes__ 里的一项 规范化为 (name, columns, unique) 形式的元组
+    支持的写法：
+        'created_at'                                  单列普通索引
+        ('blog_id', 'created_at')                     多列普通索引
+        dict(columns=('user_id', 'name'), unique=True, name='uk_user_blog')
+    """
+    if isinstance(spec, basestring):
+        spec = dict(columns=(spec, ))
+    elif isinstance(spec, (list, tuple)):
+        spec = dict(columns=tuple(spec))
+    elif not isinstance(spec, dict):
+        raise TypeError('Bad index definition: %s' % str(spec))
+    columns = tuple(spec['columns'])
+    if not columns:
+        raise TypeError('Index must contain at least 1 column.')
+    unique = spec.get('unique', False)
+    return spec.get('name') or _index_name(columns, unique), columns, unique
+
+
+def _gen_indexes(mappings, indexes=()):
+    """
+    收集 字段上声明的索引（Field(index=True, unique=True)）和
+    Model上声明的复合索引（__indexes__），返回 (name, columns, unique) 列表
+    """
+    L = []
+    for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
+        if f.primary_key:
+            continue
+        if f.unique:
+            L.append((_index_name((f.name, ), True), (f.name, ), True))
+        elif f.index:
+            L.append((_index_name((f.name, )), (f.name, ), False))
+    for spec in indexes:
+        name, columns, unique = _normalize_index(spec)
+        for col in columns:
+            if not col in mappings:
+                raise TypeError('Index %s references unknown field: %s' % (name, col))
+        L.append((name, tuple(mappings[col].name for col in columns), unique))
+    names = set()
+    for name, columns, unique in L:
+        if name in names:
+            raise TypeError('Duplicate index name: %s' % name)
+        names.add(name)
+    return L
+
+
+def index_ddl(name, columns, unique=False):
+    """
+    生成 create table / alter table add 中的索引定义
+
+    >>> index_ddl('idx_user_id_created_at', ('user_id', 'created_at'))
+    'key `idx_user_id_created_at` (`user_id`,`created_at`)'
+    """
+    return '%s `%s` (%s)' % ('unique key' if unique else 'key', name, ','.join(['`%s`' % c for c in columns]))
+
+
+def _gen_sql(table_name, mappings, indexes=()):
     """
     类 ==> 表时 生成创建表的sql
+    indexes: _gen_indexes 返回的索引列表
     """
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
@@ -53,11 +136,91 @@ def _gen_sql(table_name, mappings):
             pk = f.name
         #sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
         sql.append('  `%s` %s,' % (f.name, ddl) if nullable else '  `%s` %s not null,' % (f.name, ddl))
+    for name, columns, unique in indexes:
+        sql.append('  %s,' % index_ddl(name, columns, unique))
     sql.append('  primary key(`%s`)' % pk)
     sql.append(');')
     return '\n'.join(sql)
 
 
+def create_table_sql(model, indexes=True):
+    """
+    返回创建 model 对应的表的语句(不带注释和结尾的分号)，
+    indexes 为False时 不带二级索引， 比如 导入大量数据之后再建索引
+    """
+    sql = _gen_sql(model.__table__, model.__mappings__, model.__indexes__ if indexes else ())
+    return sql.split('\n', 1)[1].rstrip(';')
+
+
+def _gen_counters(name, mappings, counters=()):
+    """
+    检查 __counters__ 声明的计数器缓存， 每一项为 (外键字段, 目标Model, 目标Model中的计数字段)：
+        class Comment(Model):
+            __counters__ = [('blog_id', Blog, 'comment_count')]
+    表示 Comment.insert()/delete() 时 在同一个事务中把 blogs.comment_count 加1/减1
+    外键 不能被update，否则计数会偏移； 计数字段 只能由orm维护，不能被Blog.update()覆盖
+    """
+    L = []
+    for fk, target, counter in counters:
+        if not fk in mappings:
+            raise TypeError('Counter foreign key not defined in class %s: %s' % (name, fk))
+        if not counter in getattr(target, '__mappings__', {}):
+            raise TypeError('Counter field not defined in class %s: %s' % (target.__name__, counter))
+        if mappings[fk].updatable:
+            logging.warning('NOTE: change counter foreign key %s.%s to non-updatable.' % (name, fk))
+            mappings[fk].updatable = False
+        if target.__mappings__[counter].updatable:
+            logging.warning('NOTE: change counter field %s.%s to non-updatable.' % (target.__name__, counter))
+            target.__mappings__[counter].updatable = False
+        L.append((fk, target, counter))
+    return L
+
+
+def _gen_denormalize(name, mappings, specs=()):
+    """
+    检查 __denormalize__ 声明的冗余字段， 每一项为 (外键字段, 源Model, {冗余字段: 源Model中的字段})：
+        class Blog(Model):
+            __denormalize__ = [('user_id', User, dict(user_name='name', user_image='image'))]
+    表示 blogs.user_name/user_image 是 users.name/image 的拷贝， 读取时不需要join；
+    User.update() 提交之后 由后台的 _Propagator 分批改写这些拷贝
+    外键 不能被update； 冗余字段 只能在insert时写入 或者由propagator维护，
+    不能被Blog.update()用实例中可能过期的值覆盖
+    """
+    L = []
+    for fk, source, fields in specs:
+        if not fk in mappings:
+            raise TypeError('Denormalize foreign key not defined in class %s: %s' % (name, fk))
+        for copy, field in fields.iteritems():
+            if not copy in mappings:
+                raise TypeError('Denormalized field not defined in class %s: %s' % (name, copy))
+            if not field in getattr(source, '__mappings__', {}):
+                raise TypeError('Denormalize source field not defined in class %s: %s' % (source.__name__, field))
+            if mappings[copy].updatable:
+                logging.warning('NOTE: change denormalized field %s.%s to non-updatable.' % (name, copy))
+                mappings[copy].updatable = False
+        if mappings[fk].updatable:
+            logging.warning('NOTE: change denormalize foreign key %s.%s to non-updatable.' % (name, fk))
+            mappings[fk].updatable = False
+        L.append((fk, source, dict(fields)))
+    return L
+
+
+def _gen_shard(name, mappings, spec):
+    """
+    检查 __shard__ 声明的分片策略，返回 _ShardPolicy 对象，没有声明时返回None
+    分片键的值决定了该行所在的分片，修改它需要把行迁移到其他分片，所以不能被update
+    """
+    if spec is None:
+        return None
+    key = spec['key']
+    if not key in mappings:
+        raise TypeError('Shard key not defined in class %s: %s' % (name, key))
+    if mappings[key].updatable:
+        logging.warning('NOTE: change shard key %s.%s to non-updatable.' % (name, key))
+        mappings[key].updatable = False
+    return _ShardPolicy(name, key, spec.get('group', name.lower()))
+
+
 class Field(object):
     """
     保存数据库中的表的  字段属性
@@ -86,6 +249,8 @@ class Field(object):
                 `last_modified` real not null,
                 primary key(`id`)
                 );
+    self.index / self.unique: 是否在该字段上建立 普通索引/唯一索引，生成__sql时会追加
+                key `idx_xxx` (`xxx`) 或 unique key `uk_xxx` (`xxx`)
     self._default: 用于让orm自己填入缺省值，缺省值可以是 可调用对象，比如函数
                 比如：passwd 字段 <StringField:passwd,varchar(255),default(<function <lambda> at 0x0000000002A13898>),UI>
                      这里passwd的默认值 就可以通过 返回的函数 调用取得
@@ -93,6 +258,12 @@ class Field(object):
     """
     _count = 0
 
+    # 写入/读取数据库时的转换函数，子类可以覆盖，为None时不转换：
+    #   to_db(value) ==> 写入数据库的值
+    #   from_db(value) ==> Model实例中保存的值
+    to_db = None
+    from_db = None
+
     def __init__(self, **kw):
         self.name = kw.get('name', None)
         self._default = kw.get('default', None)
@@ -101,6 +272,8 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', '')
+        self.index = kw.get('index', False)
+        self.unique = kw.get('unique', False)
         self._order = Field._count
         Field._count += 1
 
@@ -197,14 +370,588 @@ class BlobField(Field):
         super(BlobField, self).__init__(**kw)
 
 
+# CompressedTextField 的格式头：第一个字节标识存储格式，没有格式头的是迁移前的原始文本
+_TEXT_RAW = '\x00'
+_TEXT_ZLIB = '\x01'
+
+
+def compress_text(value, threshold=256, level=6):
+    """
+    把文本编码为 CompressedTextField 的存储格式：
+        utf-8长度 >= threshold 并且压缩后更短时， 存为 '\\x01' + zlib数据
+        否则存为 '\\x00' + utf-8文本
+    已经编码过的值原样返回
+
+    >>> compress_text(u'abc')
+    '\\x00abc'
+    >>> len(compress_text(u'abc' * 100)) < 300
+    True
+    >>> decompress_text(compress_text(u'abc' * 100)) == u'abc' * 100
+    True
+    """
+    if isinstance(value, _LazyText):
+        return value.raw
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    if value[:1] in (_TEXT_RAW, _TEXT_ZLIB):
+        return value
+    if len(value) >= threshold:
+        z = zlib.compress(value, level)
+        if len(z) + 1 < len(value):
+            return _TEXT_ZLIB + z
+    return _TEXT_RAW + value
+
+
+def decompress_text(value):
+    """
+    把 CompressedTextField 的存储格式 解码为unicode， 兼容迁移前没有格式头的文本
+    """
+    if value is None:
+        return value
+    value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+    h = value[:1]
+    if h == _TEXT_ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if h == _TEXT_RAW:
+        return value[1:].decode('utf-8')
+    return value.decode('utf-8')
+
+
+class _LazyText(object):
+    """
+    从数据库读出的 尚未解压的值， 第一次访问时才解压
+    """
+    __slots__ = ('raw', )
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def load(self):
+        return decompress_text(self.raw)
+
+
+class CompressedTextField(Field):
+    """
+    保存压缩文本类型字段的属性
+    insert/update 时按 compress_text 压缩， 读取时不解压，访问该属性时才解压
+    threshold: 小于该长度(utf-8字节数)的文本不压缩
+    level: zlib 压缩级别
+    已有的text列需要先用 compress_column 迁移
+    """
+    def __init__(self, threshold=256, level=6, **kw):
+        if 'default' not in kw:
+            kw['default'] = ''
+        if 'ddl' not in kw:
+            kw['ddl'] = 'mediumblob'
+        super(CompressedTextField, self).__init__(**kw)
+        self.threshold = threshold
+        self.level = level
+
+    def to_db(self, value):
+        return compress_text(value, self.threshold, self.level)
+
+    def from_db(self, value):
+        return _LazyText(value)
+
+
 class VersionField(Field):
     """
     保存Version类型字段的属性
+    Model中定义了VersionField时，update() 使用乐观锁：
+        update ... set ..., `version`=`version`+1 where `id`=? and `version`=?
+    没有匹配的行 说明该行已被其他人修改，抛出 VersionConflictError
     """
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
 
+class VersionConflictError(db.DBError):
+    """
+    乐观锁冲突： update 时数据库中的version 和实例的version 不一致
+    """
+    pass
+
+
+def retry_on_conflict(retries=3, delay=0.01):
+    """
+    设计一个装饰器， 在发生 VersionConflictError 时重新执行被装饰的函数
+    被装饰的函数需要自己重新读取数据(read-modify-write)，比如：
+        @retry_on_conflict(retries=5)
+        def rename_blog(blog_id, name):
+            blog = Blog.get(blog_id)
+            blog.name = name
+            blog.update()
+    delay: 第n次重试前 sleep delay * n 秒， 避免冲突的线程同时重试
+    超过重试次数后 抛出最后一次的 VersionConflictError
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            n = 0
+            while True:
+                try:
+                    return func(*args, **kw)
+                except VersionConflictError:
+                    n += 1
+                    if n > retries:
+                        raise
+                    logging.warning('[VERSION] conflict in %s, retry %d...' % (func.__name__, n))
+                    if delay:
+                        time.sleep(delay * n)
+        return _wrapper
+    return _decorator
+
+
+class _ModelCache(object):
+    """
+    Model.get 的读穿透缓存， 通过在Model子类中声明 __cache__ 开启：
+        class User(Model):
+            __cache__ = dict(ttl=300, max_entries=10000)
+    ttl: 缓存的有效时间(秒)
+    max_entries: 最多缓存的行数，超过后按LRU淘汰
+    缓存的是 db.select_one 返回的行数据， 每次get都会构造新的Model实例，
+    所以调用者修改实例 不会污染缓存。
+    _generation: 每次失效都会+1，get在查询数据库之前记下该值，
+                 如果查询期间有失效发生，就不把查询结果写入缓存，避免把旧数据写回去
+    """
+    def __init__(self, name, ttl=60, max_entries=1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(row):
+        """
+        估算一行数据占用的内存
+        """
+        return sys.getsizeof(row) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in row.iteritems())
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        """
+        返回缓存的行数据， 未命中或已过期返回None
+        """
+        with self._lock:
+            e = self._entries.pop(key, None)
+            if e is not None and e[0] > time.time():
+                self._entries[key] = e
+                self.hits += 1
+                return e[1]
+            if e is not None:
+                self._memory -= e[2]
+            self.misses += 1
+            return None
+
+    def put(self, key, row, generation=None):
+        """
+        写入一行数据， generation 与当前值不一致时放弃写入
+        """
+        size = self._sizeof(row)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            e = self._entries.pop(key, None)
+            if e is not None:
+                self._memory -= e[2]
+            self._entries[key] = (time.time() + self.ttl, dict(row), size)
+            self._memory += size
+            while len(self._entries) > self.max_entries:
+                _, e = self._entries.popitem(last=False)
+                self._memory -= e[2]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            e = self._entries.pop(key, None)
+            if e is not None:
+                self._memory -= e[2]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._memory = 0
+
+    def stats(self):
+        """
+        返回缓存的统计信息：命中次数，未命中次数，命中率，行数，估算的内存(字节)
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return db.Dict(name=self.name, hits=self.hits, misses=self.misses,
+                           hit_ratio=float(self.hits) / total if total else 0.0,
+                           entries=len(self._entries), memory=self._memory)
+
+
+# 所有开启了缓存的Model: {类名: _ModelCache}
+_caches = {}
+
+
+def cache_stats():
+    """
+    返回所有Model缓存的统计信息列表
+    """
+    return [c.stats() for _, c in sorted(_caches.iteritems())]
+
+
+class _BloomFilter(object):
+    """
+    Bloom filter： 判断一个值 一定不存在 或者 可能存在
+    capacity: 预计的元素个数， error_rate: 元素个数达到capacity时的误判率
+    用md5的两个64位整数 做double hashing得到k个位置
+
+    >>> f = _BloomFilter(1000, 0.01)
+    >>> f.m, f.k
+    (9586, 7)
+    >>> for i in range(1000):
+    ...     f.add(str(i))
+    >>> all(str(i) in f for i in range(1000))
+    True
+    >>> sum(1 for i in range(1000, 11000) if str(i) in f) < 200
+    True
+    >>> round(f.error_rate(), 3)
+    0.01
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.m = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.k = max(1, int(round(float(self.m) / capacity * math.log(2))))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.m for i in xrange(self.k)]
+
+    def add(self, key):
+        # |= 不是原子操作， 并发add时可能丢失其中一个位， 导致漏判:
+        with self._lock:
+            for p in self._positions(key):
+                self.bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def error_rate(self):
+        """
+        按已加入的元素个数 估算的误判率
+        """
+        return (1 - math.exp(-self.k * self.count / float(self.m))) ** self.k
+
+
+class _NegativeCache(object):
+    """
+    Model的否定缓存， 通过在Model子类中声明 __negative_cache__ 开启：
+        class User(Model):
+            __negative_cache__ = dict(capacity=100000, error_rate=0.001)
+    为主键和单字段的unique索引 各维护一个Bloom filter，
+    get(pk) 和 find_first/exists('where col=?', value) 查询的值一定不存在时 直接返回， 不访问数据库
+    build_negative_cache 扫描完整个表之后才生效， 在此之前照常查询数据库
+    insert/update 在写数据库之前 把新的值加入filter， 事务回滚只会多出误判，不会漏判；
+    写之前加入、提交之前build的扫描已经经过了该行时， 新的filter里没有这个值，
+    所以提交之后 如果期间开始过新的build， 再加入一次(recheck)；
+    delete 不能从filter中删除， 也只会增加误判， 误判率太高时重新build
+    注意： filter只在本进程内维护， 其它进程(多个worker)写入的值 本进程看不到，
+    因此只能用于单进程部署， 或者只有一个进程写入的表；
+    多worker部署时 不要在会被其它进程插入的表上开启(例如 users: 注册和登录在不同的worker上)
+
+    >>> _NegativeCache._key(u'Jos\\xe9 ') == _NegativeCache._key(u'JOSE')
+    True
+    >>> nc = _NegativeCache('test', ['id'], capacity=100)
+    >>> nc.swap(dict(id=_BloomFilter(100, 0.01)))
+    >>> generation = nc.add(dict(id='u1'))
+    >>> nc.start_build(dict(id=_BloomFilter(100, 0.01)))   # 扫描在 u1 提交之前经过了它
+    >>> nc.swap(nc.building)
+    >>> nc.may_exist('id', 'u1')
+    False
+    >>> nc.recheck(dict(id='u1'), generation)
+    >>> nc.may_exist('id', 'u1')
+    True
+    """
+    def __init__(self, name, columns, capacity=100000, error_rate=0.001):
+        self.name = name
+        self.columns = columns
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # {字段名: _BloomFilter}， build完成之前为None
+        self.filters = None
+        # build期间新建的filter， insert同时写入 避免漏掉扫描期间插入的行
+        self.building = None
+        # 每次开始build时 +1， 用于recheck
+        self.generation = 0
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.skipped = 0
+        self.false_positives = 0
+
+    @staticmethod
+    def _key(value):
+        # MySQL默认的collation(utf8_general_ci)比较字符串时 不区分大小写和重音， 并忽略结尾的空格，
+        # 按同样的规则规范化(分解后去掉重音符号)， 保证数据库能查到的值 在filter中也一定能查到
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        value = unicodedata.normalize('NFKD', value)
+        value = u''.join(c for c in value if not unicodedata.combining(c))
+        return value.lower().replace(u'\xdf', u's').rstrip(u' ').encode('utf-8')
+
+    def add(self, row):
+        """
+        把一行数据 {字段名: 值} 中的主键和unique字段加入filter， 返回当前的generation， 提交后传给recheck
+        """
+        with self._lock:
+            targets = [f for f in (self.filters, self.building) if f is not None]
+            generation = self.generation
+        for filters in targets:
+            for col in self.columns:
+                value = row.get(col)
+                if value is not None:
+                    filters[col].add(self._key(value))
+        return generation
+
+    def recheck(self, row, generation):
+        """
+        写操作提交之后调用： add之后开始过新的build时 再加入一次
+        """
+        if self.generation != generation:
+            self.add(row)
+
+    def start_build(self, filters):
+        with self._lock:
+            self.building = filters
+            self.generation += 1
+
+    def may_exist(self, col, value):
+        """
+        返回False时 该值一定不存在
+        """
+        filters = self.filters
+        if filters is None or col not in filters:
+            return True
+        with self._lock:
+            self.checks += 1
+        if self._key(value) in filters[col]:
+            return True
+        with self._lock:
+            self.skipped += 1
+        return False
+
+    def missed(self):
+        """
+        filter认为可能存在 但数据库中没有查到：一次误判
+        """
+        if self.filters is not None:
+            with self._lock:
+                self.false_positives += 1
+
+    def swap(self, filters):
+        with self._lock:
+            self.filters = filters
+            self.building = None
+            self.checks = self.skipped = self.false_positives = 0
+
+    def stats(self):
+        """
+        返回统计信息：是否已build、检查次数、跳过数据库的次数、误判次数、
+        实际的误判率(误判次数 / 不存在的值的查询次数)、按元素个数估算的误判率、
+        每个filter的元素个数， filter占用的内存(字节)
+        """
+        with self._lock:
+            filters = self.filters or {}
+            negatives = self.skipped + self.false_positives
+            return db.Dict(name=self.name, ready=self.filters is not None,
+                           checks=self.checks, skipped=self.skipped, false_positives=self.false_positives,
+                           false_positive_rate=float(self.false_positives) / negatives if negatives else 0.0,
+                           estimated_error_rate=max([f.error_rate() for f in filters.itervalues()] or [0.0]),
+                           entries=dict((c, f.count) for c, f in filters.iteritems()),
+                           memory=sum(len(f.bits) for f in filters.itervalues()))
+
+
+# 所有开启了否定缓存的Model: {类名: _NegativeCache}
+_negative_caches = {}
+
+
+def negative_cache_stats():
+    """
+    返回所有Model否定缓存的统计信息列表
+    """
+    return [c.stats() for _, c in sorted(_negative_caches.iteritems())]
+
+
+# 没有指定分片键
+_NO_KEY = object()
+
+
+class _ShardPolicy(object):
+    """
+    Model的水平分片策略， 通过在Model子类中声明 __shard__ 开启：
+        class Comment(Model):
+            __shard__ = dict(key='blog_id', group='comments')
+    key: 分片键字段， 按 crc32(分片键的值) % 分片数 路由到分片
+    group: db.add_shards 注册的分片组， 分片组未注册时只有全局engine，相当于不分片
+    """
+    def __init__(self, name, key, group):
+        self.name = name
+        self.key = key
+        self.group = group
+
+    @property
+    def engines(self):
+        return db.shard_engines(self.group) or [None]
+
+    def engine_for(self, value):
+        """
+        返回分片键的值 对应的engine名称
+        """
+        engines = self.engines
+        if len(engines) == 1:
+            return engines[0]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return engines[(zlib.crc32(str(value)) & 0xffffffff) % len(engines)]
+
+    def one(self, value, fn, *args):
+        """
+        在分片键的值 对应的分片上执行fn
+        """
+        with db.use_engine(self.engine_for(value)):
+            return fn(*args)
+
+    def all(self, fn, *args):
+        """
+        在所有分片上并行执行fn， 返回结果列表
+        """
+        return db.scatter(self.engines, fn, *args)
+
+
+# 只有一个等值条件的where， 可以使用否定缓存:  where `email`=?
+_RE_WHERE_EQ = re.compile(r'^\s*where\s+`?(\w+)`?\s*=\s*\?\s*$', re.I)
+_RE_LIMIT = re.compile(r'\blimit\s+(\d+|\?)(?:\s*,\s*(\d+|\?))?\s*$', re.I)
+_RE_ORDER_BY = re.compile(r'\border\s+by\s+(.+)$', re.I | re.S)
+
+
+def _split_order_limit(where, args):
+    """
+    把查询条件拆分成 在每个分片上执行的条件 和 合并结果时需要的排序/分页信息
+    每个分片都需要返回 offset + limit 行， 合并排序之后再分页：
+
+    >>> _split_order_limit('where user_id=? order by created_at desc, `id` limit ?, ?', ('u1', 20, 10))
+    ('where user_id=? order by created_at desc, `id` limit 30', ['u1'], [('created_at', True), ('id', False)], 20, 10)
+    >>> _split_order_limit('where user_id=?', ('u1', ))
+    ('where user_id=?', ['u1'], [], 0, None)
+    """
+    args = list(args)
+    offset, limit = 0, None
+    m = _RE_LIMIT.search(where)
+    if m:
+        values = [v for v in m.groups() if v is not None]
+        n = values.count('?')
+        params = iter(args[len(args) - n:])
+        del args[len(args) - n:]
+        values = [int(next(params)) if v == '?' else int(v) for v in values]
+        offset, limit = (0, values[0]) if len(values) == 1 else values
+        where = '%s limit %d' % (where[:m.start()].rstrip(), offset + limit)
+    order = []
+    m = _RE_ORDER_BY.search(_RE_LIMIT.sub('', where))
+    if m:
+        for item in m.group(1).split(','):
+            parts = item.split()
+            col = parts[0].split('.')[-1].strip('`')
+            order.append((col, len(parts) > 1 and parts[1].lower() == 'desc'))
+    return where, args, order, offset, limit
+
+
+def _merge_rows(results, order, offset=0, limit=None):
+    """
+    合并各个分片的查询结果， 按order 排序后再按 offset/limit 分页
+    """
+    rows = [r for L in results for r in L]
+    for col, desc in reversed(order):
+        try:
+            rows.sort(key=lambda r: r[col], reverse=desc)
+        except KeyError:
+            raise ValueError('Cannot merge "order by %s" across shards.' % col)
+    return rows[offset:] if limit is None else rows[offset:offset + limit]
+
+
+def _combine(fn, a, b):
+    """
+    合并两个分片的同一个聚合结果
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if fn in ('count', 'sum'):
+        return a + b
+    return min(a, b) if fn == 'min' else max(a, b)
+
+
+def _merge_aggregates(fns, ngroups, results):
+    """
+    合并各个分片的聚合结果， results 为每个分片上 [(分组字段..., 聚合列...), ...] 组成的列表
+    avg 无法由各分片的结果合并得到， 抛出ValueError
+    """
+    if 'avg' in fns:
+        raise ValueError('avg() cannot be merged across shards, use sum and count instead.')
+    merged = {}
+    for rows in results:
+        for r in rows:
+            g = r[:ngroups]
+            if g in merged:
+                r = g + tuple(_combine(fn, a, b) for fn, a, b in zip(fns, merged[g][ngroups:], r[ngroups:]))
+            merged[g] = r
+    return [merged[g] for g in sorted(merged)]
+
+
+def _select_one_joined(sql, *args):
+    """
+    返回 (select_one的结果, 结果是否来自加入的single-flight)
+    """
+    return db.select_one(sql, *args), db.joined_flight()
+
+
+def _first(L):
+    """
+    返回列表中第一个不为None的元素
+    """
+    for x in L:
+        if x is not None:
+            return x
+    return None
+
+
+def _lazy_getitem(self, key):
+    """
+    有from_db转换的Model 使用的__getitem__， 第一次访问时才解压 _LazyText
+    getattr、jinja2模板 和 json.dumps 都会经过这里
+    """
+    value = dict.__getitem__(self, key)
+    if isinstance(value, _LazyText):
+        value = value.load()
+        dict.__setitem__(self, key, value)
+    return value
+
+
 class ModelMetaclass(type):
     """
     对类对象动态完成以下操作
@@ -217,6 +964,28 @@ class ModelMetaclass(type):
     类和表的mapping：
         1. 提取类名，保存为表名，完成简单的类和表的映射
         2. 新增"__table__"属性，保存提取出来的表名
+    索引：
+        1. 合并字段上的 index/unique 声明 和 类属性"__indexes__" 中的复合索引
+        2. 用规范化后的 [(name, columns, unique), ...] 覆盖"__indexes__"属性
+    计数器缓存：
+        1. 检查类属性"__counters__" 中的外键和计数字段
+        2. 外键 和 计数字段 都会被改成 non-updatable
+    冗余字段：
+        1. 检查类属性"__denormalize__" 中的外键和冗余字段， 外键 和 冗余字段 都会被改成 non-updatable
+        2. 在源Model的"__dependents__"属性中 登记 (Model, 外键, 字段对应关系)
+    字段转换：
+        1. 新增"__converters__"属性，保存有from_db转换的字段 [(属性名, 字段), ...]
+        2. 有转换时 使用 _lazy_getitem 作为__getitem__，实现访问时才转换
+    乐观锁：
+        1. 新增"__version__"属性，保存VersionField字段，没有时为None
+    分片：
+        1. 类属性"__shard__" 为dict(key=..., group=...)时 替换为 _ShardPolicy 对象，否则为None
+        2. 分片键 会被改成 non-updatable
+    缓存：
+        1. 类属性"__cache__" 为dict(ttl=..., max_entries=...)时 替换为 _ModelCache 对象，否则为None
+        2. 类属性"__negative_cache__" 为dict(capacity=..., error_rate=...)时 替换为 _NegativeCache 对象，否则为None
+    group commit：
+        1. 类属性"__group_commit__" 为True时 insert 通过 db.group_commit 和其他线程的insert合并提交
     """
     def __new__(cls, name, bases, attrs):
         # skip base Model class:
@@ -234,11 +1003,17 @@ class ModelMetaclass(type):
         logging.info('Scan ORMapping %s...' % name)
         mappings = dict()
         primary_key = None
+        version = None
         for k, v in attrs.iteritems():
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
                 logging.info('[MAPPING] Found mapping: %s => %s' % (k, v))
+                # check duplicate version field:
+                if isinstance(v, VersionField):
+                    if version:
+                        raise TypeError('Cannot define more than 1 version field in class: %s' % name)
+                    version = v
                 # check duplicate primary key:
                 if v.primary_key:
                     if primary_key:
@@ -260,11 +1035,34 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__version__'] = version
+        attrs['__converters__'] = [(k, v) for k, v in mappings.iteritems() if v.from_db]
+        if attrs['__converters__'] and not '__getitem__' in attrs:
+            attrs['__getitem__'] = _lazy_getitem
+        indexes = _gen_indexes(mappings, attrs.get('__indexes__', ()))
+        attrs['__counters__'] = _gen_counters(name, mappings, attrs.get('__counters__', ()))
+        attrs['__denormalize__'] = _gen_denormalize(name, mappings, attrs.get('__denormalize__', ()))
+        attrs['__dependents__'] = []
+        attrs['__shard__'] = _gen_shard(name, mappings, attrs.get('__shard__'))
+        if attrs.get('__cache__') is not None:
+            attrs['__cache__'] = _caches[name] = _ModelCache(name, **attrs['__cache__'])
+        else:
+            attrs['__cache__'] = None
+        if attrs.get('__negative_cache__') is not None:
+            columns = [primary_key.name] + [cols[0] for _, cols, unique in indexes if unique and len(cols) == 1]
+            attrs['__negative_cache__'] = _negative_caches[name] = _NegativeCache(name, columns, **attrs['__negative_cache__'])
+        else:
+            attrs['__negative_cache__'] = None
+        attrs['__group_commit__'] = bool(attrs.get('__group_commit__'))
+        attrs['__indexes__'] = indexes
+        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, indexes)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        for fk, source, fields in model.__denormalize__:
+            source.__dependents__.append((model, fk, fields))
+        return model
 
 
 class Model(dict):
@@ -275,7 +1073,17 @@ class Model(dict):
         "__table__" : 表名
         "__mappings__": 字段对象(字段的所有属性，见Field类)
         "__primary_key__": 主键字段
+        "__version__": 乐观锁的版本字段(VersionField)，没有时为None
         "__sql__": 创建表时执行的sql
+        "__counters__": 计数器缓存 [(外键字段, 目标Model, 计数字段), ...]
+        "__denormalize__": 冗余字段 [(外键字段, 源Model, {冗余字段: 源字段}), ...]
+        "__dependents__": 冗余了该Model字段的Model [(Model, 外键字段, {冗余字段: 源字段}), ...]
+        "__shard__": 水平分片策略（_ShardPolicy对象），未分片时为None
+        "__cache__": Model.get 的读穿透缓存（_ModelCache对象），未开启时为None
+        "__negative_cache__": 主键和unique字段的否定缓存（_NegativeCache对象），未开启时为None
+        "__group_commit__": insert 是否通过 db.group_commit 合并提交
+        "__indexes__": 索引列表 [(name, columns, unique), ...]， 由字段的index/unique 和
+                       子类中声明的 __indexes__ 合并而来
 
     子类在实例化时，需要完成 实例属性 <==> 行值 的映射， 这里使用 定制dict 来实现。
         Model 从字典继承而来，并且通过"__getattr__","__setattr__"将Model重写，
@@ -329,6 +1137,17 @@ class Model(dict):
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    @classmethod
+    def _from_row(cls, d):
+        """
+        用查询出来的一行数据构造实例，对有from_db转换的字段进行转换
+        """
+        m = cls(**d)
+        for k, f in cls.__converters__:
+            if f.name in d:
+                dict.__setitem__(m, k, f.from_db(d[f.name]))
+        return m
+
     def __getattr__(self, key):
         """
         get时生效，比如 a[key],  a.get(key)
@@ -347,51 +1166,254 @@ class Model(dict):
         self[key] = value
 
     @classmethod
-    def get(cls, pk):
+    def get(cls, pk, cached=True):
         """
         Get by primary key.
+        分片时 如果主键就是分片键则直接路由，否则在所有分片上查询
+        开启了 __cache__ 时先读缓存；未命中则查询数据库，并在事务之外把结果写入缓存
+        （事务中读到的可能是未提交的数据； 加入single-flight得到的结果可能是提交之前的数据， 也不写入缓存）
+        缓存只在本进程内失效， 其他进程的修改要等ttl过期才能看到，
+        需要最新数据的地方(比如 校验登录cookie用的密码和权限) 传 cached=False 跳过缓存直接查询
+        开启了 __negative_cache__ 时 一定不存在的主键直接返回None
+        """
+        cache = cls.__cache__
+        if cache is not None:
+            d = cache.get(pk) if cached else None
+            if d is not None:
+                return cls._from_row(d)
+            generation = cache.generation
+        if not cls._may_exist(cls.__primary_key__.name, pk):
+            return None
+        sql = 'select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name)
+        key = pk if cls.__shard__ and cls.__mappings__[cls.__shard__.key] is cls.__primary_key__ else _NO_KEY
+        # 分片上的查询可能在scatter的线程中执行， 所以在执行查询的线程里取 joined_flight:
+        rows = cls._on_shards(key, _select_one_joined, sql, pk)
+        d = _first([r for r, joined in rows])
+        if d is None:
+            cls.__negative_cache__ and cls.__negative_cache__.missed()
+        elif cache is not None and not db.in_transaction() and not any(joined for r, joined in rows):
+            cache.put(pk, d, generation)
+        return cls._from_row(d) if d else None
+
+    @classmethod
+    def _may_exist(cls, col, value):
+        nc = cls.__negative_cache__
+        return nc is None or nc.may_exist(col, value)
+
+    @classmethod
+    def _may_match(cls, where, args):
+        """
+        where 为 'where col=?' 并且col有否定缓存时， 返回该值是否可能存在， 其他条件都返回True
+        """
+        nc = cls.__negative_cache__
+        if nc is None or len(args) != 1:
+            return True
+        m = _RE_WHERE_EQ.match(where)
+        return m is None or nc.may_exist(m.group(1), args[0])
+
+    @classmethod
+    def negative_cache_stats(cls):
+        """
+        返回该Model否定缓存的统计信息， 未开启时返回None
         """
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        return cls.__negative_cache__.stats() if cls.__negative_cache__ is not None else None
 
     @classmethod
-    def find_first(cls, where, *args):
+    def cache_stats(cls):
+        """
+        返回该Model缓存的统计信息， 未开启缓存时返回None
+        """
+        return cls.__cache__.stats() if cls.__cache__ is not None else None
+
+    @classmethod
+    def _invalidate(cls, pk):
+        """
+        立即让缓存失效，并在事务提交后再失效一次：
+        避免提交前 其他线程把旧数据重新写入缓存
+        """
+        cache = cls.__cache__
+        if cache is not None:
+            cache.invalidate(pk)
+            if db.in_transaction():
+                db.on_commit(lambda: cache.invalidate(pk))
+
+    @classmethod
+    def _on_shards(cls, key, fn, *args):
+        """
+        不分片时在全局engine上执行fn；分片时在分片键key对应的分片上执行fn，
+        没有分片键（_NO_KEY）时在所有分片上并行执行， 返回结果列表
+        """
+        policy = cls.__shard__
+        if policy is None:
+            with db.use_engine(None):
+                return [fn(*args)]
+        if key is _NO_KEY:
+            return policy.all(fn, *args)
+        return [policy.one(key, fn, *args)]
+
+    @classmethod
+    def _pop_shard_key(cls, kw):
+        """
+        从关键字参数中取出分片键的值 shard_key
+        """
+        key = kw.pop('shard_key', _NO_KEY)
+        if kw:
+            raise TypeError('Unexpected keyword argument(s): %s' % ', '.join(kw.keys()))
+        return key
+
+    @classmethod
+    def _scatter_select(cls, where, args):
+        """
+        在所有分片上执行查询， 合并结果时按照where中的 order by 排序， 再按 limit 分页
+        """
+        where, args, order, offset, limit = _split_order_limit(where, args)
+        results = cls.__shard__.all(db.select, 'select * from `%s` %s' % (cls.__table__, where), *args)
+        return _merge_rows(results, order, offset, limit)
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
         """
         通过where语句进行条件查询，返回1个查询结果。如果有多个查询结果
         仅取第一个，如果没有结果，则返回None
+        分片时可以通过 shard_key=... 指定分片键的值，否则在所有分片上查询后 按order by取第一个
         """
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        key = cls._pop_shard_key(kw)
+        if not cls._may_match(where, args):
+            return None
+        if cls.__shard__ is None or key is not _NO_KEY:
+            d = cls._on_shards(key, db.select_one, 'select * from %s %s' % (cls.__table__, where), *args)[0]
+        else:
+            L = cls._scatter_select(where if _RE_LIMIT.search(where) else '%s limit 1' % where, args)
+            d = L[0] if L else None
+        if d is None and len(args) == 1 and _RE_WHERE_EQ.match(where):
+            cls.__negative_cache__ and cls.__negative_cache__.missed()
+        return cls._from_row(d) if d else None
 
     @classmethod
     def find_all(cls, *args):
         """
         查询所有字段， 将结果以一个列表返回
         """
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+        if cls.__shard__ is None:
+            L = cls._on_shards(_NO_KEY, db.select, 'select * from `%s`' % cls.__table__)[0]
+        else:
+            L = cls._scatter_select('', ())
+        return [cls._from_row(d) for d in L]
 
     @classmethod
-    def find_by(cls, where, *args):
+    def find_by(cls, where, *args, **kw):
         """
         通过where语句进行条件查询，将结果以一个列表返回
+        分片时可以通过 shard_key=... 指定分片键的值，否则在所有分片上并行查询，
+        合并结果时保持 order by 的顺序和 limit 的行数：
+            Comment.find_by('where blog_id=? order by created_at desc', blog_id, shard_key=blog_id)
+            Comment.find_by('order by created_at desc limit ?', 10)
+        """
+        key = cls._pop_shard_key(kw)
+        if cls.__shard__ is None or key is not _NO_KEY:
+            L = cls._on_shards(key, db.select, 'select * from `%s` %s' % (cls.__table__, where), *args)[0]
+        else:
+            L = cls._scatter_select(where, args)
+        return [cls._from_row(d) for d in L]
+
+    @classmethod
+    def exists(cls, where, *args, **kw):
+        """
+        通过 select 1 from table where ... limit 1 检测是否存在满足条件的行，返回布尔值
+        不会把整行数据取回来 构造Model实例
+            User.exists('where email=?', 'test@example.com')
         """
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        key = cls._pop_shard_key(kw)
+        if not cls._may_match(where, args):
+            return False
+        sql = 'select 1 from `%s` %s limit 1' % (cls.__table__, where)
+        r = _first(cls._on_shards(key, db.select_one, sql, *args)) is not None
+        if not r and len(args) == 1 and _RE_WHERE_EQ.match(where):
+            cls.__negative_cache__ and cls.__negative_cache__.missed()
+        return r
 
     @classmethod
     def count_all(cls):
         """
         执行 select count(pk) from table语句，返回一个数值
         """
-        return db.select('select count(`%s`) from `%s`' % (cls.__primay_key__.name, cls.__table__))
+        sql = 'select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__)
+        return sum(cls._on_shards(_NO_KEY, db.select_int, sql))
 
     @classmethod
-    def count_by(cls, where, *args):
+    def count_by(cls, where, *args, **kw):
         """
         通过select count(pk) from table where ...语句进行查询， 返回一个数值
         """
-        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        key = cls._pop_shard_key(kw)
+        sql = 'select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where)
+        return sum(cls._on_shards(key, db.select_int, sql, *args))
+
+    @classmethod
+    def _aggregate_column(cls, name):
+        """
+        将字段名转换为表的列名，'*' 原样返回，未定义的字段抛出 ValueError
+        """
+        if name == '*':
+            return name
+        f = cls.__mappings__.get(name)
+        if f is None:
+            raise ValueError('Cannot aggregate on unknown field: %s' % name)
+        return '`%s`' % f.name
+
+    @classmethod
+    def aggregate(cls, where='', *args, **kw):
+        """
+        在MySQL端完成聚合计算，返回数值或元组，而不是Model实例
+        支持的关键字参数：
+            group_by:  字段名 或 字段名组成的元组
+            count/sum/avg/min/max:  字段名 或 字段名组成的元组，count 可以为'*'
+        结果中的聚合列按照 count, sum, avg, min, max 的顺序排列，同一种聚合按传入的字段顺序排列
+        返回值：
+            没有group_by， 只有1个聚合列 ==> 数值
+            没有group_by， 多个聚合列   ==> 元组
+            有group_by                 ==> [(分组字段..., 聚合列...), ...]
+
+            Comment.aggregate(count='*')                                 ==> 10
+            Blog.aggregate('where user_id=?', uid, count='id', max='created_at')  ==> (3, 1441878476.2)
+            Comment.aggregate(group_by='blog_id', count='*')             ==> [(u'001...', 4), (u'002...', 6)]
+        分片时可以通过 shard_key=... 指定分片键的值，否则在所有分片上执行后合并（不支持avg）
+        """
+        key = kw.pop('shard_key', _NO_KEY)
+        group_by = kw.pop('group_by', None)
+        if isinstance(group_by, basestring):
+            group_by = (group_by, )
+        group_by = tuple(group_by or ())
+        columns = []
+        fns = []
+        for fn in _aggregates:
+            fields = kw.pop(fn, None)
+            if fields is None:
+                continue
+            if isinstance(fields, basestring):
+                fields = (fields, )
+            for name in fields:
+                if name == '*' and fn != 'count':
+                    raise ValueError('Only count() accepts "*".')
+                columns.append('%s(%s)' % (fn, cls._aggregate_column(name)))
+                fns.append(fn)
+        if kw:
+            raise TypeError('Unexpected aggregate argument(s): %s' % ', '.join(kw.keys()))
+        if not columns:
+            raise ValueError('At least 1 aggregate is required.')
+        groups = [cls._aggregate_column(name) for name in group_by]
+        select = ['%s as `_g%d`' % (c, n) for n, c in enumerate(groups)]
+        select.extend(['%s as `_a%d`' % (c, n) for n, c in enumerate(columns)])
+        sql = 'select %s from `%s` %s' % (','.join(select), cls.__table__, where)
+        names = ['_g%d' % n for n in range(len(groups))] + ['_a%d' % n for n in range(len(columns))]
+        if groups:
+            sql = '%s group by %s' % (sql, ','.join(groups))
+        results = [[tuple(d[k] for k in names) for d in L] for L in cls._on_shards(key, db.select, sql, *args)]
+        rows = results[0] if len(results) == 1 else _merge_aggregates(fns, len(groups), results)
+        if groups:
+            return rows
+        r = rows[0]
+        return r[0] if len(r) == 1 else r
 
     def update(self):
         """
@@ -405,22 +1427,53 @@ class Model(dict):
         通过的db对象的update接口执行SQL
             SQL: update `user` set `passwd`=%s,`last_modified`=%s,`name`=%s where id=%s,
                  ARGS: (u'******', 1441878476.202391, u'Michael', 10190
+
+        定义了VersionField时 使用乐观锁，版本不一致时抛出 VersionConflictError，
+        更新成功后实例的version +1
+            SQL: update `blogs` set `name`=%s,`version`=`version`+1 where `id`=%s and `version`=%s
         """
         self.pre_update and self.pre_update()
         L = []
         args = []
+        version = self.__version__
         for k, v in self.__mappings__.iteritems():
+            if v is version:
+                continue
             if v.updatable:
                 if hasattr(self, k):
-                    arg = getattr(self, k)
+                    # 有to_db转换时 读取原始值，未访问过的_LazyText不需要解压再压缩:
+                    arg = dict.__getitem__(self, k) if v.to_db else getattr(self, k)
                 else:
                     arg = v.default
                     setattr(self, k, arg)
                 L.append('`%s`=?' % k)
-                args.append(arg)
+                args.append(v.to_db(arg) if v.to_db else arg)
         pk = self.__primary_key__.name
+        # 主键和unique字段不能更新时(比如User) 不需要更新否定缓存:
+        nc = self.__negative_cache__
+        row = dict((v.name, getattr(self, k, None)) for k, v in self.__mappings__.iteritems() if v.updatable and v.name in nc.columns) if nc else None
+        generation = nc.add(row) if row else None
         args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        if version is None:
+            with self._shard_ctx():
+                db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+                row and db.on_commit(lambda: nc.recheck(row, generation))
+                self._invalidate(getattr(self, pk))
+                self._propagate()
+                self.post_update and db.on_commit(self.post_update)
+            return self
+        current = getattr(self, version.name) if hasattr(self, version.name) else version.default
+        L.append('`%s`=`%s`+1' % (version.name, version.name))
+        args.append(current)
+        with self._shard_ctx():
+            r = db.update('update `%s` set %s where `%s`=? and `%s`=?' % (self.__table__, ','.join(L), pk, version.name), *args)
+            self._invalidate(getattr(self, pk))
+            if r == 0:
+                raise VersionConflictError('Version conflict when update %s: %s=%s, %s=%s' % (self.__table__, pk, getattr(self, pk), version.name, current))
+            row and db.on_commit(lambda: nc.recheck(row, generation))
+            setattr(self, version.name, current + 1)
+            self._propagate()
+            self.post_update and db.on_commit(self.post_update)
         return self
 
     def delete(self):
@@ -431,9 +1484,71 @@ class Model(dict):
         self.pre_delete and self.pre_delete()
         pk = self.__primary_key__.name
         args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        with self._shard_ctx():
+            if not self.__counters__:
+                db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+                self._invalidate(args[0])
+                self.post_delete and db.on_commit(self.post_delete)
+                return self
+            with db.transaction():
+                self._load_counter_keys()
+                if db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args):
+                    self._update_counters(-1)
+                self._invalidate(args[0])
+                self.post_delete and db.on_commit(self.post_delete)
         return self
 
+    def _shard_ctx(self):
+        """
+        把当前线程切换到该行所在的分片，不分片时切换到全局engine
+        实例上没有分片键的值时（比如 Comment(id=xxx).delete()），先在所有分片上查出来
+        """
+        policy = self.__shard__
+        if policy is None:
+            return db.use_engine(None)
+        if not hasattr(self, policy.key):
+            pk = self.__primary_key__.name
+            col = self.__mappings__[policy.key].name
+            d = _first(policy.all(db.select_one, 'select `%s` from `%s` where `%s`=?' % (col, self.__table__, pk), getattr(self, pk)))
+            setattr(self, policy.key, d[col] if d else None)
+        return db.use_engine(policy.engine_for(getattr(self, policy.key)))
+
+    def _load_counter_keys(self):
+        """
+        delete 时需要外键的值来更新计数器，如果实例上没有外键属性（比如 Comment(id=xxx).delete()），
+        则先从数据库中读取
+        """
+        missing = [fk for fk, _, _ in self.__counters__ if not hasattr(self, fk)]
+        if not missing:
+            return
+        pk = self.__primary_key__.name
+        d = db.select_one('select %s from `%s` where `%s`=?' % (','.join(['`%s`' % self.__mappings__[fk].name for fk in missing]), self.__table__, pk), getattr(self, pk))
+        for fk in missing:
+            setattr(self, fk, d[self.__mappings__[fk].name] if d else None)
+
+    def _update_counters(self, delta):
+        """
+        以 col = col + delta 的方式更新计数器缓存：
+            目标行所在的engine 和当前行相同时(比如没有配置分片)， 在当前事务中原子地更新；
+            否则在目标engine上单独自动提交， 不保证和当前的写操作同时成功或失败
+        目标Model的分片键是主键时 直接路由到目标行所在的分片， 否则在所有分片上并行执行
+        """
+        for fk, target, counter in self.__counters__:
+            key = getattr(self, fk, None)
+            if key is None:
+                continue
+            col = target.__mappings__[counter].name
+            sql = 'update `%s` set `%s`=`%s`+? where `%s`=?' % (target.__table__, col, col, target.__primary_key__.name)
+            policy = target.__shard__
+            if policy is None:
+                with db.use_engine(None):
+                    db.update(sql, delta, key)
+            elif target.__mappings__[policy.key] is target.__primary_key__:
+                policy.one(key, db.update, sql, delta, key)
+            else:
+                policy.all(db.update, sql, delta, key)
+            target._invalidate(key)
+
     def insert(self):
         """
         通过db对象的insert接口执行SQL
@@ -446,10 +1561,457 @@ class Model(dict):
             if v.insertable:
                 if not hasattr(self, k):
                     setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+                params[v.name] = v.to_db(dict.__getitem__(self, k)) if v.to_db else getattr(self, k)
+        nc = self.__negative_cache__
+        generation = nc.add(params) if nc else None
+        with self._shard_ctx():
+            if self.__group_commit__:
+                db.group_commit(self._insert, params)
+            else:
+                self._insert(params)
+            nc and db.on_commit(lambda: nc.recheck(params, generation))
         return self
 
+    def _insert(self, params):
+        if not self.__counters__:
+            db.insert('%s' % self.__table__, **params)
+            self._populate(params)
+            self.post_insert and db.on_commit(self.post_insert)
+            return
+        with db.transaction():
+            if db.insert('%s' % self.__table__, **params):
+                self._update_counters(1)
+                self._populate(params)
+                self.post_insert and db.on_commit(self.post_insert)
+
+    def _propagate(self):
+        """
+        有其他Model冗余了该Model的字段时， 提交之后 让后台propagator改写这些拷贝
+        """
+        if self.__dependents__:
+            cls, key = self.__class__, getattr(self, self.__primary_key__.name)
+            db.on_commit(lambda: propagator.submit(cls, key))
+
+    def _populate(self, row):
+        """
+        insert 成功后（事务中则在提交后）把新行写入缓存
+        有non-insertable字段时 插入的数据不是完整的一行，不写入缓存
+        """
+        cache = self.__cache__
+        if cache is not None and len(row) == len(self.__mappings__):
+            key = row[self.__primary_key__.name]
+            db.on_commit(lambda: cache.put(key, row))
+
+
+def live_indexes(table):
+    """
+    通过 show index 读取当前engine上 表上已存在的索引，返回 {columns: (name, unique)}
+    columns 是按 Seq_in_index 排好序的字段名元组
+    """
+    keys = {}
+    for r in db.select('show index from `%s`' % table):
+        keys.setdefault(r.Key_name, (not int(r.Non_unique), []))[1].append((int(r.Seq_in_index), r.Column_name))
+    live = {}
+    for name, (unique, cols) in keys.iteritems():
+        if name == 'PRIMARY':
+            continue
+        live[tuple(c for _, c in sorted(cols))] = (name, unique)
+    return live
+
+
+def check_indexes(*models):
+    """
+    对比 Model 中声明的索引 和 数据库中实际存在的索引，返回缺失的索引列表：
+        [(table, name, columns, unique, ddl), ...]
+    ddl 是可以直接执行的 alter table 语句。
+    已存在的索引只要字段顺序相同即视为匹配（不要求索引名一致），
+    但声明为unique而实际不是unique的索引也会被报告。
+
+    >>> class Post(Model):
+    ...     __indexes__ = [('user_id', 'created_at')]
+    ...     id = IntegerField(primary_key=True)
+    ...     user_id = IntegerField(index=True)
+    ...     slug = StringField(unique=True)
+    ...     created_at = FloatField()
+    >>> print Post().__sql__()
+    -- generating SQL for post:
+    create table `post` (
+      `id` bigint not null,
+      `user_id` bigint not null,
+      `slug` varchar(255) not null,
+      `created_at` real not null,
+      key `idx_user_id` (`user_id`),
+      unique key `uk_slug` (`slug`),
+      key `idx_user_id_created_at` (`user_id`,`created_at`),
+      primary key(`id`)
+    );
+    >>> db.update('drop table if exists post')
+    0
+    >>> db.update('create table post (id bigint primary key, user_id bigint, slug varchar(255), created_at real, key k_uid (user_id))')
+    0
+    >>> for m in check_indexes(Post):
+    ...     print m[4]
+    alter table `post` add unique key `uk_slug` (`slug`)
+    alter table `post` add key `idx_user_id_created_at` (`user_id`,`created_at`)
+    >>> db.update('drop table post')
+    0
+    """
+    missing = []
+    for model in models:
+        table = model.__table__
+        live = live_indexes(table)
+        for name, columns, unique in model.__indexes__:
+            found = live.get(columns)
+            if found and (found[1] or not unique):
+                continue
+            ddl = 'alter table `%s` add %s' % (table, index_ddl(name, columns, unique))
+            logging.warning('[INDEX] missing index on %s: %s' % (table, ddl))
+            missing.append((table, name, columns, unique, ddl))
+    return missing
+
+
+def _live_columns(table):
+    """
+    通过 show columns 读取数据库中 表上已存在的字段， 返回 {字段名: 类型}， 类型为小写， 比如 'bigint(20)'
+    """
+    return dict((r.Field, r.Type.lower()) for r in db.select('show columns from `%s`' % table))
+
+
+def _column_ddl(f):
+    """
+    生成 alter table add column 中的字段定义： 已有的行取字段的默认值，
+    默认值是函数(比如 next_id)时 以及blob/text字段(MySQL不支持默认值)时 使用MySQL的隐式默认值
+    """
+    ddl = '%s%s' % (f.ddl, '' if f.nullable else ' not null')
+    d = f._default
+    if d is None or callable(d) or 'blob' in f.ddl or 'text' in f.ddl:
+        return ddl
+    if isinstance(d, bool):
+        d = int(d)
+    if isinstance(d, (int, long, float)):
+        return '%s default %r' % (ddl, d)
+    if isinstance(d, unicode):
+        d = d.encode('utf-8')
+    return "%s default '%s'" % (ddl, str(d).replace('\\', '\\\\').replace("'", "''"))
+
+
+def check_columns(*models):
+    """
+    对比 Model 中声明的字段 和 数据库中实际存在的字段， 返回需要迁移的字段列表：
+        [(table, engine, column, ddl), ...]
+    engine 是分片的engine名称(不分片时为None)， ddl 是需要在该engine上执行的 alter table 语句：
+        1. 缺少的字段： alter table ... add column， 按字段的声明顺序放在前一个字段之后，
+           已有的行取字段的默认值， 计数器字段(__counters__)加上之后需要执行 recount_counters；
+        2. CompressedTextField 对应的列还不是blob： alter table ... modify， 改完之后需要执行 compress_column
+    部署新增了字段的Model之前 必须先执行这些语句， 否则insert/update会因为字段不存在而失败。
+
+    >>> class Note(Model):
+    ...     id = IntegerField(primary_key=True)
+    ...     title = StringField()
+    ...     hits = IntegerField()
+    ...     body = CompressedTextField()
+    >>> db.update('drop table if exists note')
+    0
+    >>> db.update('create table note (id bigint primary key, body text)')
+    0
+    >>> for m in check_columns(Note):
+    ...     print m[3]
+    alter table `note` add column `title` varchar(255) not null default '' after `id`
+    alter table `note` add column `hits` bigint not null default 0 after `title`
+    alter table `note` modify `body` mediumblob not null
+    >>> db.update('drop table note')
+    0
+    """
+    missing = []
+    for model in models:
+        table = model.__table__
+        fields = sorted(model.__mappings__.values(), lambda x, y: cmp(x._order, y._order))
+        for engine in (model.__shard__.engines if model.__shard__ else [None]):
+            with db.use_engine(engine):
+                live = _live_columns(table)
+            prev = None
+            for f in fields:
+                ddl = None
+                if f.name not in live:
+                    ddl = 'alter table `%s` add column `%s` %s%s' % (table, f.name, _column_ddl(f), ' after `%s`' % prev if prev else ' first')
+                elif isinstance(f, CompressedTextField) and 'blob' not in live[f.name]:
+                    ddl = 'alter table `%s` modify `%s` %s%s' % (table, f.name, f.ddl, '' if f.nullable else ' not null')
+                if ddl:
+                    logging.warning('[COLUMN] %s%s needs migration: %s' % (table, '@%s' % engine if engine else '', ddl))
+                    missing.append((table, engine, f.name, ddl))
+                prev = f.name
+    return missing
+
+
+def recount_counters(model, batch_size=1000, pause=0):
+    """
+    修复计数器缓存的偏移（比如 手工删除了comments 表中的数据）
+    按主键顺序 分批扫描目标表， 每批在一个事务中：
+        1. select ... for update 锁住这一批目标行，避免和并发的 insert()/delete() 冲突
+        2. 通过 model.aggregate(group_by=外键, count='*') 重新统计
+        3. 只更新计数不一致的行
+    pause: 每批之间 sleep 的秒数，用于降低对线上库的压力
+    目标Model分片时 逐个分片执行
+    返回修复的行数
+
+        recount_counters(Comment, batch_size=500)
+    """
+    repaired = 0
+    for fk, target, counter in model.__counters__:
+        for engine in (target.__shard__.engines if target.__shard__ else [None]):
+            repaired += _recount_shard(model, fk, target, counter, engine, batch_size, pause)
+    return repaired
+
+
+def _recount_shard(model, fk, target, counter, engine, batch_size, pause):
+    """
+    在目标表的一个分片上 执行recount_counters
+    """
+    repaired = 0
+    pk = target.__primary_key__.name
+    col = target.__mappings__[counter].name
+    fk_col = model.__mappings__[fk].name
+    last = None
+    with db.use_engine(engine):
+        while True:
+            with db.transaction():
+                where, args = ('where `%s`>?' % pk, [last]) if last is not None else ('', [])
+                rows = db.select('select `%s`,`%s` from `%s` %s order by `%s` limit ? for update' % (pk, col, target.__table__, where, pk), *(args + [batch_size]))
+                if not rows:
+                    break
+                keys = [r[pk] for r in rows]
+                counts = dict(model.aggregate('where `%s` in (%s)' % (fk_col, ','.join(['?'] * len(keys))), *keys, group_by=fk, count='*'))
+                for r in rows:
+                    n = counts.get(r[pk], 0)
+                    if r[col] != n:
+                        logging.warning('[COUNTER] repair %s.%s of %s: %s => %s' % (target.__table__, col, r[pk], r[col], n))
+                        db.update('update `%s` set `%s`=? where `%s`=?' % (target.__table__, col, pk), n, r[pk])
+                        target._invalidate(r[pk])
+                        repaired += 1
+            last = keys[-1]
+            if pause:
+                time.sleep(pause)
+    return repaired
+
+
+def compress_column(model, field, batch_size=500, pause=0, alter=False):
+    """
+    把已有的行 改写为 CompressedTextField 的存储格式
+    alter: 先执行 alter table ... modify 把列改成字段的ddl（比如text ==> mediumblob）
+    按主键顺序分批读取，每批在一个事务中改写； update 时带上旧值作为条件，
+    读取之后被应用修改过的行 会被跳过（应用写入的值已经是新格式）
+    分片的Model 逐个分片执行， 返回改写的行数
+
+        compress_column(Blog, 'content', alter=True)
+    """
+    f = model.__mappings__[field]
+    if not f.to_db:
+        raise TypeError('Field %s.%s has no to_db conversion.' % (model.__name__, field))
+    pk = model.__primary_key__.name
+    col = f.name
+    n = 0
+    for engine in (model.__shard__.engines if model.__shard__ else [None]):
+        with db.use_engine(engine):
+            if alter:
+                db.update('alter table `%s` modify `%s` %s%s' % (model.__table__, col, f.ddl, '' if f.nullable else ' not null'))
+            last = None
+            while True:
+                where, args = ('where `%s`>?' % pk, [last]) if last is not None else ('', [])
+                rows = db.select('select `%s`,`%s` from `%s` %s order by `%s` limit ?' % (pk, col, model.__table__, where, pk), *(args + [batch_size]))
+                if not rows:
+                    break
+                changes = []
+                for r in rows:
+                    raw = r[col]
+                    if raw is None:
+                        continue
+                    if not isinstance(raw, basestring):
+                        raw = str(raw)
+                    # 未执行alter的text列读出来是unicode:
+                    value = f.to_db(raw)
+                    if value != (raw.encode('utf-8') if isinstance(raw, unicode) else raw):
+                        changes.append((r[pk], raw, value))
+                if changes:
+                    with db.transaction():
+                        for pk_value, raw, value in changes:
+                            if db.update('update `%s` set `%s`=? where `%s`=? and `%s`=?' % (model.__table__, col, pk, col), value, pk_value, raw):
+                                model._invalidate(pk_value)
+                                n += 1
+                last = rows[-1][pk]
+                logging.info('[COMPRESS] %s.%s: %d rows rewritten, last %s=%s' % (model.__table__, col, n, pk, last))
+                if pause:
+                    time.sleep(pause)
+    return n
+
+
+# 冗余字段propagator 每批改写的行数， 以及每批之间暂停的秒数
+DENORMALIZE_BATCH_SIZE = 500
+DENORMALIZE_PAUSE = 0.05
+
+
+class _Propagator(object):
+    """
+    后台改写冗余字段的线程：
+    源Model的一行被update之后， 对每个声明了 __denormalize__ 的Model，
+    按主键顺序每次取 batch_size 行 where 外键=?， 只改写值不一致的行， 每批之间暂停pause秒，
+    不会在请求中执行一个改写几百万行的大事务
+    改写时读取源Model中 当时的值， 所以同一行被连续修改多次时 排队中的任务只执行一次
+    """
+    def __init__(self, batch_size=DENORMALIZE_BATCH_SIZE, pause=DENORMALIZE_PAUSE):
+        self.batch_size = batch_size
+        self.pause = pause
+        self._lock = threading.Lock()
+        self._queue = OrderedDict()
+        self._event = threading.Event()
+        self._thread = None
+        self.current = None
+        self.jobs = 0
+        self.rows = 0
+        self.errors = 0
+
+    def submit(self, source, key):
+        """
+        登记 源Model source 中主键为key的行需要传播， 已经在队列中时合并， 保留最早的登记时间
+        """
+        with self._lock:
+            self._queue.setdefault((source, key), time.time())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='denormalize-propagator')
+                self._thread.daemon = True
+                self._thread.start()
+        self._event.set()
+
+    def _loop(self):
+        while True:
+            self._event.wait()
+            with self._lock:
+                if not self._queue:
+                    self._event.clear()
+                    continue
+                (source, key), _ = self._queue.popitem(last=False)
+            try:
+                self.run(source, key)
+            except Exception:
+                logging.exception('[DENORMALIZE] propagate %s %s failed.' % (source.__name__, key))
+                with self._lock:
+                    self.errors += 1
+
+    def run(self, source, key):
+        """
+        把 source 中主键为key的行 传播到所有冗余了它的Model， 返回改写的行数
+        """
+        row = source.get(key)
+        if row is None:
+            return 0
+        n = 0
+        for model, fk, fields in source.__dependents__:
+            copies = sorted(fields.iteritems())
+            values = [getattr(row, f) for _, f in copies]
+            if model.__shard__ is not None and model.__shard__.key == fk:
+                engines = [model.__shard__.engine_for(key)]
+            else:
+                engines = model.__shard__.engines if model.__shard__ else [None]
+            for engine in engines:
+                n += self._rewrite(model, fk, key, [model.__mappings__[c].name for c, _ in copies], values, engine)
+        with self._lock:
+            self.jobs += 1
+        return n
+
+    def _rewrite(self, model, fk, key, columns, values, engine):
+        table = model.__table__
+        pk = model.__primary_key__.name
+        fk_col = model.__mappings__[fk].name
+        differs = ' or '.join(['not (`%s` <=> ?)' % c for c in columns])
+        select = 'select `%s` from `%s` where `%s`=? and (%s)' % (pk, table, fk_col, differs)
+        n = 0
+        last = None
+        self.current = db.Dict(model=model.__name__, key=key, engine=engine, rows=0)
+        with db.use_engine(engine):
+            while True:
+                if last is None:
+                    rows = db.select('%s order by `%s` limit ?' % (select, pk), key, *(values + [self.batch_size]))
+                else:
+                    rows = db.select('%s and `%s`>? order by `%s` limit ?' % (select, pk, pk), key, *(values + [last, self.batch_size]))
+                if not rows:
+                    break
+                pks = [r[pk] for r in rows]
+                db.update('update `%s` set %s where `%s` in (%s)' % (table, ','.join(['`%s`=?' % c for c in columns]), pk, ','.join(['?'] * len(pks))), *(values + pks))
+                for v in pks:
+                    model._invalidate(v)
+                n += len(pks)
+                self.current.rows = n
+                with self._lock:
+                    self.rows += len(pks)
+                last = pks[-1]
+                if len(rows) < self.batch_size:
+                    break
+                if self.pause:
+                    time.sleep(self.pause)
+        self.current = None
+        if n:
+            logging.info('[DENORMALIZE] %s: %d rows of %s=%s rewritten.' % (table, n, fk_col, key))
+        return n
+
+    def stats(self):
+        """
+        返回进度： 排队中的任务数、最早排队的任务等待的秒数、正在执行的任务(已改写的行数)、
+        已完成的任务数、累计改写的行数、失败的任务数
+        """
+        with self._lock:
+            oldest = next(self._queue.itervalues(), None)
+            return db.Dict(pending=len(self._queue), lag=time.time() - oldest if oldest else 0.0,
+                           current=self.current, jobs=self.jobs, rows=self.rows, errors=self.errors)
+
+
+# 全局的冗余字段propagator
+propagator = _Propagator()
+
+
+def build_negative_cache(model, batch_size=1000):
+    """
+    按主键顺序分批扫描 model 的所有分片， 只读取主键和unique字段， 建立新的Bloom filter之后替换旧的，
+    filter的大小按 max(capacity, 行数 * 2) 分配； 扫描期间insert的值同时写入新的filter
+    启动时在后台线程中执行， 之后误判率升高时(比如删除了大量的行) 可以重新执行， 返回扫描的行数
+    """
+    nc = model.__negative_cache__
+    if nc is None:
+        raise TypeError('Model %s has no __negative_cache__.' % model.__name__)
+    table = model.__table__
+    pk = model.__primary_key__.name
+    engines = model.__shard__.engines if model.__shard__ else [None]
+    total = sum(db.scatter(engines, db.select_int, 'select count(*) from `%s`' % table))
+    capacity = max(nc.capacity, total * 2)
+    filters = dict((c, _BloomFilter(capacity, nc.error_rate)) for c in nc.columns)
+    # 开始扫描之前设置， 之后insert的值都会写入新的filter， 之前写入、扫描时还没提交的 提交后由recheck写入
+    nc.start_build(filters)
+    n = 0
+    try:
+        select = 'select %s from `%s`' % (','.join(['`%s`' % c for c in nc.columns]), table)
+        for engine in engines:
+            with db.use_engine(engine):
+                last = None
+                while True:
+                    if last is None:
+                        rows = db.select('%s order by `%s` limit ?' % (select, pk), batch_size)
+                    else:
+                        rows = db.select('%s where `%s`>? order by `%s` limit ?' % (select, pk, pk), last, batch_size)
+                    for r in rows:
+                        for c in nc.columns:
+                            if r[c] is not None:
+                                filters[c].add(nc._key(r[c]))
+                    n += len(rows)
+                    if len(rows) < batch_size:
+                        break
+                    last = rows[-1][pk]
+    except:
+        with nc._lock:
+            nc.building = None
+        raise
+    nc.swap(filters)
+    logging.info('[NEGATIVE CACHE] %s: %d rows loaded, %d bytes.' % (model.__name__, n, sum(len(f.bits) for f in filters.itervalues())))
+    return n
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('www-data', 'www-data', 'test', '192.168.10.128')
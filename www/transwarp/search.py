@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+search模块设计的原因：
+    1. 全文搜索
+        find_by('where content like ?') 需要扫描整张表，数据量大了以后无法使用
+        search模块维护一个 倒排索引： 词 ==> [(文档, 词频), ...]
+        查询时只需要读取 查询词 对应的倒排列表，再按BM25打分排序
+设计search接口：
+    1. 建立索引
+        from transwarp.search import SearchIndex
+        index = SearchIndex(fields=dict(name=3, summary=2, content=1))
+        index.open('/srv/awesome/search')      # 从磁盘加载已有的段，不调用则只在内存中
+        index.add(blog.id, blog)               # 新增或替换文档
+        index.remove(blog.id)                  # 删除文档
+    2. 查询
+        total, hits = index.search(u'python 教程', page=1, size=10)
+        # hits => [(doc_id, score), ...]
+    3. 存储
+        新增的文档先写入内存中的缓冲区，达到 flush_docs 篇后写成一个不可变的段（segment），
+        段的数量超过 max_segments 时合并成一个段。
+        段文件为zlib压缩的marshal数据：
+            (版本, [文档id, ...], [文档长度, ...], {词: 倒排列表})
+        倒排列表 为 (文档序号差值, 词频) 交替排列的varint字节串
+        删除的文档记录在 段名.del 文件中，合并时才真正删除
+        segments 文件记录当前所有的段，通过 写临时文件 + rename 原子地替换
+    4. 多进程
+        多个进程打开同一个目录时， 只有拿到 write.lock 文件锁的进程写段文件（writable为True），
+        其他进程只读： add/remove 把分析后的文档写到 incoming/ 目录， 由写进程在flush时读入；
+        只读进程在后台线程中 发现段文件变化后重新加载， 写进程退出后 由某个只读进程接替
+"""
+
+import os
+import re
+import math
+import zlib
+import time
+import fcntl
+import heapq
+import marshal
+import logging
+import threading
+
+
+# 段文件格式的版本号
+_SEGMENT_VERSION = 1
+
+_RE_WORD = re.compile(ur'[a-z0-9]+|[一-鿿㐀-䶿]+', re.U)
+
+
+def tokenize(text):
+    """
+    分词：
+        英文和数字 按单词切分，转成小写
+        中文 同时生成单字和相邻两字(bigram)，这样单字和词语都能搜到
+
+    >>> tokenize(u'Hello, World 2015')
+    [u'hello', u'world', u'2015']
+    >>> tokenize(u'\\u5b66\\u4e60Python\\u6559\\u7a0b')
+    [u'\\u5b66', u'\\u5b66\\u4e60', u'\\u4e60', u'python', u'\\u6559', u'\\u6559\\u7a0b', u'\\u7a0b']
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    L = []
+    for w in _RE_WORD.findall(text.lower()):
+        if w[0] < u'㐀':
+            L.append(w)
+            continue
+        for i, ch in enumerate(w):
+            L.append(ch)
+            if i + 1 < len(w):
+                L.append(w[i:i + 2])
+    return L
+
+
+def _encode(postings):
+    """
+    把 [(docnum, tf), ...] (docnum递增) 编码为varint字节串
+
+    >>> _decode(_encode([(0, 1), (3, 200), (1000, 2)]))
+    [(0, 1), (3, 200), (1000, 2)]
+    """
+    buf = bytearray()
+    last = 0
+    for docnum, tf in postings:
+        for n in (docnum - last, tf):
+            while n > 0x7f:
+                buf.append((n & 0x7f) | 0x80)
+                n >>= 7
+            buf.append(n)
+        last = docnum
+    return str(buf)
+
+
+def _decode(data):
+    """
+    解码 _encode 生成的字节串
+    """
+    L = []
+    buf = bytearray(data)
+    n = shift = 0
+    values = []
+    for b in buf:
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        values.append(n)
+        n = shift = 0
+    last = 0
+    for i in xrange(0, len(values), 2):
+        last += values[i]
+        L.append((last, values[i + 1]))
+    return L
+
+
+class _Segment(object):
+    """
+    不可变的索引段
+    doc_ids: 文档序号 ==> 文档id
+    doc_lens: 文档序号 ==> 文档长度（按字段权重加权的词数）
+    postings: 词 ==> 编码后的倒排列表
+    deleted: 已删除的文档序号
+    """
+    def __init__(self, name, doc_ids, doc_lens, postings, deleted=()):
+        self.name = name
+        self.doc_ids = doc_ids
+        self.doc_lens = doc_lens
+        self.postings = postings
+        self.deleted = set(deleted)
+        self._docnums = None
+        self.live_docs = len(doc_ids) - len(self.deleted)
+        self.live_len = sum(doc_lens) - sum(doc_lens[n] for n in self.deleted)
+
+    def docnum(self, doc_id):
+        if self._docnums is None:
+            self._docnums = dict((d, n) for n, d in enumerate(self.doc_ids))
+        return self._docnums.get(doc_id)
+
+    def delete(self, doc_id):
+        """
+        标记删除文档， 返回是否删除了文档
+        """
+        n = self.docnum(doc_id)
+        if n is None or n in self.deleted:
+            return False
+        self.deleted.add(n)
+        self.live_docs -= 1
+        self.live_len -= self.doc_lens[n]
+        return True
+
+    def terms(self, term):
+        """
+        返回词的倒排列表 [(doc_id, doc_len, tf), ...]， 跳过已删除的文档
+        """
+        data = self.postings.get(term)
+        if data is None:
+            return []
+        deleted = self.deleted
+        return [(self.doc_ids[n], self.doc_lens[n], tf) for n, tf in _decode(data) if n not in deleted]
+
+    def docs(self):
+        """
+        遍历未删除的文档， 用于合并: 返回 {docnum: {term: tf}}
+        """
+        docs = {}
+        for term, data in self.postings.iteritems():
+            for n, tf in _decode(data):
+                if n not in self.deleted:
+                    docs.setdefault(n, {})[term] = tf
+        return docs
+
+    def dump(self, path):
+        data = zlib.compress(marshal.dumps((_SEGMENT_VERSION, self.doc_ids, self.doc_lens, self.postings)))
+        write_atomic(os.path.join(path, '%s.seg' % self.name), data)
+        self.dump_deleted(path)
+
+    def dump_deleted(self, path):
+        write_atomic(os.path.join(path, '%s.del' % self.name), marshal.dumps(sorted(self.deleted)))
+
+    @staticmethod
+    def load(path, name):
+        with open(os.path.join(path, '%s.seg' % name), 'rb') as f:
+            version, doc_ids, doc_lens, postings = marshal.loads(zlib.decompress(f.read()))
+        if version != _SEGMENT_VERSION:
+            raise ValueError('Unsupported segment version %s: %s' % (version, name))
+        deleted = ()
+        fdel = os.path.join(path, '%s.del' % name)
+        if os.path.isfile(fdel):
+            with open(fdel, 'rb') as f:
+                deleted = marshal.loads(f.read())
+        return _Segment(name, doc_ids, doc_lens, postings, deleted)
+
+
+def write_atomic(fpath, data):
+    """
+    先写临时文件 再rename，避免进程崩溃时留下写了一半的文件
+    """
+    tmp = '%s.tmp' % fpath
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, fpath)
+
+
+def _build_segment(name, docs):
+    """
+    docs: [(doc_id, doc_len, {term: tf}), ...] ==> _Segment
+    """
+    doc_ids = []
+    doc_lens = []
+    terms = {}
+    for n, (doc_id, doc_len, tfs) in enumerate(docs):
+        doc_ids.append(doc_id)
+        doc_lens.append(doc_len)
+        for term, tf in tfs.iteritems():
+            terms.setdefault(term, []).append((n, tf))
+    postings = dict((term, _encode(L)) for term, L in terms.iteritems())
+    return _Segment(name, doc_ids, doc_lens, postings)
+
+
+class SearchIndex(object):
+    """
+    增量更新的倒排索引
+    fields: 字段名 ==> 权重(整数)， 同一个词出现在权重高的字段中 得分更高
+    flush_docs: 内存缓冲区中的文档数 达到该值时写成段
+    max_segments: 段的数量超过该值时 合并所有段
+    k1, b: BM25 的参数
+    """
+    def __init__(self, fields, flush_docs=1000, max_segments=8, k1=1.2, b=0.75):
+        self.fields = fields
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.k1 = k1
+        self.b = b
+        self._path = None
+        self._lock = threading.RLock()
+        self._segments = []
+        self._next_gen = 0
+        # 内存缓冲区: doc_id ==> (doc_len, {term: tf})
+        self._buffer = {}
+        self._buffer_postings = {}
+        self._timer = None
+        # 是否可以写段文件， 只在内存中的索引总是可写
+        self.writable = True
+        self._lock_file = None
+        self._signature = None
+        self._spooled = 0
+
+    def open(self, path):
+        """
+        从目录中加载已有的段， 之后flush的段都写到该目录
+        其他进程已经打开了该目录时 以只读方式打开
+        """
+        with self._lock:
+            if not os.path.isdir(os.path.join(path, 'incoming')):
+                os.makedirs(os.path.join(path, 'incoming'))
+            self._path = path
+            self._try_lock()
+            self._load()
+            logging.info('[SEARCH] open index %s (%s): %d segments, %d docs.' % (path, 'writable' if self.writable else 'read-only', len(self._segments), len(self)))
+
+    def _try_lock(self):
+        """
+        尝试获得写锁， 锁由操作系统在进程退出时释放
+        """
+        f = open(os.path.join(self._path, 'write.lock'), 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            self.writable = False
+            return False
+        self._lock_file = f
+        self.writable = True
+        return True
+
+    def _files_signature(self):
+        """
+        segments 和所有 .del 文件的修改时间， 只读进程用来判断是否需要重新加载
+        """
+        def mtime(name):
+            try:
+                return os.stat(os.path.join(self._path, name)).st_mtime
+            except OSError:
+                return None
+        return [mtime('segments')] + [mtime('%s.del' % seg.name) for seg in self._segments]
+
+    def _load(self):
+        fseg = os.path.join(self._path, 'segments')
+        if os.path.isfile(fseg):
+            with open(fseg, 'rb') as f:
+                self._next_gen, names = marshal.loads(f.read())
+            self._segments = [_Segment.load(self._path, name) for name in names]
+        self._signature = self._files_signature()
+
+    def reload(self):
+        """
+        只读进程： 段文件有变化时重新加载
+        """
+        with self._lock:
+            if self._files_signature() == self._signature:
+                return
+            try:
+                self._load()
+            except (IOError, OSError):
+                # 写进程正在合并， 段文件已经被删除， 下次再加载:
+                logging.info('[SEARCH] segments changed while reloading, retry later.')
+                return
+            logging.info('[SEARCH] reload index %s: %d segments, %d docs.' % (self._path, len(self._segments), len(self)))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buffer) + sum(seg.live_docs for seg in self._segments)
+
+    def _analyze(self, doc):
+        """
+        返回文档的 (加权长度, {term: 加权词频})
+        Model 是dict的子类， 但 Model.get 是按主键查询的classmethod， 所以用 doc[field] 读取，
+        同时经过 _lazy_getitem 解压 CompressedTextField
+
+        >>> from orm import Model, IntegerField, StringField, CompressedTextField, compress_text
+        >>> class SearchDoc(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        ...     content = CompressedTextField(threshold=0)
+        >>> doc = SearchDoc._from_row(dict(id=1, name=u'Python', content=compress_text(u'python tutorial', 0)))
+        >>> index = SearchIndex(fields=dict(name=3, content=1, summary=2))
+        >>> index._analyze(doc)
+        (5, {u'python': 4, u'tutorial': 1})
+        """
+        tfs = {}
+        for field, weight in self.fields.iteritems():
+            if isinstance(doc, dict):
+                value = doc[field] if field in doc else None
+            else:
+                value = getattr(doc, field, None)
+            if not value:
+                continue
+            for term in tokenize(value):
+                tfs[term] = tfs.get(term, 0) + weight
+        return sum(tfs.itervalues()), tfs
+
+    def _remove(self, doc_id):
+        """
+        从缓冲区和所有段中删除文档， 返回发生了删除的段
+        """
+        old = self._buffer.pop(doc_id, None)
+        if old is not None:
+            for term in old[1]:
+                L = self._buffer_postings[term]
+                del L[doc_id]
+                if not L:
+                    del self._buffer_postings[term]
+        return [seg for seg in self._segments if seg.delete(doc_id)]
+
+    def add(self, doc_id, doc):
+        """
+        新增文档，已存在时替换
+        doc: dict 或者 Model实例， 从中读取 fields 中的字段
+        只读进程中 写到incoming/目录， 写进程flush之后 所有进程reload时才能搜索到
+        """
+        doc_len, tfs = self._analyze(doc)
+        with self._lock:
+            if not self.writable:
+                self._spool(('add', doc_id, doc_len, tfs))
+                return
+            self._add(doc_id, doc_len, tfs)
+            if len(self._buffer) >= self.flush_docs:
+                self.flush()
+
+    def _add(self, doc_id, doc_len, tfs):
+        changed = self._remove(doc_id)
+        self._buffer[doc_id] = (doc_len, tfs)
+        for term, tf in tfs.iteritems():
+            self._buffer_postings.setdefault(term, {})[doc_id] = tf
+        self._save_deleted(changed)
+
+    def remove(self, doc_id):
+        with self._lock:
+            if not self.writable:
+                self._spool(('remove', doc_id))
+                return
+            self._save_deleted(self._remove(doc_id))
+
+    def _spool(self, record):
+        """
+        只读进程： 把修改写到incoming/目录， 文件名按时间排序， 写进程按顺序读入
+        """
+        self._spooled += 1
+        name = '%017.6f-%d-%d' % (time.time(), os.getpid(), self._spooled)
+        write_atomic(os.path.join(self._path, 'incoming', name), marshal.dumps(record))
+
+    def _ingest(self):
+        """
+        写进程： 读入其他进程写到incoming/目录的修改
+        """
+        incoming = os.path.join(self._path, 'incoming')
+        names = sorted(n for n in os.listdir(incoming) if not n.endswith('.tmp'))
+        for name in names:
+            fpath = os.path.join(incoming, name)
+            with open(fpath, 'rb') as f:
+                record = marshal.loads(f.read())
+            if record[0] == 'add':
+                self._add(*record[1:])
+            else:
+                self._save_deleted(self._remove(record[1]))
+            os.remove(fpath)
+        if names:
+            logging.info('[SEARCH] ingest %d changes from other processes.' % len(names))
+
+    def _save_deleted(self, segments):
+        if self._path:
+            for seg in segments:
+                seg.dump_deleted(self._path)
+
+    def _save_manifest(self):
+        if self._path:
+            write_atomic(os.path.join(self._path, 'segments'), marshal.dumps((self._next_gen, [seg.name for seg in self._segments])))
+
+    def _new_name(self):
+        name = 'seg_%d' % self._next_gen
+        self._next_gen += 1
+        return name
+
+    def flush(self):
+        """
+        把内存缓冲区写成一个新的段， 段太多时合并
+        只读进程中 尝试接替已经退出的写进程， 否则按需重新加载
+        """
+        with self._lock:
+            if not self.writable:
+                if not self._try_lock():
+                    self.reload()
+                    return
+                logging.info('[SEARCH] take over writing of index %s.' % self._path)
+                self._load()
+            if self._path:
+                self._ingest()
+            if self._buffer:
+                docs = [(doc_id, doc_len, tfs) for doc_id, (doc_len, tfs) in self._buffer.iteritems()]
+                seg = _build_segment(self._new_name(), docs)
+                if self._path:
+                    seg.dump(self._path)
+                self._segments.append(seg)
+                self._buffer = {}
+                self._buffer_postings = {}
+                self._save_manifest()
+                logging.info('[SEARCH] flush %d docs to %s.' % (len(docs), seg.name))
+            if len(self._segments) > self.max_segments:
+                self.merge()
+
+    def merge(self):
+        """
+        把所有段合并成一个， 同时真正删除已标记删除的文档
+        """
+        with self._lock:
+            if len(self._segments) < 2:
+                return
+            old = self._segments
+            docs = []
+            for seg in old:
+                for n, tfs in sorted(seg.docs().iteritems()):
+                    docs.append((seg.doc_ids[n], seg.doc_lens[n], tfs))
+            seg = _build_segment(self._new_name(), docs)
+            if self._path:
+                seg.dump(self._path)
+            self._segments = [seg]
+            self._save_manifest()
+            if self._path:
+                for s in old:
+                    for ext in ('seg', 'del'):
+                        fpath = os.path.join(self._path, '%s.%s' % (s.name, ext))
+                        if os.path.isfile(fpath):
+                            os.remove(fpath)
+            logging.info('[SEARCH] merge %d segments into %s: %d docs.' % (len(old), seg.name, len(docs)))
+
+    def rebuild(self, docs, id_field='id'):
+        """
+        清空索引， 然后从docs（可迭代的dict或Model实例） 重建， 只能在写进程中调用
+        """
+        with self._lock:
+            if not self.writable:
+                raise IOError('Search index %s is read-only in this process.' % self._path)
+            old, self._segments = self._segments, []
+            self._buffer = {}
+            self._buffer_postings = {}
+            for doc in docs:
+                self.add(doc[id_field], doc)
+            self.flush()
+            self.merge()
+            if self._path:
+                for s in old:
+                    for ext in ('seg', 'del'):
+                        fpath = os.path.join(self._path, '%s.%s' % (s.name, ext))
+                        if os.path.isfile(fpath):
+                            os.remove(fpath)
+
+    def start(self, interval=30):
+        """
+        启动后台线程， 每隔interval秒 flush一次缓冲区 并按需合并段， 只读进程中为重新加载
+        """
+        def _run():
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('[SEARCH] flush failed.')
+            self.start(interval)
+        self._timer = threading.Timer(interval, _run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
+
+    def search(self, query, page=1, size=10):
+        """
+        按BM25 打分，返回 (命中的文档数, [(doc_id, score), ...]) 其中列表为第page页的结果
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return 0, []
+        scores = {}
+        with self._lock:
+            total_docs = len(self._buffer) + sum(seg.live_docs for seg in self._segments)
+            if total_docs == 0:
+                return 0, []
+            total_len = sum(l for l, _ in self._buffer.itervalues()) + sum(seg.live_len for seg in self._segments)
+            avgdl = float(total_len) / total_docs or 1.0
+            for term in terms:
+                L = [(doc_id, self._buffer[doc_id][0], tf) for doc_id, tf in self._buffer_postings.get(term, {}).iteritems()]
+                for seg in self._segments:
+                    L.extend(seg.terms(term))
+                if not L:
+                    continue
+                idf = math.log(1.0 + (total_docs - len(L) + 0.5) / (len(L) + 0.5))
+                k1, b = self.k1, self.b
+                for doc_id, doc_len, tf in L:
+                    s = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len / avgdl))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + s
+        start = (page - 1) * size
+        top = heapq.nlargest(start + size, scores.iteritems(), key=lambda x: x[1])
+        return len(scores), top[start:]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -37,7 +37,9 @@ WSGI概要：
     5. 事物数据：request数据和response数据的封装（thread local）
 """
 
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, traceback, urllib
+import types, os, re, cgi, sys, json, stat, time, zlib, shutil, urllib, hashlib, tempfile, urlparse, datetime, functools, mimetypes, threading, logging, traceback
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from collections import OrderedDict
 
 from db import Dict
 import utils
@@ -62,6 +64,17 @@ _HEADER_X_POWERED_BY = ('X-Powered-By', 'transwarp/1.0')
 _TIMEDELTA_ZERO = datetime.timedelta(0)
 _RE_TZ = re.compile('^([\+\-])([0-9]{1,2})\:([0-9]{1,2})$')
 
+# 请求body的大小限制， multipart(文件上传)单独限制
+MAX_BODY_SIZE = 1024 * 1024
+MAX_MULTIPART_SIZE = 100 * 1024 * 1024
+
+# 上传文件： 单个文件的大小限制， 超过 MULTIPART_SPOOL_SIZE 时从内存转到 MULTIPART_TMP_DIR 下的临时文件，
+# MULTIPART_TMP_DIR 和保存上传文件的目录在同一个文件系统上时 save() 只需要rename
+MULTIPART_MAX_FILE_SIZE = 20 * 1024 * 1024
+MULTIPART_SPOOL_SIZE = 256 * 1024
+MULTIPART_TMP_DIR = None
+MULTIPART_HASH = 'sha1'
+
 # response status
 _RESPONSE_STATUSES = {
     # Informational
@@ -306,10 +319,30 @@ class _RedirectError(_HttpError):
     __repr__ = __str__
 
 
+class _NotModified(_HttpError):
+    """
+    304 响应没有body
+    """
+    def __init__(self):
+        super(_NotModified, self).__init__(304)
+
+
 class HttpError(object):
     """
     HTTP Exceptions
     """
+    @staticmethod
+    def notmodified():
+        """
+        Send a not modified response.
+
+        >>> raise HttpError.notmodified()
+        Traceback (most recent call last):
+          ...
+        _NotModified: 304 Not Modified
+        """
+        return _NotModified()
+
     @staticmethod
     def badrequest():
         """
@@ -369,6 +402,30 @@ class HttpError(object):
         """
         return _HttpError(409)
 
+    @staticmethod
+    def toolarge():
+        """
+        Send a request entity too large response.
+
+        >>> raise HttpError.toolarge()
+        Traceback (most recent call last):
+          ...
+        _HttpError: 413 Request Entity Too Large
+        """
+        return _HttpError(413)
+
+    @staticmethod
+    def methodnotallowed():
+        """
+        Send a method not allowed response.
+
+        >>> raise HttpError.methodnotallowed()
+        Traceback (most recent call last):
+          ...
+        _HttpError: 405 Method Not Allowed
+        """
+        return _HttpError(405)
+
     @staticmethod
     def internalerror():
         """
@@ -427,7 +484,12 @@ _RESPONSE_HEADER_DICT = dict(zip(map(lambda x: x.upper(), _RESPONSE_HEADERS), _R
 class Request(object):
     """
     请求对象， 用于获取所有http请求信息。
+    每个请求都会创建， 所以用 __slots__ 并且所有数据都在第一次用到时才解析：
+    header 和 cookie 只解码取到的那一个。
+    user 是给拦截器保存当前用户的。
     """
+    __slots__ = ('_environ', '_path_info', '_headers', '_all_headers', '_cookies', '_all_cookies',
+                 '_raw_input', '_body', '_json', '_files', 'user')
 
     def __init__(self, environ):
         """
@@ -436,25 +498,78 @@ class Request(object):
         包含了用户请求的所有数据
         """
         self._environ = environ
+        self._path_info = None
+        self._headers = None
+        self._cookies = None
 
     def _parse_input(self):
         """
         将通过wsgi 传入过来的参数，解析成一个字典对象 返回
         比如： Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('a=1&b=M%20M&c=ABC&c=XYZ&e=')})
             这里解析的就是 wsgi.input 对象里面的字节流
-        """
-        def _convert(item):
-            if isinstance(item, list):
-                return [utils.to_unicode(i.value) for i in item]
-            if item.filename:
-                return MultipartFile(item)
-            return utils.to_unicode(item.value)
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
+        按Content-Type选择解析方式：
+            multipart/form-data 才用 cgi.FieldStorage；
+            urlencoded(或没有Content-Type)的body 和 query string 直接用 urlparse 解析；
+            其他类型(比如json)的body不作为参数， 通过 get_body() 或 json 属性获取。
+        和 FieldStorage 一样， body里的参数排在 query string 的参数之前。
+        """
+        ctype = self._content_type()
+        if ctype == 'multipart/form-data':
+            inputs = self._parse_multipart()
+            _parse_qs(self._environ.get('QUERY_STRING', ''), inputs)
+            return inputs
+        inputs = dict()
+        if ctype in ('', 'application/x-www-form-urlencoded') and self._environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            _parse_qs(self._read_body(), inputs)
+        _parse_qs(self._environ.get('QUERY_STRING', ''), inputs)
+        return inputs
+
+    def _parse_multipart(self):
+        length = self._content_length()
+        if length is not None and length > MAX_MULTIPART_SIZE:
+            raise HttpError.toolarge()
+        boundary = cgi.parse_header(self._environ.get('CONTENT_TYPE', ''))[1].get('boundary')
+        if not boundary:
+            raise HttpError.badrequest()
         inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        self._files = []
+        _parse_multipart(self._environ['wsgi.input'], boundary, length, inputs, self._files)
         return inputs
 
+    def close(self):
+        """
+        删除上传文件中没有 save() 的临时文件， 请求处理完后调用
+        """
+        for f in getattr(self, '_files', ()):
+            f.close()
+
+    def _content_type(self):
+        """
+        不带参数的小写 Content-Type， 比如 'multipart/form-data'
+        """
+        return self._environ.get('CONTENT_TYPE', '').split(';', 1)[0].strip().lower()
+
+    def _content_length(self):
+        try:
+            return int(self._environ['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return None
+
+    def _read_body(self):
+        """
+        读取并缓存 body， 超过 MAX_BODY_SIZE 时返回 413
+        """
+        if not hasattr(self, '_body'):
+            length = self._content_length()
+            if length is not None and length > MAX_BODY_SIZE:
+                raise HttpError.toolarge()
+            fp = self._environ['wsgi.input']
+            body = fp.read(length if length is not None else MAX_BODY_SIZE + 1)
+            if len(body) > MAX_BODY_SIZE:
+                raise HttpError.toolarge()
+            self._body = body
+        return self._body
+
     def _get_raw_input(self):
         """
         将从wsgi解析出来的 数据字典，添加为Request对象的属性
@@ -572,9 +687,37 @@ class Request(object):
         >>> r = Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('<xml><raw/>')})
         >>> r.get_body()
         '<xml><raw/>'
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_LENGTH':str(MAX_BODY_SIZE + 1), 'wsgi.input':StringIO('')})
+        >>> r.get_body()
+        Traceback (most recent call last):
+          ...
+        _HttpError: 413 Request Entity Too Large
         """
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        return self._read_body()
+
+    @property
+    def json(self):
+        """
+        把 json 格式的 body 解析成对象， 没有 body 时为 None， 不是合法的 json 时返回 400
+
+        >>> from StringIO import StringIO
+        >>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/json', 'QUERY_STRING':'page=2', 'wsgi.input':StringIO('{"name": "Bob", "tags": [1, 2]}')})
+        >>> r.json['name'], r.json['tags']
+        (u'Bob', [1, 2])
+        >>> r.get('name'), r.get('page')
+        (None, u'2')
+        >>> Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('{bad')}).json
+        Traceback (most recent call last):
+          ...
+        _HttpError: 400 Bad Request
+        """
+        if not hasattr(self, '_json'):
+            body = self._read_body()
+            try:
+                self._json = json.loads(body) if body else None
+            except ValueError:
+                raise HttpError.badrequest()
+        return self._json
 
     @property
     def remote_addr(self):
@@ -645,7 +788,9 @@ class Request(object):
         >>> r.path_info
         '/test/a b.html'
         """
-        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+        if self._path_info is None:
+            self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
 
     @property
     def host(self):
@@ -657,23 +802,11 @@ class Request(object):
         """
         return self._environ.get('HTTP_HOST', '')
 
-    def _get_headers(self):
-        """
-        从environ里 取得HTTP_开通的 header
-        """
-        if not hasattr(self, '_headers'):
-            hdrs = {}
-            for k, v in self._environ.iteritems():
-                if k.startswith('HTTP_'):
-                    # convert 'HTTP_ACCEPT_ENCODING' to 'ACCEPT-ENCODING'
-                    hdrs[k[5:].replace('_', '-').upper()] = v.decode('utf-8')
-            self._headers = hdrs
-        return self._headers
-
     @property
     def headers(self):
         """
         获取所有的header， setter实现的属性
+        第一次访问时解码environ里所有 HTTP_ 开头的值并缓存， 返回的dict是共享的， 不要修改
         Get all HTTP headers with key as str and value as unicode. The header names are 'XXX-XXX' uppercase.
         >>> r = Request({'HTTP_USER_AGENT': 'Mozilla/5.0', 'HTTP_ACCEPT': 'text/html'})
         >>> H = r.headers
@@ -685,8 +818,19 @@ class Request(object):
         >>> L.sort()
         >>> L
         [('ACCEPT', u'text/html'), ('USER-AGENT', u'Mozilla/5.0')]
+        >>> r.headers is H
+        True
         """
-        return dict(**self._get_headers())
+        if not hasattr(self, '_all_headers'):
+            hdrs = self._headers or {}
+            for k, v in self._environ.iteritems():
+                if k.startswith('HTTP_'):
+                    # convert 'HTTP_ACCEPT_ENCODING' to 'ACCEPT-ENCODING'
+                    key = k[5:].replace('_', '-')
+                    if key not in hdrs:
+                        hdrs[key] = v.decode('utf-8')
+            self._headers = self._all_headers = hdrs
+        return self._all_headers
 
     def header(self, header, default=None):
         """
@@ -704,20 +848,32 @@ class Request(object):
         >>> r.header('Test', u'DEFAULT')
         u'DEFAULT'
         """
-        return self._get_headers().get(header.upper(), default)
+        key = header.upper()
+        hdrs = self._headers
+        if hdrs is None:
+            hdrs = self._headers = {}
+        else:
+            v = hdrs.get(key)
+            if v is not None:
+                return v
+        v = self._environ.get('HTTP_' + key.replace('-', '_'))
+        if v is None:
+            return default
+        v = hdrs[key] = v.decode('utf-8')
+        return v
 
     def _get_cookies(self):
         """
-        从environ里取出cookies字符串，并解析成键值对 组成的字典
+        从environ里取出cookies字符串，并解析成 名字 -> 没有解码的值 组成的字典
         """
-        if not hasattr(self, '_cookies'):
+        if self._cookies is None:
             cookies = {}
             cookie_str = self._environ.get('HTTP_COOKIE')
             if cookie_str:
                 for c in cookie_str.split(';'):
                     pos = c.find('=')
                     if pos > 0:
-                        cookies[c[:pos].strip()] = utils.unquote(c[pos+1:])
+                        cookies[c[:pos].strip()] = c[pos+1:]
             self._cookies = cookies
         return self._cookies
 
@@ -732,7 +888,10 @@ class Request(object):
         >>> r.cookies['url']
         u'http://www.example.com/'
         """
-        return Dict(**self._get_cookies())
+        if not hasattr(self, '_all_cookies'):
+            cookies = self._get_cookies()
+            self._all_cookies = Dict(cookies.keys(), [utils.unquote(v) for v in cookies.itervalues()])
+        return self._all_cookies
 
     def cookie(self, name, default=None):
         """
@@ -747,14 +906,169 @@ class Request(object):
         >>> r.cookie('test', u'DEFAULT')
         u'DEFAULT'
         """
-        return self._get_cookies().get(name, default)
+        v = self._get_cookies().get(name)
+        if v is None:
+            return default
+        return utils.unquote(v)
+
+
+def _add_input(inputs, key, value):
+    """
+    一个key有多个值时保存为list
+    """
+    old = inputs.get(key)
+    if old is None:
+        inputs[key] = value
+    elif isinstance(old, list):
+        old.append(value)
+    else:
+        inputs[key] = [old, value]
+
+
+def _parse_qs(qs, inputs):
+    """
+    解析 urlencoded 的参数到 inputs
+
+    >>> inputs = {}
+    >>> _parse_qs('a=1&b=M%20M&c=ABC&c=XYZ&e=&n=%E4%B8%AD', inputs)
+    >>> sorted(inputs.items())
+    [('a', u'1'), ('b', u'M M'), ('c', [u'ABC', u'XYZ']), ('e', u''), ('n', u'\u4e2d')]
+    """
+    if not qs:
+        return
+    for k, v in urlparse.parse_qsl(qs, keep_blank_values=True):
+        _add_input(inputs, k, utils.to_unicode(v))
+
+
+_MULTIPART_CHUNK = 64 * 1024
+_MULTIPART_MAX_HEADER = 16 * 1024
+
+
+def _parse_multipart(fp, boundary, length, inputs, files):
+    """
+    流式解析 multipart/form-data：
+        每次从 fp 读取 _MULTIPART_CHUNK 字节， 只在内存里保留分隔符可能跨块的一小段，
+        普通字段保存到 inputs， 文件边读边写入 MultipartFile 并计算摘要，
+        总大小、单个文件和字段的大小超过限制时立即返回 413。
+    新建的 MultipartFile 马上加入 files， 出错时调用者可以清理临时文件。
+    分隔符前的换行可以是 CRLF 也可以是 LF， 按第一个分隔符所在行的换行判断，
+    所以 LF 分隔的内容以 '\\r' 结尾时不会被截掉。
+
+    >>> body = '--B\\r\\nContent-Disposition: form-data; name="a"\\r\\n\\r\\n1\\r\\n--B\\r\\nContent-Disposition: form-data; name="f"; filename="x.txt"\\r\\nContent-Type: text/plain\\r\\n\\r\\nline1\\r\\nline2\\r\\n--B--\\r\\n'
+    >>> inputs, files = {}, []
+    >>> _parse_multipart(StringIO(body), 'B', len(body), inputs, files)
+    >>> inputs['a']
+    u'1'
+    >>> f = inputs['f']
+    >>> f.filename, f.content_type, f.size, f.hexdigest
+    (u'x.txt', 'text/plain', 12, '2e8b459e11acdf2861942e27e7651513578e8c7d')
+    >>> f.file.read()
+    'line1\\r\\nline2'
+    >>> body = '--B\\nContent-Disposition: form-data; name="f"; filename="x.txt"\\n\\nline1\\r\\n--B--\\n'
+    >>> inputs, files = {}, []
+    >>> _parse_multipart(StringIO(body), 'B', len(body), inputs, files)
+    >>> inputs['f'].file.read()
+    'line1\\r'
+    """
+    read = [0]
+    # 分隔符前的换行是否为 CRLF
+    crlf = None
+
+    def _more(buf):
+        n = _MULTIPART_CHUNK if length is None else min(_MULTIPART_CHUNK, length - read[0])
+        data = fp.read(n) if n > 0 else ''
+        if not data:
+            raise HttpError.badrequest()
+        read[0] += len(data)
+        if read[0] > MAX_MULTIPART_SIZE:
+            raise HttpError.toolarge()
+        return buf + data
+
+    sep = '\n--' + boundary
+    # 在开头补一个换行， 这样第一个分隔符和后面的一样都是 '\n--boundary'
+    buf = '\n'
+    while True:
+        i = buf.find(sep)
+        if i >= 0:
+            buf = buf[i + len(sep):]
+            break
+        buf = _more(buf[-len(sep):])
+    while True:
+        # 分隔符后面是 '--' 表示结束， 否则跳过这一行
+        while len(buf) < 2 or (not buf.startswith('--') and buf.find('\n') < 0):
+            buf = _more(buf)
+        if buf.startswith('--'):
+            return
+        i = buf.find('\n')
+        if crlf is None:
+            crlf = buf[:i].endswith('\r')
+        buf = buf[i + 1:]
+        headers = {}
+        while True:
+            i = buf.find('\n')
+            while i < 0:
+                if len(buf) > _MULTIPART_MAX_HEADER:
+                    raise HttpError.badrequest()
+                buf = _more(buf)
+                i = buf.find('\n')
+            line = buf[:i].rstrip('\r')
+            buf = buf[i + 1:]
+            if not line:
+                break
+            k, _, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        params = cgi.parse_header(headers.get('content-disposition', ''))[1]
+        name, filename = params.get('name'), params.get('filename')
+        if filename is not None:
+            part = MultipartFile._create(name, filename, headers.get('content-type', 'application/octet-stream'))
+            files.append(part)
+            write = part._write
+        else:
+            part = []
+
+            def write(data, part=part, size=[0]):
+                size[0] += len(data)
+                if size[0] > MAX_BODY_SIZE:
+                    raise HttpError.toolarge()
+                part.append(data)
+        # 可能是分隔符开头的尾部(包括前面的 '\r')留在buf里， 其余的写出去
+        keep = len(sep) + 1
+        while True:
+            i = buf.find(sep)
+            if i >= 0:
+                data = buf[:i]
+                write(data[:-1] if crlf and data.endswith('\r') else data)
+                buf = buf[i + len(sep):]
+                break
+            if len(buf) > keep:
+                write(buf[:-keep])
+                buf = buf[-keep:]
+            buf = _more(buf)
+        if name is None:
+            continue
+        if filename is not None:
+            part._done()
+            _add_input(inputs, name, part)
+        else:
+            _add_input(inputs, name, utils.to_unicode(''.join(part)))
+
+
+_HEADER_CONTENT_TYPE_HTML = ('Content-Type', 'text/html; charset=utf-8')
 
 
 class Response(object):
+    """
+    响应对象， header 以 大写名字 -> (规范的名字, 值) 保存， 输出时不需要再转换
+    """
+    __slots__ = ('_status', '_headers', '_cookies', '_etag', '_gzip')
 
     def __init__(self):
         self._status = '200 OK'
-        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._headers = {'CONTENT-TYPE': _HEADER_CONTENT_TYPE_HTML}
+        self._cookies = None
+        self._etag = False
+        # 为False时 wsgi() 不再压缩， 比如静态文件自己处理了压缩
+        self._gzip = True
 
     def unset_header(self, name):
         """
@@ -784,9 +1098,10 @@ class Response(object):
         'image/png'
         """
         key = name.upper()
-        if key not in _RESPONSE_HEADER_DICT:
-            key = name
-        self._headers[key] = utils.to_str(value)
+        canonical = _RESPONSE_HEADER_DICT.get(key)
+        if canonical is None:
+            key = canonical = name
+        self._headers[key] = (canonical, utils.to_str(value))
 
     def header(self, name):
         """
@@ -802,7 +1117,8 @@ class Response(object):
         key = name.upper()
         if key not in _RESPONSE_HEADER_DICT:
             key = name
-        return self._headers.get(key)
+        h = self._headers.get(key)
+        return h[1] if h else None
 
     @property
     def headers(self):
@@ -817,8 +1133,8 @@ class Response(object):
         >>> r.headers
         [('Content-Type', 'text/html; charset=utf-8'), ('Set-Cookie', 's1=ok; Max-Age=3600; Path=/; HttpOnly'), ('X-Powered-By', 'transwarp/1.0')]
         """
-        L = [(_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
-        if hasattr(self, '_cookies'):
+        L = self._headers.values()
+        if self._cookies:
             for v in self._cookies.itervalues():
                 L.append(('Set-Cookie', v))
         L.append(_HEADER_X_POWERED_BY)
@@ -910,7 +1226,7 @@ class Response(object):
         >>> r._cookies
         {'company': 'company=Expires; Expires=Sat, 14-Jul-2012 14:06:34 GMT; Path=/; HttpOnly'}
         """
-        if not hasattr(self, '_cookies'):
+        if self._cookies is None:
             self._cookies = {}
         L = ['%s=%s' % (utils.quote(name), utils.quote(value))]
         if expires is not None:
@@ -940,9 +1256,8 @@ class Response(object):
         >>> r._cookies
         {}
         """
-        if hasattr(self, '_cookies'):
-            if name in self._cookies:
-                del self._cookies[name]
+        if self._cookies and name in self._cookies:
+            del self._cookies[name]
 
     @property
     def status_code(self):
@@ -1027,8 +1342,48 @@ class Response(object):
 # 实现URL路由功能
 # 将URL 映射到 函数上
 #################################################################
-# 用于捕获变量的re
-_re_route = re.compile(r'(:[a-zA-Z_]\w*)')
+# 用于捕获变量的re， 变量可以带类型： :id<int>
+_re_route = re.compile(r'(:[a-zA-Z_]\w*(?:<[a-zA-Z_]\w*>)?)')
+
+# 变量类型对应的 re 和转换函数， path 类型匹配剩余的整个路径(可以包含/)，只能放在最后一段
+_ROUTE_TYPES = {
+    'str': r'[^\/]+',
+    'int': r'\d+',
+    'path': r'.+',
+}
+
+_ROUTE_CONVERTERS = {
+    'int': int,
+}
+
+
+def _route_var(var):
+    """
+    解析 :name<type> 形式的变量， 返回 (name, type)
+
+    >>> _route_var(':id')
+    ('id', 'str')
+    >>> _route_var(':page<int>')
+    ('page', 'int')
+    >>> _route_var(':x<float>')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid route variable type: :x<float>
+    """
+    name, t = var[1:], 'str'
+    if var.endswith('>'):
+        name, t = var[1:-1].split('<')
+    if t not in _ROUTE_TYPES:
+        raise ValueError('Invalid route variable type: %s' % var)
+    return name, t
+
+
+def _route(path, method):
+    def _decorator(func):
+        func.__web_route__ = path
+        func.__web_method__ = method
+        return func
+    return _decorator
 
 
 # 方法的装饰器，用于捕获url
@@ -1049,11 +1404,7 @@ def get(path):
     >>> test()
     'ok'
     """
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'GET'
-        return func
-    return _decorator
+    return _route(path, 'GET')
 
 
 def post(path):
@@ -1070,11 +1421,33 @@ def post(path):
     >>> testpost()
     '200'
     """
-    def _decorator(func):
-        func.__web_route__ = path
-        func.__web_method__ = 'POST'
-        return func
-    return _decorator
+    return _route(path, 'POST')
+
+
+def put(path):
+    """
+    A @put decorator.
+    >>> @put('/api/blogs/:id')
+    ... def testput():
+    ...     return '200'
+    ...
+    >>> testput.__web_method__
+    'PUT'
+    """
+    return _route(path, 'PUT')
+
+
+def delete(path):
+    """
+    A @delete decorator.
+    >>> @delete('/api/blogs/:id')
+    ... def testdelete():
+    ...     return '200'
+    ...
+    >>> testdelete.__web_method__
+    'DELETE'
+    """
+    return _route(path, 'DELETE')
 
 
 def _build_regex(path):
@@ -1087,15 +1460,17 @@ def _build_regex(path):
     '^\\/(?P<user>[^\\/]+)\\/(?P<comments>[^\\/]+)\\/list$'
     >>> _build_regex(':id-:pid/:w')
     '^(?P<id>[^\\/]+)\\-(?P<pid>[^\\/]+)\\/(?P<w>[^\\/]+)$'
+    >>> _build_regex('/blog/:id<int>/:file<path>')
+    '^\\/blog\\/(?P<id>\\d+)\\/(?P<file>.+)$'
     """
     re_list = ['^']
     var_list = []
     is_var = False
     for v in _re_route.split(path):
         if is_var:
-            var_name = v[1:]
+            var_name, var_type = _route_var(v)
             var_list.append(var_name)
-            re_list.append(r'(?P<%s>[^\/]+)' % var_name)
+            re_list.append(r'(?P<%s>%s)' % (var_name, _ROUTE_TYPES[var_type]))
         else:
             s = ''
             for ch in v:
@@ -1113,15 +1488,76 @@ def _build_regex(path):
     return ''.join(re_list)
 
 
-def _static_file_generator(fpath, block_size=8192):
+def _route_converters(path):
+    """
+    返回路径中每个变量的转换函数， 不需要转换的为None
+    """
+    return [_ROUTE_CONVERTERS.get(_route_var(v)[1]) for v in _re_route.findall(path)]
+
+
+def _convert(converters, values):
+    return [v if c is None else c(v) for c, v in zip(converters, values)]
+
+
+# 静态文件： 浏览器缓存时间， stat结果的缓存时间， 小文件内存缓存的总大小和单个文件的大小上限
+STATIC_MAX_AGE = 3600
+STATIC_STAT_TTL = 2.0
+STATIC_CACHE_SIZE = 16 * 1024 * 1024
+STATIC_CACHE_MAX_FILE = 64 * 1024
+
+_STATIC_BLOCK_SIZE = 64 * 1024
+_STATIC_MAX_STATS = 10000
+
+
+def _static_file_generator(fpath, offset, length, block_size=_STATIC_BLOCK_SIZE):
     """
-    读取静态文件的一个生成器
+    从 offset 开始读取 length 字节的生成器， 开始迭代时才打开文件， 读完或者被关闭时关闭文件，
+    所以返回之后没有被迭代的生成器 不会占用文件句柄
     """
-    with open(fpath, 'rb') as f:
-        block = f.read(block_size)
-        while block:
+    f = open(fpath, 'rb')
+    try:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(block_size, length))
+            if not block:
+                break
+            length -= len(block)
             yield block
-            block = f.read(block_size)
+    finally:
+        f.close()
+
+
+def _parse_range(value, size):
+    """
+    解析单个区间的 Range header， 返回 (start, end)：
+    不能满足时返回 None， 格式不对或者多个区间时返回 False， 这时发送整个文件
+
+    >>> _parse_range('bytes=0-99', 1000), _parse_range('bytes=900-', 1000), _parse_range('bytes=-100', 1000), _parse_range('bytes=990-2000', 1000)
+    ((0, 99), (900, 999), (900, 999), (990, 999))
+    >>> _parse_range('bytes=1000-', 1000), _parse_range('bytes=-0', 1000)
+    (None, None)
+    >>> _parse_range('bytes=0-1,5-6', 1000), _parse_range('items=0-1', 1000), _parse_range('bytes=5-1', 1000)
+    (False, False, False)
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return False
+    start, _, end = spec.strip().partition('-')
+    try:
+        if not start:
+            n = int(end)
+            if n <= 0:
+                return None
+            return max(size - n, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return False
+    if start >= size:
+        return None
+    if end < start:
+        return False
+    return start, min(end, size - 1)
 
 
 class Route(object):
@@ -1148,6 +1584,7 @@ class Route(object):
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
+            self.converters = _route_converters(self.path)
         self.func = func
 
     def match(self, url):
@@ -1156,7 +1593,7 @@ class Route(object):
         """
         m = self.route.match(url)
         if m:
-            return m.groups()
+            return _convert(self.converters, m.groups())
         return None
 
     def __call__(self, *args):
@@ -1173,27 +1610,350 @@ class Route(object):
     __repr__ = __str__
 
 
+# 整段变量的匹配函数， 匹配时返回转换后的值组成的tuple， 否则返回None
+_SEGMENT_MATCHERS = {
+    'str': lambda s: (s, ) if s else None,
+    'int': lambda s: (int(s), ) if s.isdigit() else None,
+}
+
+# 同一个节点下变量子节点的匹配顺序： 含字面量的组合段最具体， 然后是int， 最后是str
+_SEGMENT_PRIORITY = {
+    'regex': 0,
+    'int': 1,
+    'str': 2,
+}
+
+
+def _segment_matcher(segment):
+    """
+    组合段(如 :id-:pid)用re匹配
+    """
+    route = re.compile(_build_regex(segment))
+    converters = _route_converters(segment)
+
+    def _match(s):
+        m = route.match(s)
+        if m:
+            return _convert(converters, m.groups())
+        return None
+    return _match
+
+
+class _RouteNode(object):
+    """
+    路由树的节点， 每个节点对应路径中的一段
+    """
+    def __init__(self):
+        self.static = {}    # 字面量段 -> 子节点
+        self.params = []    # [(优先级, key, 匹配函数, 子节点)]
+        self.catchall = {}  # path 类型变量： method -> route
+        self.routes = {}    # 路径在此结束的路由： method -> route
+
+    def child(self, kind, segment):
+        if kind == 'static':
+            return self.static.setdefault(segment, _RouteNode())
+        key = kind if kind != 'regex' else segment
+        for p in self.params:
+            if p[1] == key:
+                return p[3]
+        matcher = _segment_matcher(segment) if kind == 'regex' else _SEGMENT_MATCHERS[kind]
+        node = _RouteNode()
+        self.params.append((_SEGMENT_PRIORITY[kind], key, matcher, node))
+        self.params.sort(key=lambda p: p[0])
+        return node
+
+
+def _pick(routes, method):
+    r = routes.get(method)
+    if r is None and method == 'HEAD':
+        r = routes.get('GET')
+    return r
+
+
+class Router(object):
+    """
+    按 '/' 分段的路由树， 在启动时构造一次：
+        没有变量的路径直接查dict；
+        动态路径逐段向下匹配， 字面量段优先， 然后按类型尝试变量段， 失败时回溯，
+        所以分发的开销只和路径的段数有关， 和路由的数量无关。
+    HEAD 请求在没有单独注册时由 GET 路由处理。
+
+    >>> router = Router()
+    >>> for path in ('/', '/blog/:id', '/blog/:id<int>', '/blog/:id/comments', '/blog/new', '/files/:f<path>', '/v/:a-:b<int>'):
+    ...     router.add(Route(get(path)(lambda *args: path)))
+    >>> router.add(Route(delete('/blog/:id')(lambda id: 'deleted')))
+    >>> router.match('GET', '/blog/new')
+    (Route(static,GET,path=/blog/new), [])
+    >>> router.match('GET', '/blog/123')
+    (Route(dynamic,GET,path=/blog/:id<int>), [123])
+    >>> router.match('HEAD', '/blog/abc/comments')
+    (Route(dynamic,GET,path=/blog/:id/comments), ['abc'])
+    >>> router.match('GET', '/files/css/a.css')
+    (Route(dynamic,GET,path=/files/:f<path>), ['css/a.css'])
+    >>> router.match('GET', '/v/x-1')
+    (Route(dynamic,GET,path=/v/:a-:b<int>), ['x', 1])
+    >>> router.match('GET', '/blog/abc/likes')
+    (None, None)
+    >>> router.allowed('/blog/abc')
+    ['DELETE', 'GET', 'HEAD']
+    """
+    def __init__(self):
+        self._static = {}   # method -> {path: route}
+        self._root = _RouteNode()
+        self._methods = set()
+
+    def add(self, route):
+        self._methods.add(route.method)
+        if route.is_static:
+            self._static.setdefault(route.method, {})[route.path] = route
+            return
+        node = self._root
+        segments = route.path.split('/')
+        for i, s in enumerate(segments):
+            parts = _re_route.split(s)
+            if len(parts) == 1:
+                node = node.child('static', s)
+                continue
+            if len(parts) == 3 and parts[0] == '' and parts[2] == '':
+                kind = _route_var(parts[1])[1]
+                if kind == 'path':
+                    if i != len(segments) - 1:
+                        raise ValueError('path variable must be the last segment: %s' % route.path)
+                    node.catchall.setdefault(route.method, route)
+                    return
+                node = node.child(kind, s)
+                continue
+            if 'path' in [_route_var(v)[1] for v in parts[1::2]]:
+                raise ValueError('path variable must be the whole segment: %s' % route.path)
+            node = node.child('regex', s)
+        # 和原来按注册顺序线性匹配一样， 相同的路径先注册的优先
+        node.routes.setdefault(route.method, route)
+
+    def match(self, method, path):
+        """
+        返回 (route, args)， 没有匹配的路由时返回 (None, None)
+        """
+        static = self._static.get(method)
+        r = static and static.get(path)
+        if r is None and method == 'HEAD':
+            static = self._static.get('GET')
+            r = static and static.get(path)
+        if r is not None:
+            return r, []
+        args = []
+        r = self._match(self._root, path.split('/'), 0, method, args)
+        if r is None:
+            return None, None
+        return r, args
+
+    def _match(self, node, segments, i, method, args):
+        if i == len(segments):
+            return _pick(node.routes, method)
+        s = segments[i]
+        child = node.static.get(s)
+        if child is not None:
+            r = self._match(child, segments, i + 1, method, args)
+            if r is not None:
+                return r
+        for _, _, matcher, child in node.params:
+            values = matcher(s)
+            if values is not None:
+                n = len(args)
+                args.extend(values)
+                r = self._match(child, segments, i + 1, method, args)
+                if r is not None:
+                    return r
+                del args[n:]
+        if node.catchall:
+            rest = '/'.join(segments[i:])
+            r = _pick(node.catchall, method)
+            if r is not None and rest:
+                args.append(rest)
+                return r
+        return None
+
+    def allowed(self, path):
+        """
+        返回可以处理 path 的所有 method， 用于 405 响应的 Allow header
+        """
+        methods = self._methods | set(['HEAD']) if 'GET' in self._methods else self._methods
+        return sorted([m for m in methods if self.match(m, path)[0] is not None])
+
+
 class StaticFileRoute(object):
     """
     静态文件路由对象，和Route相对应
+    处理 /static/ 下的文件：
+        stat 结果缓存 STATIC_STAT_TTL 秒， 小于 STATIC_CACHE_MAX_FILE 的文件按LRU保存在内存里；
+        ETag / Last-Modified 验证通过时返回 304；
+        支持单个区间的 Range 请求；
+        客户端接受 gzip 时 优先发送预先压缩好的同名 .gz 文件；
+        没有 .gz 文件的小文本文件 压缩后和原始内容一起缓存， 不会每次请求都压缩；
+        大文件不在请求时压缩， 整个文件用 wsgi.file_wrapper 发送， 服务器可以用 sendfile，
+        需要压缩的大文件 请预先生成 .gz 文件。
+    gzip: 是否压缩， 和 get_wsgi_application 的 gzip 参数相同
     """
-    def __init__(self):
+    def __init__(self, gzip=True):
+        self.path = '/static/:file<path>'
         self.method = 'GET'
         self.is_static = False
-        self.route = re.compile('^/static/(.+)$')
+        self.gzip = gzip
+        self._stats = {}            # 文件路径 -> (检查的时间, (mtime, size, etag, last_modified) 或 None)
+        self._mimes = {}            # 扩展名 -> content type
+        self._cache = OrderedDict() # 文件路径 -> [mtime, 内容, 压缩后的内容 或 None]
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def _stat(self, fpath):
+        now = time.time()
+        e = self._stats.get(fpath)
+        if e is not None and now - e[0] < STATIC_STAT_TTL:
+            return e[1]
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            info = None
+        else:
+            if stat.S_ISREG(st.st_mode):
+                mtime = int(st.st_mtime)
+                info = (mtime, st.st_size, '"%x-%x"' % (mtime, st.st_size), formatdate(mtime, usegmt=True))
+            else:
+                info = None
+        if len(self._stats) >= _STATIC_MAX_STATS:
+            self._stats.clear()
+        self._stats[fpath] = (now, info)
+        return info
+
+    def _mime(self, fpath):
+        fext = os.path.splitext(fpath)[1].lower()
+        mime = self._mimes.get(fext)
+        if mime is None:
+            mime = self._mimes[fext] = mimetypes.types_map.get(fext, 'application/octet-stream')
+        return mime
 
-    def match(self, url):
-        if url.startswith('/static/'):
-            return (url[1:], )
-        return None
+    @staticmethod
+    def _entry_size(e):
+        return len(e[1]) + len(e[2] or '')
 
-    def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+    def _evict(self):
+        while self._cache_size > STATIC_CACHE_SIZE:
+            _, e = self._cache.popitem(last=False)
+            self._cache_size -= self._entry_size(e)
+
+    def _read(self, fpath, mtime, level=None):
+        """
+        读取小文件， 按LRU缓存， 总大小不超过 STATIC_CACHE_SIZE；
+        level 不为None时 返回按该级别gzip压缩的内容， 和原始内容缓存在一起， 文件修改后一起失效
+        """
+        with self._lock:
+            e = self._cache.pop(fpath, None)
+            if e is not None:
+                if e[0] == mtime:
+                    self._cache[fpath] = e
+                else:
+                    self._cache_size -= self._entry_size(e)
+                    e = None
+        if e is None:
+            with open(fpath, 'rb') as f:
+                e = [mtime, f.read(), None]
+            with self._lock:
+                old = self._cache.pop(fpath, None)
+                if old is not None:
+                    self._cache_size -= self._entry_size(old)
+                self._cache[fpath] = e
+                self._cache_size += self._entry_size(e)
+                self._evict()
+        if level is None:
+            return e[1]
+        if e[2] is None:
+            start = time.time()
+            c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            gz = c.compress(e[1]) + c.flush()
+            _gzip_count('compressed', len(e[1]), len(gz), time.time() - start)
+            with self._lock:
+                if e[2] is None:
+                    e[2] = gz
+                    if self._cache.get(fpath) is e:
+                        self._cache_size += len(gz)
+                        self._evict()
+        return e[2]
+
+    def __call__(self, fname):
+        root = os.path.join(ctx.application.document_root, 'static')
+        fpath = os.path.normpath(os.path.join(root, fname))
+        if not fpath.startswith(root + os.sep):
+            raise HttpError.notfound()
+        info = self._stat(fpath)
+        if info is None:
             raise HttpError.notfound()
-        fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        request, response = ctx.request, ctx.response
+        response._gzip = False
+        response.content_type = self._mime(fpath)
+        response.set_header('Cache-Control', 'max-age=%d' % STATIC_MAX_AGE)
+        rng = request.header('Range')
+        # 区间请求只针对原始文件
+        accepts = rng is None and _accepts_gzip(request.header('Accept-Encoding'))
+        level = None
+        gz = self._stat(fpath + '.gz')
+        if gz is not None:
+            response.set_header('Vary', 'Accept-Encoding')
+            if accepts:
+                response.set_header('Content-Encoding', 'gzip')
+                fpath, info = fpath + '.gz', (gz[0], gz[1], gz[2][:-1] + '-gz"', gz[3])
+        elif self.gzip and GZIP_MIN_SIZE <= info[1] <= STATIC_CACHE_MAX_FILE:
+            level = _gzip_level(response.content_type)
+            if level is not None:
+                response.set_header('Vary', 'Accept-Encoding')
+                if not accepts:
+                    level = None
+        mtime, size, etag, last_modified = info
+        if level is not None:
+            response.set_header('Content-Encoding', 'gzip')
+            etag = etag[:-1] + '-gz"'
+        response.set_header('ETag', etag)
+        response.set_header('Last-Modified', last_modified)
+        response.set_header('Accept-Ranges', 'bytes')
+        inm = request.header('If-None-Match')
+        if inm is not None:
+            if _etag_matches(inm, etag):
+                raise HttpError.notmodified()
+        else:
+            ims = request.header('If-Modified-Since')
+            t = ims and parsedate_tz(ims)
+            if t and mktime_tz(t) >= mtime:
+                raise HttpError.notmodified()
+        if level is not None:
+            data = self._read(fpath, mtime, level)
+            size = len(data)
+        start, end = 0, size - 1
+        if rng is not None and request.header('If-Range', etag) in (etag, last_modified):
+            r = _parse_range(rng, size)
+            if r is None:
+                response.set_header('Content-Range', 'bytes */%d' % size)
+                raise _HttpError(416)
+            if r:
+                start, end = r
+                response.status = 206
+                response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        length = end - start + 1
+        response.content_length = length
+        if request.request_method == 'HEAD':
+            return []
+        if level is not None:
+            return [data]
+        if size <= STATIC_CACHE_MAX_FILE:
+            data = self._read(fpath, mtime)
+            return [data if length == size else data[start:end + 1]]
+        if length == size:
+            file_wrapper = request.environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(open(fpath, 'rb'), _STATIC_BLOCK_SIZE)
+        return _static_file_generator(fpath, start, length)
+
+    def __str__(self):
+        return 'Route(dynamic,%s,path=%s)' % (self.method, self.path)
+
+    __repr__ = __str__
 
 
 class MultipartFile(object):
@@ -1202,10 +1962,79 @@ class MultipartFile(object):
     f = ctx.request['file']
     f.filename # 'test.png'
     f.file # file-like object
+    f.size # 文件大小
+    f.hexdigest # 上传时计算的 MULTIPART_HASH 摘要
+    f.save('/path/to/test.png') # 已经写到临时文件的直接rename， 不复制数据， 之后 f.file 已关闭
+    仍然可以用 cgi.FieldStorage 构造， 这时 size 和 hexdigest 为None
     """
-    def __init__(self, storage):
-        self.filename = utils.to_unicode(storage.filename)
-        self.file = storage.file
+    def __init__(self, storage=None):
+        self.name = getattr(storage, 'name', None)
+        self.filename = utils.to_unicode(storage.filename) if storage is not None else None
+        self.content_type = getattr(storage, 'type', None)
+        self.size = None
+        self.hexdigest = None
+        self.file = storage.file if storage is not None else StringIO()
+        self._hash = None
+        self._tmp = None
+
+    @classmethod
+    def _create(cls, name, filename, content_type):
+        """
+        _parse_multipart 边解析边写入的文件
+        """
+        f = cls()
+        f.name = name
+        f.filename = utils.to_unicode(filename)
+        f.content_type = content_type
+        f.size = 0
+        f._hash = hashlib.new(MULTIPART_HASH)
+        return f
+
+    def _write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > MULTIPART_MAX_FILE_SIZE:
+            raise HttpError.toolarge()
+        self._hash.update(data)
+        if self._tmp is None and self.size > MULTIPART_SPOOL_SIZE:
+            f = tempfile.NamedTemporaryFile(prefix='upload-', dir=MULTIPART_TMP_DIR, delete=False)
+            self._tmp = f.name
+            f.write(self.file.getvalue())
+            self.file = f
+        self.file.write(data)
+
+    def _done(self):
+        self.hexdigest = self._hash.hexdigest()
+        self._hash = None
+        if self._tmp is not None:
+            self.file.flush()
+        self.file.seek(0)
+
+    def save(self, path):
+        """
+        保存到 path， 同一个文件系统上的临时文件直接rename
+        """
+        if self._tmp is None:
+            self.file.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(self.file, f)
+            return
+        self.file.close()
+        shutil.move(self._tmp, path)
+        self._tmp = None
+
+    def close(self):
+        """
+        删除没有保存的临时文件
+        """
+        if self._tmp is not None:
+            self.file.close()
+            try:
+                os.remove(self._tmp)
+            except OSError:
+                pass
+            self._tmp = None
 
 
 #################################################################
@@ -1239,28 +2068,121 @@ class TemplateEngine(object):
         return '<!-- override this method to render template -->'
 
 
+# 流式渲染时 攒够这么多字节再交给wsgi server， 避免每一小段输出都写一次socket
+TEMPLATE_STREAM_SIZE = 8 * 1024
+
+
+class _PrefetchedBody(object):
+    """
+    流式渲染的页面： 在 start_response 之前先渲染出第一块， 第一块之前的模板错误仍然返回500；
+    之后的块在请求处理完之后才渲染， 这时出错只能截断页面。
+    close() 关闭原来的body， wsgi server 发送完或者丢弃body时都会调用
+
+    >>> def _gen():
+    ...     yield 'a'
+    ...     raise ValueError('bad')
+    >>> body = _PrefetchedBody(_gen())
+    >>> body._first
+    ['a']
+    >>> _PrefetchedBody(iter([]))._first
+    []
+    >>> def _bad():
+    ...     raise ValueError('bad')
+    ...     yield 'a'
+    >>> _PrefetchedBody(_bad())
+    Traceback (most recent call last):
+      ...
+    ValueError: bad
+    """
+    __slots__ = ('_body', '_it', '_first')
+
+    def __init__(self, body):
+        self._body = body
+        self._it = iter(body)
+        try:
+            self._first = [next(self._it)]
+        except StopIteration:
+            self._first = []
+
+    def __iter__(self):
+        for chunk in self._first:
+            yield chunk
+        for chunk in self._it:
+            yield chunk
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+
+
 class Jinja2TemplateEngine(TemplateEngine):
     """
     Render using jinja2 template engine.
+        cache_dir: 编译后的模板字节码保存在这个目录， 重启后不用重新编译；
+        stream: 为True时 __call__ 用 generate() 边渲染边返回utf-8编码的块， wsgi server 可以先发送页面的开头。
+    生产环境传 auto_reload=False， 加好filter后调用 precompile()， 之后请求不再检查模板文件是否修改。
+
     >>> templ_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
     >>> engine = Jinja2TemplateEngine(templ_path)
     >>> engine.add_filter('datetime', lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'))
     >>> engine('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12)))
     '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
+    >>> ''.join(engine.stream('jinja2-test.html', dict(name='Michael', posted_at=datetime.datetime(2014, 6, 1, 10, 11, 12))))
+    '<p>Hello, Michael.</p><span>2014-06-01 10:11:12</span>'
     """
 
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, cache_dir=None, stream=False, **kw):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if 'autoescape' not in kw:
             kw['autoescape'] = True
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+        if kw.get('auto_reload') is False and 'cache_size' not in kw:
+            # 不会重新加载的模板 全部留在内存里
+            kw['cache_size'] = -1
+        self._stream = stream
         self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
-    def __call__(self, path, model):
+    def precompile(self, extensions=('html', )):
+        """
+        编译并加载模板目录下所有扩展名在 extensions 里的模板， 模板有语法错误时启动就会失败
+        """
+        start = time.time()
+        names = self._env.list_templates(extensions=extensions)
+        for name in names:
+            self._env.get_template(name)
+        logging.info('Precompiled %d templates in %.1fms.' % (len(names), (time.time() - start) * 1000))
+        return len(names)
+
+    def render(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
 
+    def stream(self, path, model):
+        # 在返回生成器之前加载模板， 模板不存在或者有语法错误时 仍然在处理请求的过程中抛出
+        return self._generate(self._env.get_template(path), model)
+
+    def _generate(self, template, model):
+        buf, size = [], 0
+        for s in template.generate(**model):
+            s = s.encode('utf-8')
+            buf.append(s)
+            size += len(s)
+            if size >= TEMPLATE_STREAM_SIZE:
+                yield ''.join(buf)
+                buf, size = [], 0
+        if buf:
+            yield ''.join(buf)
+
+    def __call__(self, path, model):
+        if self._stream:
+            return self.stream(path, model)
+        return self.render(path, model)
+
 
 def _debug():
     """
@@ -1325,6 +2247,414 @@ def view(path):
     return _decorator
 
 
+def _etag_matches(if_none_match, etag):
+    """
+    If-None-Match 是否包含 etag， 按RFC 7232 忽略 W/ 前缀
+
+    >>> _etag_matches(u'"a1", W/"b2"', '"b2"'), _etag_matches(u'*', '"c3"'), _etag_matches(u'"a1"', '"c3"'), _etag_matches(None, '"a1"')
+    (True, True, False, False)
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def cache_control(max_age=0, etag=True, private=False, version=None):
+    """
+    动态页面的缓存策略， 要放在 @view 和 @api 的外面：
+        Cache-Control： max_age 为0时是 no-cache， 也就是每次都要用 ETag 验证；
+                        private 表示内容和用户有关， CDN 不能缓存
+        ETag： 默认是渲染后 body 的 md5， If-None-Match 匹配时返回 304 而不发送 body；
+               如果提供了 version(*args, **kw)， 用它返回的版本号和url(包括query string)生成 ETag，
+               匹配时直接返回 304， 不再调用处理函数和渲染模板。
+               version 的返回值要包含所有会影响内容的东西， 比如当前用户。
+    只对 GET/HEAD 请求返回 304， 处理函数出错时不设置缓存的header。
+
+    >>> @cache_control(max_age=60, version=lambda id: 'v1')
+    ... def test(id):
+    ...     return 'content of %s' % id
+    >>> ctx.request, ctx.response = Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/t/1'}), Response()
+    >>> test('1')
+    'content of 1'
+    >>> ctx.response.header('Cache-Control'), ctx.response.header('ETag')
+    ('max-age=60', '"970d66a0a7641d23416f77b1f3019dee"')
+    >>> ctx.request, ctx.response = Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/t/1', 'HTTP_IF_NONE_MATCH': '"970d66a0a7641d23416f77b1f3019dee"'}), Response()
+    >>> test('1')
+    Traceback (most recent call last):
+      ...
+    _NotModified: 304 Not Modified
+    >>> ctx.request, ctx.response = Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/t/1', 'QUERY_STRING': 'page=2', 'HTTP_IF_NONE_MATCH': '"970d66a0a7641d23416f77b1f3019dee"'}), Response()
+    >>> test('1'), ctx.response.header('ETag')
+    ('content of 1', '"9b2b69b8930eaaabc91333dc810e0bbf"')
+    """
+    L = ['private'] if private else []
+    L.append('max-age=%d' % max_age if max_age > 0 else 'no-cache')
+    value = ', '.join(L)
+
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            request, response = ctx.request, ctx.response
+            if etag and version is not None:
+                tag = '"%s"' % hashlib.md5('%s?%s\n%s' % (request.path_info, request.query_string, utils.to_str(version(*args, **kw)))).hexdigest()
+                if request.request_method in ('GET', 'HEAD') and _etag_matches(request.header('If-None-Match'), tag):
+                    response.set_header('Cache-Control', value)
+                    response.set_header('ETag', tag)
+                    raise HttpError.notmodified()
+            r = func(*args, **kw)
+            response.set_header('Cache-Control', value)
+            if etag:
+                if version is None:
+                    # 渲染后由 wsgi() 计算body的ETag
+                    response._etag = True
+                else:
+                    response.set_header('ETag', tag)
+            return r
+        return _wrapper
+    return _decorator
+
+
+# 整页缓存的总大小， 等待其他线程生成页面的最长时间
+PAGE_CACHE_SIZE = 32 * 1024 * 1024
+PAGE_CACHE_WAIT = 10.0
+
+
+class _PageCache(object):
+    """
+    @cached_page 的缓存： 按LRU保存 key -> (过期时间, body, header, 是否计算ETag)， 总大小不超过 capacity。
+    同一个key同时只有一个线程生成页面：
+        没有缓存时其他线程等它生成完；
+        缓存过期不久(stale 秒以内)时其他线程直接返回旧的页面。
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._size = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, stale=0, misses=0, waits=0, bypass=0, evictions=0)
+
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _get(self, key):
+        e = self._entries.pop(key, None)
+        if e is not None:
+            self._entries[key] = e
+        return e
+
+    def _put(self, key, entry):
+        size = len(entry[1])
+        if size > self.capacity:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self.capacity:
+            _, e = self._entries.popitem(last=False)
+            self._size -= len(e[1])
+            self._stats['evictions'] += 1
+
+    def _restore(self, entry):
+        response = ctx.response
+        response._headers.update(entry[2])
+        response._etag = response._etag or entry[3]
+        return entry[1]
+
+    def fetch(self, key, ttl, stale, generate):
+        """
+        返回缓存的或者调用 generate() 生成的页面， generate 返回 (body, header, 是否计算ETag, 是否可以缓存)
+        """
+        now = time.time()
+        with self._lock:
+            e = self._get(key)
+            if e is not None and now < e[0]:
+                self._stats['hits'] += 1
+                return self._restore(e)
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = threading.Event()
+                leader = True
+            else:
+                leader = False
+                if e is not None and now < e[0] + stale:
+                    self._stats['stale'] += 1
+                    return self._restore(e)
+            self._stats['misses' if leader else 'waits'] += 1
+        if not leader:
+            flight.wait(PAGE_CACHE_WAIT)
+            with self._lock:
+                e = self._get(key)
+            if e is not None:
+                return self._restore(e)
+            return generate()[0]
+        try:
+            body, headers, etag, cacheable = generate()
+            if cacheable:
+                with self._lock:
+                    self._put(key, (time.time() + ttl, body, headers, etag))
+            return body
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return Dict(entries=len(self._entries), size=self._size, **self._stats)
+
+
+page_cache = _PageCache(PAGE_CACHE_SIZE)
+
+
+def _render_page(func, args, kw):
+    """
+    调用处理函数并渲染成 str， 只缓存没有设置cookie的 200 响应
+    """
+    r = func(*args, **kw)
+    if isinstance(r, Template):
+        r = ctx.application.template_engine(r.template_name, r.model)
+    if isinstance(r, unicode):
+        r = r.encode('utf-8')
+    elif r is None:
+        r = ''
+    elif not isinstance(r, str):
+        r = ''.join(r)
+    response = ctx.response
+    return r, dict(response._headers), response._etag, response.status_code == 200 and not response._cookies
+
+
+def cached_page(ttl, vary=None, stale=None):
+    """
+    缓存渲染后的整个页面(body和header)， 放在 @view 和 @api 的外面， @cache_control 的里面：
+        key 是 path、query string 和 vary() 的返回值， 比如区分登录的和匿名的用户；
+        vary() 返回 None 时不使用缓存， 比如页面里有当前用户的信息时；
+        过期后 stale 秒(默认等于ttl)以内， 一个线程重新生成， 其他线程返回旧的页面。
+    只缓存 GET/HEAD 请求， 统计见 page_cache.stats()。
+
+    >>> n = [0]
+    >>> @cached_page(60, vary=lambda: ctx.request.cookie('lang'))
+    ... def test():
+    ...     n[0] += 1
+    ...     return u'page %d' % n[0]
+    >>> def request(cookie):
+    ...     ctx.request, ctx.response = Request({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/t', 'HTTP_COOKIE': cookie}), Response()
+    ...     return test()
+    >>> request('lang=en'), request('lang=en'), request('lang=zh'), request('')
+    ('page 1', 'page 1', 'page 2', u'page 3')
+    """
+    stale = ttl if stale is None else stale
+
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            request = ctx.request
+            part = vary() if vary is not None else ''
+            if part is None or request.request_method not in ('GET', 'HEAD'):
+                page_cache.count('bypass')
+                return func(*args, **kw)
+            key = (request.path_info, request.query_string, part)
+            return page_cache.fetch(key, ttl, stale, lambda: _render_page(func, args, kw))
+        return _wrapper
+    return _decorator
+
+
+# 响应压缩： 小于 GZIP_MIN_SIZE 的不压缩， 只压缩 text/* 和 GZIP_LEVELS 中的类型， 按类型选择压缩级别
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+GZIP_LEVELS = {
+    'application/json': 5,
+    'application/javascript': 6,
+    'application/xml': 6,
+    'image/svg+xml': 6,
+}
+
+_gzip_lock = threading.Lock()
+_gzip_stats = dict(compressed=0, skipped=0, bytes_in=0, bytes_out=0, seconds=0.0)
+
+
+def gzip_stats():
+    """
+    压缩了和跳过的响应数， 压缩前后的字节数， 节省的字节数， 压缩花费的时间
+    """
+    with _gzip_lock:
+        st = Dict(**_gzip_stats)
+    st.bytes_saved = st.bytes_in - st.bytes_out
+    return st
+
+
+def _gzip_count(key, bytes_in=0, bytes_out=0, seconds=0.0):
+    with _gzip_lock:
+        _gzip_stats[key] += 1
+        _gzip_stats['bytes_in'] += bytes_in
+        _gzip_stats['bytes_out'] += bytes_out
+        _gzip_stats['seconds'] += seconds
+
+
+def _accepts_gzip(accept_encoding):
+    """
+    明确的 gzip 优先于 *
+
+    >>> _accepts_gzip(u'gzip, deflate'), _accepts_gzip(u'deflate, gzip;q=0'), _accepts_gzip(u'gzip;q=0.5'), _accepts_gzip(u'*'), _accepts_gzip(None)
+    (True, False, True, True, False)
+    >>> _accepts_gzip(u'*;q=0, gzip'), _accepts_gzip(u'*, gzip;q=0')
+    (True, False)
+    """
+    if not accept_encoding:
+        return False
+    qs = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding in ('gzip', '*'):
+            q = 1.0
+            for param in params.split(';'):
+                k, _, v = param.partition('=')
+                if k.strip() == 'q':
+                    try:
+                        q = float(v)
+                    except ValueError:
+                        q = 0.0
+            qs[coding] = q
+    return qs.get('gzip', qs.get('*', 0.0)) > 0
+
+
+def _gzip_level(content_type):
+    """
+    返回 content type 的压缩级别， 不需要压缩时返回 None
+    """
+    ctype = content_type.split(';', 1)[0].strip().lower()
+    level = GZIP_LEVELS.get(ctype)
+    if level is None and ctype.startswith('text/'):
+        level = GZIP_LEVEL
+    return level
+
+
+def _gzip_stream(body, level):
+    """
+    逐块压缩 body， 压缩器有输出时就发送， 不缓存整个body
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    n_in = n_out = 0
+    seconds = 0.0
+    try:
+        for chunk in body:
+            if not chunk:
+                continue
+            start = time.time()
+            data = c.compress(chunk)
+            seconds += time.time() - start
+            n_in += len(chunk)
+            if data:
+                n_out += len(data)
+                yield data
+        start = time.time()
+        data = c.flush()
+        seconds += time.time() - start
+        n_out += len(data)
+        yield data
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        _gzip_count('compressed', n_in, n_out, seconds)
+
+
+def _gzip_body(request, response, body):
+    """
+    按 Accept-Encoding 和响应的类型、大小压缩 body， 返回新的body并修改响应的header：
+        已经在内存里的body一次压缩完， 设置准确的 Content-Length；
+        其他的可迭代对象边迭代边压缩， 去掉 Content-Length；
+        强 ETag 改成弱 ETag， 因为压缩后的字节和原来的不同。
+    HEAD 和 GET 一样决定是否压缩， 返回的header(Content-Encoding、Content-Length、ETag)相同， 只是不发送body。
+
+    >>> ctx.request, ctx.response = Request({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}), Response()
+    >>> ctx.response.set_header('ETag', '"abc"')
+    >>> body = _gzip_body(ctx.request, ctx.response, ['<p>hello</p>' * 200])
+    >>> ctx.response.header('Content-Encoding'), ctx.response.header('Vary'), ctx.response.header('ETag')
+    ('gzip', 'Accept-Encoding', 'W/"abc"')
+    >>> int(ctx.response.header('Content-Length')) == len(body[0]) < 2400
+    True
+    >>> zlib.decompress(body[0], 16 + zlib.MAX_WBITS) == '<p>hello</p>' * 200
+    True
+    >>> ctx.request = Request({'REQUEST_METHOD': 'HEAD', 'HTTP_ACCEPT_ENCODING': 'gzip'})
+    >>> ctx.response = Response()
+    >>> ctx.response.set_header('ETag', '"abc"')
+    >>> head = _gzip_body(ctx.request, ctx.response, ['<p>hello</p>' * 200])
+    >>> ctx.response.header('Content-Encoding'), ctx.response.header('ETag'), int(ctx.response.header('Content-Length')) == len(body[0])
+    ('gzip', 'W/"abc"', True)
+    >>> ctx.response = Response()
+    >>> ctx.response.content_type = 'image/png'
+    >>> _gzip_body(ctx.request, ctx.response, ['x' * 2000]) == ['x' * 2000], ctx.response.header('Content-Encoding')
+    (True, None)
+    >>> ctx.response = Response()
+    >>> ctx.response.status = 206
+    >>> _gzip_body(ctx.request, ctx.response, ['x' * 2000]) == ['x' * 2000], ctx.response.header('Content-Encoding'), ctx.response.header('Vary')
+    (True, None, 'Accept-Encoding')
+    """
+    if not response._gzip or response.header('Content-Encoding'):
+        return body
+    level = _gzip_level(response.content_type or '')
+    if level is None:
+        return body
+    # 206 等不压缩的响应 也要和 200 响应一样带上 Vary:
+    vary = response.header('Vary')
+    if not vary:
+        response.set_header('Vary', 'Accept-Encoding')
+    elif 'accept-encoding' not in vary.lower():
+        response.set_header('Vary', '%s, Accept-Encoding' % vary)
+    if response.status_code != 200:
+        return body
+    length = response.content_length
+    if (length is not None and int(length) < GZIP_MIN_SIZE) or not _accepts_gzip(request.header('Accept-Encoding')):
+        _gzip_count('skipped')
+        return body
+    response.set_header('Content-Encoding', 'gzip')
+    etag = response.header('ETag')
+    if etag and not etag.startswith('W/'):
+        response.set_header('ETag', 'W/' + etag)
+    if isinstance(body, list) and len(body) == 1 and isinstance(body[0], str):
+        start = time.time()
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = c.compress(body[0]) + c.flush()
+        _gzip_count('compressed', len(body[0]), len(data), time.time() - start)
+        response.content_length = len(data)
+        return [data]
+    response.unset_header('Content-Length')
+    if request.request_method == 'HEAD':
+        # 不会发送的body 不用压缩， 原样返回由调用者关闭
+        return body
+    return _gzip_stream(body, level)
+
+
+def _gzip_not_modified(request, response):
+    """
+    304 响应的 ETag 和 Vary 要和压缩后的 200 响应一致
+    """
+    if not response._gzip or response.header('Content-Encoding') or _gzip_level(response.content_type or '') is None:
+        return
+    if not response.header('Vary'):
+        response.set_header('Vary', 'Accept-Encoding')
+    etag = response.header('ETag')
+    if etag and not etag.startswith('W/') and _accepts_gzip(request.header('Accept-Encoding')):
+        response.set_header('ETag', 'W/' + etag)
+
+
 #################################################################
 # 实现URL拦截器
 # 主要interceptor的实现
@@ -1357,6 +2687,7 @@ def interceptor(pattern='/'):
     """
     def _decorator(func):
         func.__interceptor__ = _build_pattern_fn(pattern)
+        func.__interceptor_pattern__ = pattern
         return func
     return _decorator
 
@@ -1424,6 +2755,101 @@ def _build_interceptor_chain(last_fn, *interceptors):
     return fn
 
 
+def _interceptor_applies(func, path):
+    """
+    在启动时判断拦截器是否作用于路由模板 path 能匹配的所有url：
+        True 总是作用， False 总是不作用， None 取决于变量的值， 只能在请求时判断
+    静态路径直接用拦截器的匹配函数判断， 动态路径只看第一个变量之前的前缀
+    (startswith 模式)或最后一个变量之后的后缀(endswith 模式)。
+
+    >>> f = interceptor('/manage/')(lambda next: next())
+    >>> _interceptor_applies(f, '/manage/blogs'), _interceptor_applies(f, '/api/blogs')
+    (True, False)
+    >>> _interceptor_applies(f, '/manage/blogs/:id'), _interceptor_applies(f, '/blog/:id')
+    (True, False)
+    >>> _interceptor_applies(f, '/:section/blogs') is None
+    True
+    >>> f = interceptor('*.json')(lambda next: next())
+    >>> _interceptor_applies(f, '/api/:id.json'), _interceptor_applies(f, '/api/:id.html'), _interceptor_applies(f, '/api/:id') is None
+    (True, False, True)
+    """
+    parts = _re_route.split(path)
+    if len(parts) == 1:
+        return bool(func.__interceptor__(path))
+    pattern = getattr(func, '__interceptor_pattern__', None)
+    if pattern is None:
+        return None
+    m = _RE_INTERCEPTOR_STARTS_WITH.match(pattern)
+    if m:
+        literal, p = parts[0], m.group(1)
+        if literal.startswith(p):
+            return True
+        return None if p.startswith(literal) else False
+    m = _RE_INTERCEPTOR_ENDS_WITH.match(pattern)
+    if m:
+        literal, p = parts[-1], m.group(1)
+        if literal.endswith(p):
+            return True
+        return None if p.endswith(literal) else False
+    return None
+
+
+def _build_route_chain(route, interceptors):
+    """
+    为一个路由构造只包含适用拦截器的链， 返回 fn(path, args)：
+    总是作用的拦截器直接调用， 不能在启动时确定的才在请求时用 path 判断。
+
+    >>> @interceptor('/')
+    ... def f1(next):
+    ...     print 'f1'
+    ...     return next()
+    >>> @interceptor('/manage/')
+    ... def f2(next):
+    ...     print 'f2'
+    ...     return next()
+    >>> @interceptor('/blog/')
+    ... def f3(next):
+    ...     print 'f3'
+    ...     return next()
+    >>> chain = _build_route_chain(Route(get('/manage/blogs/:id')(lambda id: id)), [f1, f2, f3])
+    >>> chain('/manage/blogs/123', ['123'])
+    f1
+    f2
+    '123'
+    >>> chain = _build_route_chain(Route(get('/:section/:id')(lambda s, id: id)), [f1, f2, f3])
+    >>> chain('/blog/123', ['blog', '123'])
+    f1
+    f3
+    '123'
+    """
+    def _target(path, args):
+        return route(*args)
+
+    def _always(func, next):
+        def _wrapper(path, args):
+            return func(lambda: next(path, args))
+        return _wrapper
+
+    def _maybe(func, next):
+        def _wrapper(path, args):
+            if func.__interceptor__(path):
+                return func(lambda: next(path, args))
+            return next(path, args)
+        return _wrapper
+
+    fn = _target
+    applied = []
+    for f in reversed(interceptors):
+        applies = _interceptor_applies(f, route.path)
+        if applies is False:
+            continue
+        fn = _always(f, fn) if applies else _maybe(f, fn)
+        applied.append('%s%s' % (f.__name__, '' if applies else '?'))
+    applied.reverse()
+    logging.info('Interceptors of %s: %s' % (route, ', '.join(applied) or 'none'))
+    return fn
+
+
 def _load_module(module_name):
     """
     Load module from name as str.
@@ -1465,11 +2891,7 @@ class WSGIApplication(object):
         self._interceptors = []
         self._template_engine = None
 
-        self._get_static = {}
-        self._post_static = {}
-
-        self._get_dynamic = []
-        self._post_dynamic = []
+        self._routes = []
 
     def _check_not_running(self):
         """
@@ -1506,16 +2928,7 @@ class WSGIApplication(object):
         """
         self._check_not_running()
         route = Route(func)
-        if route.is_static:
-            if route.method == 'GET':
-                self._get_static[route.path] = route
-            if route.method == 'POST':
-                self._post_static[route.path] = route
-        else:
-            if route.method == 'GET':
-                self._get_dynamic.append(route)
-            if route.method == 'POST':
-                self._post_dynamic.append(route)
+        self._routes.append(route)
         logging.info('Add route: %s' % str(route))
 
     def add_interceptor(self, func):
@@ -1535,39 +2948,43 @@ class WSGIApplication(object):
         server = make_server(host, port, self.get_wsgi_application(debug=True))
         server.serve_forever()
 
-    def get_wsgi_application(self, debug=False):
+    def get_wsgi_application(self, debug=False, gzip=True):
+        """
+        gzip： 是否按 Accept-Encoding 压缩响应， 统计见 gzip_stats()
+        """
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
         self._running = True
 
-        _application = Dict(document_root=self._document_root)
+        static_route = StaticFileRoute(gzip)
+        routes = self._routes + [static_route]
+        # 路由树只在启动时构造一次
+        router = Router()
+        for route in routes:
+            router.add(route)
+        # 每个路由模板适用的拦截器也在启动时确定， 请求时不再匹配拦截器的模式
+        chains = dict((route, _build_route_chain(route, self._interceptors)) for route in self._routes)
+        # 静态文件不经过拦截器， 不需要为每个文件请求绑定用户
+        chains[static_route] = lambda path, args: static_route(*args)
+
+        _application = Dict(document_root=self._document_root, template_engine=self._template_engine)
+
+        def fn_notfound():
+            path_info = ctx.request.path_info
+            allowed = router.allowed(path_info)
+            if allowed:
+                ctx.response.set_header('Allow', ', '.join(allowed))
+                raise HttpError.methodnotallowed()
+            raise HttpError.notfound()
+
+        # 没有匹配的路由时 仍按url执行拦截器， 比如未登录访问 /manage/ 下不存在的页面也跳转到登录页
+        fn_miss = _build_interceptor_chain(fn_notfound, *self._interceptors)
 
-        def fn_route():
-            request_method = ctx.request.request_method
+        def fn_exec():
             path_info = ctx.request.path_info
-            if request_method=='GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise HttpError.notfound()
-            if request_method=='POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise HttpError.notfound()
-            raise badrequest()
-
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+            route, args = router.match(ctx.request.request_method, path_info)
+            if route is None:
+                return fn_miss()
+            return chains[route](path_info, args)
 
         def wsgi(env, start_response):
             """
@@ -1580,16 +2997,43 @@ class WSGIApplication(object):
                 r = fn_exec()
                 if isinstance(r, Template):
                     r = self._template_engine(r.template_name, r.model)
+                    if not isinstance(r, str):
+                        # 流式渲染的页面要计算ETag 只能先渲染完， 否则先渲染第一块 再 start_response
+                        r = ''.join(r) if response._etag else _PrefetchedBody(r)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                if isinstance(r, str):
+                    if response._etag and response.status_code == 200:
+                        tag = '"%s"' % hashlib.md5(r).hexdigest()
+                        response.set_header('ETag', tag)
+                        if ctx.request.request_method in ('GET', 'HEAD') and _etag_matches(ctx.request.header('If-None-Match'), tag):
+                            raise HttpError.notmodified()
+                    if response.content_length is None:
+                        response.content_length = len(r)
+                    # 直接返回str的话 wsgi server 会逐个字节迭代
+                    r = [r]
+                if gzip:
+                    r = _gzip_body(ctx.request, response, r)
                 start_response(response.status, response.headers)
+                if ctx.request.request_method == 'HEAD':
+                    # 不发送的body 也要关闭(流式渲染的生成器、打开的文件)
+                    if hasattr(r, 'close'):
+                        r.close()
+                    return []
                 return r
             except _RedirectError, e:
                 response.set_header('Location', e.location)
                 start_response(e.status, response.headers)
                 return []
+            except _NotModified, e:
+                if gzip:
+                    _gzip_not_modified(ctx.request, response)
+                response.unset_header('Content-Type')
+                response.unset_header('Content-Length')
+                start_response(e.status, response.headers)
+                return []
             except _HttpError, e:
                 start_response(e.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
@@ -1609,13 +3053,118 @@ class WSGIApplication(object):
                     stacks.replace('<', '&lt;').replace('>', '&gt;'),
                     '</pre></div></body></html>']
             finally:
+                ctx.request.close()
                 del ctx.application
                 del ctx.request
                 del ctx.response
 
         return wsgi
 
+def _bench_router(n=500, rounds=20000):
+    """
+    对比 n 个动态路由时 线性匹配每个路由的re 和 路由树的分发耗时：
+        python web.py bench
+    """
+    routes = []
+    for i in range(n):
+        routes.append(Route(get('/api/r%d/:id/items/:item<int>' % i)(lambda *args: args)))
+    router = Router()
+    for r in routes:
+        router.add(r)
+    paths = ['/api/r0/abc/items/1', '/api/r%d/abc/items/1' % (n // 2), '/api/r%d/abc/items/1' % (n - 1), '/api/none/abc/items/1']
+
+    def _linear(path):
+        for r in routes:
+            args = r.match(path)
+            if args:
+                return r, args
+        return None, None
+
+    for path in paths:
+        assert _linear(path) == router.match('GET', path)
+        L = []
+        for name, fn in (('linear', _linear), ('tree', lambda p: router.match('GET', p))):
+            start = time.time()
+            for _ in xrange(rounds):
+                fn(path)
+            L.append('%s %.2fus' % (name, (time.time() - start) * 1000000.0 / rounds))
+        print '%d routes, %-28s %s' % (n, path, ', '.join(L))
+
+
+def _bench_input(rounds=20000):
+    """
+    对比 cgi.FieldStorage 和 urlparse 解析一个 /api/authenticate 那样的小表单的耗时：
+        python web.py bench
+    """
+    payload = 'email=admin%40example.com&passwd=0c5a3f0e6d1b2c4f8a9e7d6c5b4a3f2e1d0c9b8a&remember=true'
+
+    def _environ():
+        return {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                'CONTENT_LENGTH': str(len(payload)), 'QUERY_STRING': '', 'wsgi.input': StringIO(payload)}
+
+    def _field_storage():
+        fs = cgi.FieldStorage(fp=_environ()['wsgi.input'], environ=_environ(), keep_blank_values=True)
+        return dict((k, utils.to_unicode(fs[k].value)) for k in fs)
+
+    def _fast():
+        return Request(_environ()).input()
+
+    assert _field_storage() == _fast()
+    L = []
+    for name, fn in (('FieldStorage', _field_storage), ('parse_qsl', _fast)):
+        start = time.time()
+        for _ in xrange(rounds):
+            fn()
+        L.append('%s %.2fus' % (name, (time.time() - start) * 1000000.0 / rounds))
+    print 'urlencoded body of %d bytes: %s' % (len(payload), ', '.join(L))
+
+
+def _bench_wsgi(rounds=20000):
+    """
+    一个带 cookie 和常见 header 的请求经过拦截器和动态路由的完整 wsgi() 耗时：
+        python web.py bench
+    """
+    @interceptor('/')
+    def _bind_user(next):
+        ctx.request.user = ctx.request.cookie('awesession')
+        return next()
+
+    @get('/blog/:id')
+    def _blog(id):
+        ctx.request.header('User-Agent')
+        return 'blog %s' % id
+
+    app = WSGIApplication()
+    app.add_interceptor(_bind_user)
+    app.add_url(_blog)
+    fn = app.get_wsgi_application()
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': '/blog/001402710285786', 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '9000', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1', 'wsgi.input': StringIO(''),
+        'wsgi.url_scheme': 'http', 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        'HTTP_HOST': 'localhost:9000', 'HTTP_CONNECTION': 'keep-alive', 'HTTP_CACHE_CONTROL': 'max-age=0',
+        'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36',
+        'HTTP_REFERER': 'http://localhost:9000/', 'HTTP_ACCEPT_ENCODING': 'gzip,deflate,sdch',
+        'HTTP_ACCEPT_LANGUAGE': 'zh-CN,zh;q=0.8,en;q=0.6',
+        'HTTP_COOKIE': 'awesession=001402710285786-1403315185-1a5f4ab5d8c1e19a0e32f1d6c2b7e3f4; _ga=GA1.1.1234567.1402710285; theme=dark',
+    }
+
+    def _start_response(status, headers):
+        pass
+
+    start = time.time()
+    for _ in xrange(rounds):
+        fn(dict(environ), _start_response)
+    print 'wsgi() with interceptor, cookie and header lookups: %.2fus per request' % ((time.time() - start) * 1000000.0 / rounds)
+
+
 if __name__ == '__main__':
     sys.path.append('.')
-    import doctest
-    doctest.testmod()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        _bench_router()
+        _bench_input()
+        _bench_wsgi()
+    else:
+        import doctest
+        doctest.testmod()
@@ -5,11 +5,12 @@ __author__ = 'Michael Liao'
 
 import os, re, time, base64, hashlib, logging
 
-from transwarp.web import get, post, ctx, view, interceptor, HttpError
+from transwarp import db
+from transwarp.web import get, post, ctx, view, interceptor, cache_control, cached_page, HttpError
 
 from apis import api, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 
-from models import User, Blog, Comment
+from models import User, Blog, Comment, blog_index
 from config import configs
 
 _COOKIE_NAME = 'awesession'
@@ -29,7 +30,8 @@ def parse_signed_cookie(cookie_str):
         id, expires, md5 = L
         if int(expires) < time.time():
             return None
-        user = User.get(id)
+        # 修改密码之后 旧cookie立即失效， 不能用其他worker上可能过期的缓存:
+        user = User.get(id, cached=False)
         if user is None:
             return None
         if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
@@ -48,7 +50,7 @@ def check_admin():
 def user_interceptor(next):
     logging.info('try to bind user from session cookie...')
     user = None
-    cookie = ctx.request.cookies.get(_COOKIE_NAME)
+    cookie = ctx.request.cookie(_COOKIE_NAME)
     if cookie:
         logging.info('parse session cookie...')
         user = parse_signed_cookie(cookie)
@@ -64,12 +66,26 @@ def manage_interceptor(next):
         return next()
     raise HttpError.seeother('/signin')
 
+# 页面里有当前用户， 只能由浏览器缓存， 每次用ETag验证；
+# 匿名用户看到的页面都一样， 在服务端缓存10秒， 登录用户不走缓存
+@cache_control(private=True)
+@cached_page(10, vary=lambda: None if ctx.request.user else 'anonymous')
 @view('blogs.html')
 @get('/')
 def index():
     blogs = Blog.find_all()
     return dict(blogs=blogs, user=ctx.request.user)
 
+@view('blog.html')
+@get('/blog/:blog_id')
+def blog(blog_id):
+    blog, comments = db.gather(
+        (Blog.get, blog_id),
+        lambda: Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id, shard_key=blog_id))
+    if blog is None:
+        raise HttpError.notfound()
+    return dict(blog=blog, comments=comments, user=ctx.request.user)
+
 @view('signin.html')
 @get('/signin')
 def signin():
@@ -115,8 +131,7 @@ def register_user():
         raise APIValueError('email')
     if not password or not _RE_MD5.match(password):
         raise APIValueError('password')
-    user = User.find_first('where email=?', email)
-    if user:
+    if User.exists('where email=?', email):
         raise APIError('register:failed', 'email', 'Email is already in use.')
     user = User(name=name, email=email, password=password, image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email).hexdigest())
     user.insert()
@@ -130,6 +145,7 @@ def register_user():
 def register():
     return dict()
 
+@cache_control(max_age=10)
 @api
 @get('/api/users')
 def api_get_users():
@@ -137,3 +153,19 @@ def api_get_users():
     for u in users:
         u.password = '******'
     return dict(users=users)
+
+@api
+@get('/api/blogs/search')
+def api_search_blogs():
+    i = ctx.request.input(q='', page='1', size='10')
+    q = i.q.strip()
+    if not q:
+        raise APIValueError('q')
+    try:
+        page = max(int(i.page), 1)
+        size = min(max(int(i.size), 1), 50)
+    except ValueError:
+        raise APIValueError('page')
+    total, hits = blog_index.search(q, page, size)
+    blogs = filter(None, db.gather(*[(Blog.get, blog_id) for blog_id, score in hits]))
+    return dict(total=total, page=page, size=size, blogs=blogs)
@@ -9,7 +9,7 @@ A WSGI application entry.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import os, time
+import os, time, threading
 from datetime import datetime
 
 from transwarp import db
@@ -32,17 +32,47 @@ def datetime_filter(t):
 
 # init db:
 db.create_engine(**configs.db)
+for group, shards in configs.shards.iteritems():
+    if shards:
+        db.add_shards(group, shards)
 
 # init wsgi app:
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+_root = os.path.dirname(os.path.abspath(__file__))
+if configs.templates.production:
+    template_engine = Jinja2TemplateEngine(os.path.join(_root, 'templates'), cache_dir=os.path.join(_root, configs.templates.cache), stream=configs.templates.stream, auto_reload=False)
+else:
+    template_engine = Jinja2TemplateEngine(os.path.join(_root, 'templates'), stream=configs.templates.stream)
 template_engine.add_filter('datetime', datetime_filter)
+if configs.templates.production:
+    template_engine.precompile()
 
 wsgi.template_engine = template_engine
 
 import urls
 
+import models
+
+# 只合并 Blog.get 的并发查询， 比如被大量转发的blog 同时到达的请求；
+# 不全局开启， 因为写操作提交后的查询 可能加入提交之前就开始执行的相同查询 读到旧数据:
+db.set_single_flight(True, 'select * from %s where %s=?' % (models.Blog.__table__, models.Blog.__primary_key__.name))
+
+# init search index, only the process holding the write lock builds an empty index, in background:
+def build_search_index():
+    try:
+        models.blog_index.rebuild(models.Blog.find_all())
+    finally:
+        models.blog_index.start()
+
+models.blog_index.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.search.path))
+if models.blog_index.writable and len(models.blog_index) == 0:
+    t = threading.Thread(target=build_search_index)
+    t.daemon = True
+    t.start()
+else:
+    models.blog_index.start()
+
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)